@@ -0,0 +1,68 @@
+#!/bin/env python
+
+import argparse
+import datetime
+import json
+import os
+import sys
+import timeit
+from bson import json_util
+from bson.decimal128 import Decimal128
+from bson.objectid import ObjectId
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'shared'))
+
+import codec
+
+"""
+Microbenchmarks for the serialization done on the hot paths of the pipeline.
+
+Producer: encoding a change event document with bson.json_util.dumps vs. codec.dumps.
+Consumer: re-encoding an S3 body for _bulk (json.loads + json.dumps) vs. passing the bytes through.
+
+Usage: python3 benchmarks/bench_codec.py [--fields 50] [--number 2000]
+"""
+
+
+def make_document(fields):
+    """Return a document shaped like a typical fullDocument, with nested values and BSON types."""
+    document = {'_id': ObjectId(), 'createdAt': datetime.datetime.utcnow(), 'price': Decimal128('19.99')}
+    for i in range(fields):
+        document['field_{}'.format(i)] = 'value {}'.format(i) if i % 3 else {'n': i, 'tags': ['a', 'b', i], 'at': datetime.datetime.utcnow()}
+    return document
+
+
+def run(name, statement, number):
+    seconds = timeit.timeit(statement, number=number)
+    print('{:<45} {:>10.2f} us/op {:>12.0f} ops/s'.format(name, seconds / number * 1e6, number / seconds))
+    return seconds
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serialization microbenchmarks')
+    parser.add_argument('--fields', type=int, default=50, help='top level fields per document')
+    parser.add_argument('--number', type=int, default=2000, help='operations per benchmark')
+    args = parser.parse_args()
+
+    document = make_document(args.fields)
+    encoded = codec.dumps(document)
+    source = encoded.encode('utf-8')
+    action_line = codec.bulk_action_line('index', {'_index': 'db-coll', '_id': '1'})
+
+    assert json.loads(encoded) == json.loads(json_util.dumps(document))
+
+    print('document: {} fields, {} bytes'.format(args.fields, len(source)))
+
+    print('\nproducer - BSON to JSON')
+    baseline = run('bson.json_util.dumps', lambda: json_util.dumps(document), args.number)
+    fast = run('codec.dumps', lambda: codec.dumps(document), args.number)
+    print('speedup: {:.2f}x'.format(baseline / fast))
+
+    print('\nconsumer - S3 body to _bulk source')
+    baseline = run('json.loads + json.dumps', lambda: codec.build_bulk_body([(action_line, json.dumps(json.loads(source)).encode('utf-8'))]), args.number)
+    fast = run('bytes passthrough', lambda: codec.build_bulk_body([(action_line, source)]), args.number)
+    print('speedup: {:.2f}x'.format(baseline / fast))
+
+
+if __name__ == '__main__':
+    main()
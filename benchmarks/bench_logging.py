@@ -0,0 +1,55 @@
+#!/bin/env python
+
+import argparse
+import os
+import re
+import subprocess
+import sys
+
+"""
+Handler throughput at each log level, with and without the sampling and byte budget of shared/log.py.
+
+Runs benchmarks/bench_pipeline.py once per configuration in a fresh process, with the log written to
+/dev/null, and reports the reader, writer and end to end throughput it measures.
+
+Usage: python3 benchmarks/bench_logging.py [--events 20000] [--doc-bytes 2048]
+"""
+
+PIPELINE_BENCHMARK = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bench_pipeline.py')
+
+# (name, environment) - unlimited runs log every event and never drop records, like plain logging would
+CONFIGURATIONS = [
+    ('WARNING', {'LOGLEVEL': 'WARNING'}),
+    ('INFO', {'LOGLEVEL': 'INFO'}),
+    ('INFO unlimited', {'LOGLEVEL': 'INFO', 'LOG_EVENT_SAMPLE_RATE': '1', 'LOG_BYTES_PER_INVOCATION': '0'}),
+    ('DEBUG', {'LOGLEVEL': 'DEBUG'}),
+    ('DEBUG unlimited', {'LOGLEVEL': 'DEBUG', 'LOG_EVENT_SAMPLE_RATE': '1', 'LOG_BYTES_PER_INVOCATION': '0', 'LOG_PAYLOAD_MAX_CHARS': '1000000'}),
+]
+
+THROUGHPUT = re.compile(r'^(reader|writer|end to end):\s+([\d.]+)', re.MULTILINE)
+
+
+def run(environment, args):
+    """run the pipeline benchmark and return its {stage: events per second}"""
+    env = dict(os.environ, **environment)
+    output = subprocess.run(
+        [sys.executable, PIPELINE_BENCHMARK, '--events', str(args.events), '--doc-bytes', str(args.doc_bytes)],
+        env=env, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=True, universal_newlines=True).stdout
+
+    return {stage: float(value) for stage, value in THROUGHPUT.findall(output)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Handler throughput per log level')
+    parser.add_argument('--events', type=int, default=20000, help='change events in the stream')
+    parser.add_argument('--doc-bytes', type=int, default=2048, help='payload size of each document')
+    args = parser.parse_args()
+
+    print('{:<20} {:>14} {:>14} {:>14}'.format('logging', 'reader ev/s', 'writer msg/s', 'end to end'))
+    for name, environment in CONFIGURATIONS:
+        result = run(environment, args)
+        print('{:<20} {:>14.0f} {:>14.0f} {:>14.0f}'.format(name, result['reader'], result['writer'], result['end to end']))
+
+
+if __name__ == '__main__':
+    main()
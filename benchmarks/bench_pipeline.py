@@ -0,0 +1,504 @@
+#!/bin/env python
+
+import argparse
+import importlib.util
+import io
+import json
+import logging
+import os
+import random
+import sys
+import threading
+import time
+from bson.objectid import ObjectId
+from bson.timestamp import Timestamp
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, os.path.join(ROOT, 'shared'))
+
+import aws_clients
+import delta
+
+"""
+Offline end-to-end benchmark of the DocumentDB reader and the OpenSearch writer Lambda functions.
+
+Both lambda_handler functions run unmodified against in-process stand-ins: a simulated DocumentDB change
+stream and state collection, S3 and SQS fakes installed in the shared aws_clients registry, and an
+OpenSearch fake that records every _bulk request. Optional per-call latencies emulate the network.
+
+The reader is invoked until the stream is drained, then the queued SQS messages are fed to the writer in
+batches, like the event source mapping does. Per-stage latency percentiles, throughput and a last write
+wins consistency check of the indexed documents are reported, so optimizations can be compared across commits.
+
+The change stream pipeline is not evaluated by the simulator, WATCHED_* filters have no effect here.
+--unordered publishes to a standard queue instead and shuffles the messages before the writer sees them,
+so consistency then rests on the external versions the writer derives from clusterTime. With DELTA_UPDATES=true
+the stream carries the updateDescription of updates instead of their full document, and the OpenSearch fake
+applies the partial updates the writer sends.
+
+Usage: python3 benchmarks/bench_pipeline.py [--events 20000] [--doc-bytes 2048] [--update-ratio 0.8] [--skew 2]
+Reader and writer environment variables, e.g. COALESCE_EVENTS or S3_SEGMENT_MAX_BYTES, are honoured.
+EMF metrics are off unless METRICS_ENABLED=true is set.
+"""
+
+logger = logging.getLogger()
+
+
+class StageTimer:
+    """Collect call durations per stage and report their percentiles"""
+
+    def __init__(self):
+        self.samples = {}
+        self.lock = threading.Lock()
+
+    def record(self, stage, seconds):
+        with self.lock:
+            self.samples.setdefault(stage, []).append(seconds)
+
+    def timed(self, stage, latency_ms, function, *args, **kwargs):
+        """call function after sleeping latency_ms, recording the duration of both under stage"""
+        start = time.perf_counter()
+        if latency_ms:
+            time.sleep(latency_ms / 1000.0)
+        try:
+            return function(*args, **kwargs)
+        finally:
+            self.record(stage, time.perf_counter() - start)
+
+    def report(self):
+        print('{:<28} {:>8} {:>10} {:>10} {:>10} {:>10} {:>10}'.format('stage', 'calls', 'total s', 'p50 ms', 'p90 ms', 'p99 ms', 'max ms'))
+        for stage in sorted(self.samples):
+            samples = sorted(self.samples[stage])
+            print('{:<28} {:>8} {:>10.3f} {:>10.3f} {:>10.3f} {:>10.3f} {:>10.3f}'.format(
+                stage, len(samples), sum(samples), percentile(samples, 50) * 1e3, percentile(samples, 90) * 1e3,
+                percentile(samples, 99) * 1e3, samples[-1] * 1e3))
+
+
+def percentile(sorted_samples, p):
+    """nearest-rank percentile of an already sorted list"""
+    return sorted_samples[max(0, min(len(sorted_samples) - 1, int(round(p / 100.0 * len(sorted_samples) + 0.5)) - 1))]
+
+
+class Workload:
+    """Synthetic change events: inserts of new documents and updates of existing ones, skewed towards hot keys.
+
+    Updates pick among the existing documents with a power law, skew 0 is uniform and larger values
+    concentrate updates on the oldest documents. Each fullDocument carries its seq, so the final state
+    of every document is known. Updates set seq, and set tag on even and remove it on odd seqs.
+    """
+
+    def __init__(self, events, doc_bytes, update_ratio, skew, seed, database, collection):
+        rng = random.Random(seed)
+        self.database = database
+        self.collection = collection
+        self.doc_bytes = doc_bytes
+        # clusterTime starts now, so replication lag metrics are meaningful
+        self.start_time = int(time.time())
+        self.operations = []
+        self.last_seq = {}
+        keys = []
+
+        for seq in range(events):
+            if keys and rng.random() < update_ratio:
+                key = keys[int(len(keys) * rng.random() ** (1 + skew))]
+                operation_type = 'update'
+            else:
+                key = ObjectId()
+                keys.append(key)
+                operation_type = 'insert'
+            self.operations.append((operation_type, key))
+            self.last_seq[str(key)] = seq
+
+    def __len__(self):
+        return len(self.operations)
+
+    def expected_tag(self, seq):
+        """tag of the document after change seq"""
+        return seq if self.operations[seq][0] == 'insert' or seq % 2 == 0 else None
+
+    def event(self, seq, full_document=None):
+        """build change event seq, a fresh dict on every call since the reader mutates it"""
+        (operation_type, key) = self.operations[seq]
+        change_event = {
+            '_id': {'_data': token(seq + 1)},
+            'operationType': operation_type,
+            'clusterTime': Timestamp(self.start_time + seq // 100000, seq % 100000 + 1),
+            'ns': {'db': self.database, 'coll': self.collection},
+            'documentKey': {'_id': key}
+        }
+
+        if operation_type == 'update':
+            if seq % 2 == 0:
+                change_event['updateDescription'] = {'updatedFields': {'seq': seq, 'tag': seq}, 'removedFields': []}
+            else:
+                change_event['updateDescription'] = {'updatedFields': {'seq': seq}, 'removedFields': ['tag']}
+            if full_document != 'updateLookup':
+                return change_event
+
+        change_event['fullDocument'] = {'_id': key, 'seq': seq, 'name': 'document {}'.format(key), 'payload': 'x' * self.doc_bytes}
+        if self.expected_tag(seq) is not None:
+            change_event['fullDocument']['tag'] = seq
+        return change_event
+
+
+def token(position):
+    """resume token of the stream position, which is also the index of the next event"""
+    return '{:032x}'.format(position)
+
+
+class FakeChangeStream:
+    """Change stream over a Workload, resuming after a token of its own"""
+
+    def __init__(self, workload, resume_after, timer, full_document=None):
+        self.workload = workload
+        self.timer = timer
+        self.full_document = full_document
+        if isinstance(resume_after, dict):
+            resume_after = resume_after['_data']
+        self.position = int(resume_after, 16) if resume_after else len(workload)
+        self.resume_token = {'_data': token(self.position)}
+        self.alive = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.alive = False
+
+    def try_next(self):
+        return self.timer.timed('docdb.try_next', 0, self.next_event)
+
+    def next_event(self):
+        if self.position >= len(self.workload):
+            return None
+        change_event = self.workload.event(self.position, self.full_document)
+        self.position += 1
+        self.resume_token = change_event['_id']
+        return change_event
+
+
+class FakeCollection:
+    """Watched collection and state collection stand-in"""
+
+    def __init__(self, client):
+        self.client = client
+        self.state = {}
+
+    def watch(self, pipeline=None, full_document=None, resume_after=None, max_await_time_ms=None):
+        return FakeChangeStream(self.client.workload, resume_after, self.client.timer, full_document)
+
+    def find_one(self, state_filter, projection=None):
+        return self.state.get(self.state_key(state_filter))
+
+    def update_one(self, state_filter, update, upsert=False):
+        self.client.timer.record('docdb.state_update', 0)
+        state = self.state.setdefault(self.state_key(state_filter), {})
+        state.update(update.get('$set', {}))
+        for (field, value) in update.get('$inc', {}).items():
+            state[field] = state.get(field, 0) + value
+
+    def state_key(self, state_filter):
+        return json.dumps({k: v for k, v in state_filter.items() if k != 'currentState'}, sort_keys=True)
+
+
+class FakeMongoClient:
+    """MongoClient stand-in, client[db][collection] returns the same FakeCollection on every lookup"""
+
+    def __init__(self, workload, timer):
+        self.workload = workload
+        self.timer = timer
+        self.collections = {}
+
+    def __getitem__(self, database):
+        client = self
+
+        class Database:
+            def __getitem__(self, collection):
+                return client.collections.setdefault((database, collection), FakeCollection(client))
+
+            def watch(self, **kwargs):
+                return self['*'].watch(**kwargs)
+
+        return Database()
+
+
+class FakeS3:
+    """Versioned in-memory bucket"""
+
+    def __init__(self, timer, latency_ms):
+        self.timer = timer
+        self.latency_ms = latency_ms
+        self.objects = {}
+        self.lock = threading.Lock()
+        self.next_version = 0
+
+    def put_object(self, Bucket, Key, Body, **kwargs):
+        return self.timer.timed('s3.put_object', self.latency_ms, self.store, Bucket, Key, Body)
+
+    def store(self, bucket, key, body):
+        with self.lock:
+            self.next_version += 1
+            version_id = str(self.next_version)
+            self.objects[(bucket, key, version_id)] = body if isinstance(body, bytes) else body.encode('utf-8')
+        return {'ResponseMetadata': {'HTTPStatusCode': 200}, 'VersionId': version_id}
+
+    def get_object(self, Bucket, Key, VersionId=None, Range=None):
+        return self.timer.timed('s3.get_object', self.latency_ms, self.load, Bucket, Key, VersionId, Range)
+
+    def load(self, bucket, key, version_id, byte_range):
+        body = self.objects[(bucket, key, version_id)]
+        if byte_range is not None:
+            (start, end) = byte_range[len('bytes='):].split('-')
+            body = body[int(start):int(end) + 1]
+        return {'ResponseMetadata': {'HTTPStatusCode': 200}, 'Body': io.BytesIO(body)}
+
+    def delete_objects(self, Bucket, Delete):
+        return self.timer.timed('s3.delete_objects', self.latency_ms, self.remove, Bucket, Delete['Objects'])
+
+    def remove(self, bucket, objects):
+        with self.lock:
+            for obj in objects:
+                self.objects.pop((bucket, obj['Key'], obj['VersionId']), None)
+        return {'Errors': []}
+
+
+class FakeSQS:
+    """FIFO queue keeping every accepted message, deduplicated by MessageDeduplicationId"""
+
+    def __init__(self, timer, latency_ms):
+        self.timer = timer
+        self.latency_ms = latency_ms
+        self.messages = []
+        self.deduplication_ids = set()
+
+    def send_message_batch(self, QueueUrl, Entries):
+        return self.timer.timed('sqs.send_message_batch', self.latency_ms, self.enqueue, Entries)
+
+    def enqueue(self, entries):
+        for entry in entries:
+            if 'MessageDeduplicationId' in entry:
+                if entry['MessageDeduplicationId'] in self.deduplication_ids:
+                    continue
+                self.deduplication_ids.add(entry['MessageDeduplicationId'])
+            # Standard queue messages have no group
+            attributes = {'MessageGroupId': entry['MessageGroupId']} if 'MessageGroupId' in entry else {}
+            self.messages.append({
+                'messageId': str(len(self.messages)),
+                'body': entry['MessageBody'],
+                'attributes': attributes
+            })
+        return {'Successful': [{'Id': entry['Id']} for entry in entries], 'Failed': []}
+
+    def get_queue_attributes(self, QueueUrl, AttributeNames):
+        return {'Attributes': {'ApproximateNumberOfMessages': str(len(self.messages))}}
+
+
+class FakeSNS:
+    def publish(self, **kwargs):
+        return {}
+
+
+class FakeIndices:
+    """Index API stand-in, indices exist once created and keep their settings"""
+
+    def __init__(self, timer, latency_ms):
+        self.timer = timer
+        self.latency_ms = latency_ms
+        self.settings = {}
+        self.aliases = {}
+
+    def exists(self, index):
+        return self.timer.timed('opensearch.indices', self.latency_ms, lambda: index in self.settings or index in self.aliases)
+
+    def create(self, index, body=None):
+        settings = (body or {}).get('settings', {}).get('index', {})
+        self.settings[index] = {'index.refresh_interval': str(settings.get('refresh_interval', '1s')),
+                                'index.number_of_replicas': str(settings.get('number_of_replicas', 1))}
+        for alias in (body or {}).get('aliases', {}):
+            self.aliases[alias] = index
+        return self.timer.timed('opensearch.indices', self.latency_ms, lambda: {'acknowledged': True})
+
+    def put_index_template(self, name, body):
+        return {'acknowledged': True}
+
+    def get_settings(self, index, **kwargs):
+        index = self.aliases.get(index, index)
+        return {index: {'settings': dict(self.settings[index])}}
+
+    def put_settings(self, index, body):
+        self.settings[index].update({'index.' + k: str(v) for k, v in body['index'].items()})
+        return {'acknowledged': True}
+
+    def rollover(self, alias, body):
+        return {'rolled_over': False}
+
+
+class FakeOpenSearch:
+    """Records the documents of every _bulk request, last write wins unless an external version is older.
+
+    Partial updates are applied like OpenSearch does, with a recursive merge of doc or, in place of running
+    the painless script, shared/delta.py on its params.
+    """
+
+    def __init__(self, timer, latency_ms):
+        self.timer = timer
+        self.latency_ms = latency_ms
+        self.documents = {}
+        self.versions = {}
+        self.indices = FakeIndices(timer, latency_ms)
+
+    def bulk(self, body, **kwargs):
+        return self.timer.timed('opensearch.bulk', self.latency_ms, self.apply, body)
+
+    def apply(self, body):
+        lines = iter(body.splitlines())
+        items = []
+        for line in lines:
+            if not line:
+                continue
+            (action, metadata), = json.loads(line).items()
+            key = (metadata['_index'], metadata['_id'])
+            if action == 'update':
+                items.append({action: self.update(key, json.loads(next(lines)))})
+                continue
+            if metadata.get('version_type') in ('external', 'external_gte'):
+                stored_version = self.versions.get(key, -1)
+                if metadata['version'] < stored_version or \
+                        (metadata['version'] == stored_version and metadata['version_type'] == 'external'):
+                    if action != 'delete':
+                        next(lines)
+                    items.append({action: {'_index': metadata['_index'], '_id': metadata['_id'], 'status': 409,
+                                           'error': {'type': 'version_conflict_engine_exception'}}})
+                    continue
+                self.versions[key] = metadata['version']
+            if action == 'delete':
+                self.documents.pop(key, None)
+            else:
+                self.documents[key] = next(lines)
+            items.append({action: {'_index': metadata['_index'], '_id': metadata['_id'], 'status': 201}})
+        return {'took': 0, 'errors': False, 'items': items}
+
+    def update(self, key, body):
+        """apply a partial update, returning its bulk item result"""
+        result = {'_index': key[0], '_id': key[1]}
+        if key not in self.documents:
+            return dict(result, status=404, error={'type': 'document_missing_exception'})
+
+        document = json.loads(self.documents[key])
+        if 'doc' in body:
+            merge(document, body['doc'])
+        else:
+            params = body['script']['params']
+            delta.apply_update(document, {'updatedFields': params['set'], 'removedFields': params['unset']})
+        self.documents[key] = json.dumps(document).encode('utf-8')
+        # Updates bump the internal version by one, like OpenSearch
+        self.versions[key] = self.versions.get(key, 0) + 1
+        return dict(result, status=200)
+
+
+def merge(document, partial_document):
+    """merge a partial document into a document, recursively for objects"""
+    for (field, value) in partial_document.items():
+        if isinstance(value, dict) and isinstance(document.get(field), dict):
+            merge(document[field], value)
+        else:
+            document[field] = value
+
+
+def load_lambda(name, directory):
+    """import a lambda_function.py under its own module name, both functions share the name lambda_function"""
+    spec = importlib.util.spec_from_file_location(name, os.path.join(ROOT, directory, 'lambda_function.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline end-to-end pipeline benchmark')
+    parser.add_argument('--events', type=int, default=20000, help='change events in the stream')
+    parser.add_argument('--doc-bytes', type=int, default=2048, help='payload size of each document')
+    parser.add_argument('--update-ratio', type=float, default=0.8, help='share of events that update an existing document')
+    parser.add_argument('--skew', type=float, default=2.0, help='hot key skew of updates, 0 is uniform')
+    parser.add_argument('--seed', type=int, default=1, help='workload random seed')
+    parser.add_argument('--documents-per-run', type=int, default=5000, help='Documents_per_run of each reader invocation')
+    parser.add_argument('--batch-size', type=int, default=10, help='SQS messages per writer invocation')
+    parser.add_argument('--s3-latency-ms', type=float, default=0, help='added latency of every S3 call')
+    parser.add_argument('--sqs-latency-ms', type=float, default=0, help='added latency of every SQS call')
+    parser.add_argument('--opensearch-latency-ms', type=float, default=0, help='added latency of every _bulk call')
+    parser.add_argument('--unordered', action='store_true', help='use a standard queue and deliver its messages in random order')
+    args = parser.parse_args()
+
+    # The reader runs before the writer, so the queue depth would throttle it unless rate control is asked for
+    for (name, value) in (('LOGLEVEL', 'WARNING'), ('METRICS_ENABLED', 'false'), ('BACKPRESSURE_ENABLED', 'false'),
+                          ('STATE_DB', 'statedb'), ('STATE_COLLECTION', 'statecol'),
+                          ('WATCHED_DB_NAME', 'benchdb'), ('WATCHED_COLLECTION_NAME', 'benchcoll'),
+                          ('Iterations_per_sync', '1000'), ('BUCKET_NAME', 'bench-bucket'),
+                          ('SQS_QUERY_URL', 'https://sqs.local/bench.fifo'), ('OPENSEARCH_URI', 'opensearch.local'),
+                          ('SNS_TOPIC_ARN_ALERT', 'arn:aws:sns:local:0:alert')):
+        os.environ.setdefault(name, value)
+    os.environ['Documents_per_run'] = str(args.documents_per_run)
+    if args.unordered:
+        os.environ['SQS_QUERY_URL'] = 'https://sqs.local/bench'
+
+    timer = StageTimer()
+    workload = Workload(args.events, args.doc_bytes, args.update_ratio, args.skew, args.seed,
+                        os.environ['WATCHED_DB_NAME'], os.environ['WATCHED_COLLECTION_NAME'])
+    sqs = FakeSQS(timer, args.sqs_latency_ms)
+    opensearch = FakeOpenSearch(timer, args.opensearch_latency_ms)
+    aws_clients.boto3_clients.update({'s3': FakeS3(timer, args.s3_latency_ms), 'sqs': sqs, 'sns': FakeSNS()})
+    aws_clients.opensearch_client = opensearch
+
+    reader = load_lambda('docdb_sqs_writer_lambda_function', 'docdb_sqs_writer_lambda')
+    writer = load_lambda('opensearch_writer_lambda_function', 'opensearch_writer_lambda')
+
+    reader.db_client = FakeMongoClient(workload, timer)
+    # The writer shares the rate controller state with the reader through the same state collection
+    aws_clients.documentdb_client = reader.db_client
+    # Start from the head of the stream instead of bootstrapping with a canary
+    namespace = reader.get_watched_namespaces()[0]
+    reader.store_last_processed_id(namespace, {'_data': token(0)})
+
+    print('workload: {} events, {} documents, {} bytes payload, update ratio {}, skew {}'.format(
+        len(workload), len(workload.last_seq), args.doc_bytes, args.update_ratio, args.skew))
+
+    start = time.perf_counter()
+    while True:
+        response = timer.timed('reader.lambda_handler', 0, reader.lambda_handler, {}, None)
+        if response['statusCode'] != 200:
+            break
+    reader_seconds = time.perf_counter() - start
+
+    if args.unordered:
+        random.Random(args.seed).shuffle(sqs.messages)
+
+    start = time.perf_counter()
+    failures = 0
+    for i in range(0, len(sqs.messages), args.batch_size):
+        response = timer.timed('writer.lambda_handler', 0, writer.lambda_handler, {'Records': sqs.messages[i:i + args.batch_size]}, None)
+        failures += len(response['batchItemFailures'])
+    writer_seconds = time.perf_counter() - start
+    writer.s3_cleanup_queue.maybe_flush()
+
+    print('\nthroughput')
+    print('reader: {:>10.0f} events/s   ({} events -> {} SQS messages in {:.3f} s)'.format(
+        len(workload) / reader_seconds, len(workload), len(sqs.messages), reader_seconds))
+    print('writer: {:>10.0f} messages/s ({} messages -> {} documents in {:.3f} s, {} failed)'.format(
+        len(sqs.messages) / writer_seconds if writer_seconds else 0, len(sqs.messages), len(opensearch.documents), writer_seconds, failures))
+    print('end to end: {:>6.0f} events/s\n'.format(len(workload) / (reader_seconds + writer_seconds)))
+
+    timer.report()
+
+    # Every document must hold the source of its last change
+    index = os.environ['WATCHED_DB_NAME'] + '-' + os.environ['WATCHED_COLLECTION_NAME']
+    stale = []
+    for doc_id, seq in workload.last_seq.items():
+        document = json.loads(opensearch.documents.get((index, doc_id), b'{}'))
+        if document.get('seq') != seq or document.get('tag') != workload.expected_tag(seq):
+            stale.append(doc_id)
+    print('\nconsistency: {}'.format('OK' if not stale else '{} of {} documents stale or missing'.format(len(stale), len(workload.last_seq))))
+
+    return 1 if stale else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,397 @@
+#!/bin/env python
+
+import argparse
+import datetime
+import os
+import re
+import time
+import uuid
+from bson import Decimal128, MaxKey, MinKey, Regex
+from bson.objectid import ObjectId
+from bson.timestamp import Timestamp
+from concurrent.futures import ThreadPoolExecutor
+
+import aws_clients
+import codec
+import index_manager
+import lambda_function
+import log
+import metrics
+
+"""
+Initial load of the documents that already exist in the watched namespaces, before their change streams are tailed.
+
+For each namespace the backfill:
+1. captures the current resume token, with the same canary insert/delete as the reader's first run,
+2. splits each collection into _id ranges and scans them in parallel with batched cursors,
+3. writes the documents straight to OpenSearch with _bulk (--target opensearch), or as insert events through the
+   S3/SQS pipeline of the reader (--target pipeline),
+4. stores the captured resume token, so the reader and the tailer replay every change made since step 1.
+
+Progress is kept per range in the state collection after every batch, so an interrupted backfill carries on where
+it stopped when started again. The reader and the tailer leave a namespace alone while its backfill is in progress.
+
+Uses the same environment variables as docdb_sqs_writer_lambda/lambda_function.py. --target opensearch also needs
+opensearch-py and the OPENSEARCH_* variables of shared/aws_clients.py, and switches the indices to bulk settings
+for the duration of the backfill, see shared/index_manager.py. Unless OPENSEARCH_EXTERNAL_VERSIONING is false,
+documents are written with the clusterTime of the captured resume token as their external version, like the
+OpenSearch writer does for change events. Documents OpenSearch rejects for good, e.g. with a
+mapper_parsing_exception, are logged and counted as DocumentsFailed, 429s, 5xx and timeouts are retried.
+
+Usage: PYTHONPATH=../shared python3 backfill.py [--target opensearch] [--ranges 16] [--concurrency 8] [--batch-size 1000]
+"""
+
+logger = log.setup()
+
+DEFAULT_RANGES = 16
+DEFAULT_CONCURRENCY = 8
+DEFAULT_BATCH_SIZE = 1000
+# Largest _bulk request body sent to OpenSearch
+BULK_MAX_BYTES = 10485760
+BULK_MAX_RETRIES = 5
+# How long to wait for the canary delete that carries the captured resume token
+CANARY_TIMEOUT_SECONDS = 60
+# $type aliases in _id sort order, comparison operators only match values within one group
+BSON_TYPE_ORDER = [['minKey'], ['null'], ['int', 'long', 'double', 'decimal'], ['symbol', 'string'], ['object'],
+                   ['array'], ['binData'], ['objectId'], ['bool'], ['date'], ['timestamp'], ['regex'], ['maxKey']]
+# Python types of each group, bool before the numbers since it is an int
+PYTHON_TYPE_ORDER = [(MinKey, 0), (type(None), 1), (bool, 8), ((int, float, Decimal128), 2), (str, 3), (dict, 4),
+                     ((list, tuple), 5), ((bytes, uuid.UUID), 6), (ObjectId, 7), (datetime.datetime, 9),
+                     (Timestamp, 10), ((Regex, re.Pattern), 11), (MaxKey, 12)]
+
+
+def capture_resume_token(namespace):
+    """Return the resume token and clusterTime of a canary delete, which marks the point the backfill reads from."""
+    canary_id = ObjectId()
+    watcher = lambda_function.get_watcher(namespace)
+
+    with watcher.watch(pipeline=lambda_function.get_change_stream_pipeline(namespace, canary_id),
+                       full_document='updateLookup', max_await_time_ms=1000) as change_stream:
+        lambda_function.insertCanary(namespace, canary_id)
+        lambda_function.deleteCanary(namespace, canary_id)
+
+        deadline = time.monotonic() + CANARY_TIMEOUT_SECONDS
+        while change_stream.alive and time.monotonic() < deadline:
+            change_event = change_stream.try_next()
+            if change_event is not None and change_event['operationType'] == 'delete' and \
+                    change_event['documentKey']['_id'] == canary_id:
+                return (change_event['_id'], change_event['clusterTime'])
+
+    raise Exception('Timed out waiting for the canary of {}'.format(lambda_function.get_namespace_name(namespace)))
+
+
+def use_external_versioning():
+    return os.environ.get('OPENSEARCH_EXTERNAL_VERSIONING', 'true').lower() == 'true'
+
+
+def is_retryable(status):
+    """True for bulk failures that may succeed later, e.g. 429 rejections, 5xx and timeouts"""
+    return status is None or status in (408, 429) or status >= 500
+
+
+def get_collections(namespace):
+    """Return the collections of a namespace, every replicated collection of a database level namespace."""
+    (database, collection) = namespace
+    if collection is not None:
+        return [collection]
+
+    collection_names = lambda_function.get_env_list('WATCHED_COLLECTION_NAMES')
+    return [name for name in lambda_function.get_db_client()[database].list_collection_names()
+            if name != lambda_function.CANARY_COLLECTION_NAME and (not collection_names or name in collection_names)]
+
+
+def split_ranges(collection_client, count):
+    """Split a collection into up to count [lower, upper) _id ranges, interpolated between its smallest and largest _id.
+
+    _id values of different BSON types never sort between two values of the same type, so when the smallest and the
+    largest _id have the same type every _id has it. Otherwise the collection is scanned as a single range without
+    bounds, see get_range_query().
+    """
+    first = collection_client.find_one({}, sort=[('_id', 1)], projection={'_id': 1})
+    last = collection_client.find_one({}, sort=[('_id', -1)], projection={'_id': 1})
+    if first is None:
+        return []
+
+    (low, high) = (first['_id'], last['_id'])
+    if get_type_order(low) != get_type_order(high):
+        return [(None, None)]
+
+    if isinstance(low, ObjectId) and isinstance(high, ObjectId):
+        (start, end) = (low.generation_time.timestamp(), high.generation_time.timestamp())
+        bounds = [ObjectId.from_datetime(datetime.datetime.fromtimestamp(start + (end - start) * k / count, datetime.timezone.utc))
+                  for k in range(1, count)]
+    elif isinstance(low, (int, float)) and isinstance(high, (int, float)) and not isinstance(low, bool) and not isinstance(high, bool):
+        if isinstance(low, int) and isinstance(high, int):
+            bounds = [low + (high - low) * k // count for k in range(1, count)]
+        else:
+            bounds = [low + (high - low) * k / count for k in range(1, count)]
+    else:
+        bounds = []
+
+    # Interpolated bounds can repeat when the _id space is small
+    bounds = sorted(set(bound for bound in bounds if low < bound <= high))
+    lowers = [low] + bounds
+    uppers = bounds + [None]
+
+    return list(zip(lowers, uppers))
+
+
+def get_type_order(value):
+    """Return the position of the BSON type of an _id in the _id sort order"""
+    for (python_type, position) in PYTHON_TYPE_ORDER:
+        if isinstance(value, python_type):
+            return position
+    raise Exception('Unsupported _id type {}'.format(type(value).__name__))
+
+
+def get_range_query(range_doc):
+    """Return the query of the documents of a range not backfilled yet.
+
+    A range without a lower bound holds _ids of several types, $gt only matches the type of the last _id, so the
+    types sorting after it are matched by $type.
+    """
+    query = {}
+    if range_doc.get('lastId') is not None and range_doc.get('lower') is None:
+        later_types = [alias for group in BSON_TYPE_ORDER[get_type_order(range_doc['lastId']) + 1:] for alias in group]
+        return {'$or': [{'_id': {'$gt': range_doc['lastId']}}, {'_id': {'$type': later_types}}]}
+    if range_doc.get('lastId') is not None:
+        query['$gt'] = range_doc['lastId']
+    elif range_doc.get('lower') is not None:
+        query['$gte'] = range_doc['lower']
+    if range_doc.get('upper') is not None:
+        query['$lt'] = range_doc['upper']
+
+    return {'_id': query} if query else {}
+
+
+def get_projection():
+    """Return the projection of WATCHED_FIELDS, the same fields the change stream pipeline keeps"""
+    fields = lambda_function.get_env_list('WATCHED_FIELDS')
+    return dict({field: 1 for field in fields}, _id=1) if fields else None
+
+
+def start_backfill(namespace, ranges_per_collection, target):
+    """Capture the resume token and record the ranges to scan, unless a backfill of the namespace was already started.
+
+    Returns the backfill header, which has completed=True if an earlier backfill of the namespace finished.
+    """
+    name = lambda_function.get_namespace_name(namespace)
+    state_collection = lambda_function.get_state_collection_client()
+    header_filter = dict(lambda_function.get_backfill_filter(namespace), backfillRange=None)
+    header = state_collection.find_one(header_filter)
+
+    if header is not None and header.get('completed'):
+        return header
+
+    if header is not None and header.get('resumeToken') is not None:
+        logger.info('Resuming backfill of {} started at {}.'.format(name, header['startedAt']))
+        return header
+
+    # Recorded first, so the reader stops tailing the namespace before the token is captured
+    header = dict(header_filter, completed=False, target=target, resumeToken=None,
+                  startedAt=datetime.datetime.now(datetime.timezone.utc).replace(microsecond=0))
+    state_collection.replace_one(header_filter, header, upsert=True)
+    # Ranges of a run that stopped before its token was stored are split again
+    state_collection.delete_many(dict(lambda_function.get_backfill_filter(namespace), backfillRange={'$ne': None}))
+
+    (resume_token, cluster_time) = capture_resume_token(namespace)
+
+    range_id = 0
+    for collection in get_collections(namespace):
+        collection_client = lambda_function.get_db_client()[namespace[0]][collection]
+        for (lower, upper) in split_ranges(collection_client, ranges_per_collection):
+            state_collection.insert_one(dict(lambda_function.get_backfill_filter(namespace), backfillRange=range_id,
+                                             collection=collection, lower=lower, upper=upper, lastId=None,
+                                             documents=0, done=False))
+            range_id += 1
+
+    # Stored last, the ranges are complete once the header has a token
+    state_collection.update_one(header_filter, {'$set': {'resumeToken': resume_token, 'resumeClusterTime': cluster_time}})
+    header.update({'resumeToken': resume_token, 'resumeClusterTime': cluster_time})
+    logger.info('Backfill of {} split into {} ranges.'.format(name, range_id))
+
+    return header
+
+
+class OpenSearchBackfillWriter:
+    """Index documents with _bulk requests of up to batch_size documents or BULK_MAX_BYTES, with version as their external version"""
+
+    def __init__(self, index, batch_size, version=None):
+        self.index = index
+        self.batch_size = batch_size
+        # external_gte like the OpenSearch writer, a change with the same clusterTime is not a conflict
+        self.metadata = {'version': version, 'version_type': 'external_gte'} if version is not None else {}
+        self.items = []
+        self.batch_bytes = 0
+
+    def add(self, doc_id, document, document_key=None):
+        source = codec.dumps(document).encode('utf-8')
+        self.items.append((codec.bulk_action_line('index', dict(self.metadata, _index=self.index, _id=doc_id)), source))
+        self.batch_bytes += len(source)
+        if len(self.items) >= self.batch_size or self.batch_bytes >= BULK_MAX_BYTES:
+            self.flush()
+
+    def flush(self):
+        """send the buffered documents, re-sending the ones OpenSearch rejected, e.g. with 429, with backoff"""
+        (items, self.items, self.batch_bytes) = (self.items, [], 0)
+
+        attempt = 0
+        while items:
+            with metrics.timer('OpenSearchBulk'):
+                response = aws_clients.get_opensearch_client().bulk(body=codec.build_bulk_body(items))
+
+            failed = []
+            for (item, result) in zip(items, (next(iter(result.values())) for result in response['items'])):
+                status = result.get('status')
+                # A version conflict means a newer change of the document was already written
+                if ('error' not in result and status is not None and status < 300) or status == 409:
+                    continue
+                if is_retryable(status):
+                    failed.append(item)
+                else:
+                    # e.g. mapper_parsing_exception, sending the document again fails the same way
+                    logger.error('Failed to index a document into {}: {} {}'.format(self.index, status, result.get('error')))
+                    metrics.add('DocumentsFailed')
+            if not failed:
+                return
+
+            attempt += 1
+            if attempt > BULK_MAX_RETRIES:
+                raise Exception('Failed to index {} documents into {}'.format(len(failed), self.index))
+
+            logger.warning('Retrying {} documents OpenSearch failed to index.'.format(len(failed)))
+            items = failed
+            time.sleep(0.5 * (2 ** (attempt - 1)))
+
+
+class PipelineBackfillWriter:
+    """Publish documents as insert events through the reader's S3/SQS pipeline"""
+
+    def __init__(self, database, collection, cluster_time):
+        self.database = database
+        self.collection = collection
+        self.cluster_time = cluster_time
+        self.s3_pipeline = lambda_function.S3UploadPipeline(lambda_function.SqsBatchPublisher(os.environ['SQS_QUERY_URL']))
+
+    def add(self, doc_id, document, document_key):
+        change_event = {
+            # Not a resume token, but unique per document and used as the SQS MessageDeduplicationId
+            '_id': {'_data': 'backfill-{}-{}-{}'.format(self.database, self.collection, doc_id)},
+            'operationType': 'insert',
+            'clusterTime': self.cluster_time,
+            'ns': {'db': self.database, 'coll': self.collection},
+            # The raw _id, so the document lands in the same FIFO message group as its later changes
+            'documentKey': {'_id': document_key}
+        }
+        self.s3_pipeline.submit(change_event, document, doc_id)
+
+    def flush(self):
+        self.s3_pipeline.drain()
+
+
+def backfill_range(namespace, range_doc, target, batch_size, started_at, cluster_time):
+    """Scan the rest of a range, writing and recording progress after every batch.
+
+    Documents are written as of cluster_time, the clusterTime of the captured resume token. Every change replayed
+    from that token is newer, so its external version in OpenSearch wins over the backfilled document.
+    """
+    state_collection = lambda_function.get_state_collection_client()
+    range_filter = dict(lambda_function.get_backfill_filter(namespace), backfillRange=range_doc['backfillRange'])
+    (database, collection) = (namespace[0], range_doc['collection'])
+
+    if target == 'opensearch':
+        version = codec.external_version(cluster_time.time, cluster_time.inc) if use_external_versioning() else None
+        writer = OpenSearchBackfillWriter(database + '-' + collection, batch_size, version)
+    else:
+        writer = PipelineBackfillWriter(database, collection, cluster_time)
+
+    readable = datetime.datetime.fromtimestamp(started_at).isoformat()
+    documents = range_doc['documents']
+    last_id = range_doc['lastId']
+    batch = 0
+
+    cursor = lambda_function.get_db_client()[database][collection].find(
+        get_range_query(range_doc), projection=get_projection(), sort=[('_id', 1)], batch_size=batch_size)
+
+    for document in cursor:
+        last_id = document.pop('_id')
+        # Same metadata fields as the reader adds to change events
+        document.update({'operation': 'backfill', 'timestamp': str(started_at), 'timestampReadable': str(readable)})
+        writer.add(str(last_id), document, last_id)
+        batch += 1
+
+        if batch == batch_size:
+            # Progress only moves once the batch is written, a restart repeats at most one batch
+            writer.flush()
+            documents += batch
+            state_collection.update_one(range_filter, {'$set': {'lastId': last_id, 'documents': documents}})
+            metrics.add('DocumentsBackfilled', batch)
+            batch = 0
+
+    writer.flush()
+    documents += batch
+    state_collection.update_one(range_filter, {'$set': {'lastId': last_id, 'documents': documents, 'done': True}})
+    metrics.add('DocumentsBackfilled', batch)
+    logger.info('Backfilled range {} of {}.{}: {} documents.'.format(range_doc['backfillRange'], database, collection, documents))
+
+    return documents - range_doc['documents']
+
+
+def backfill(namespace, ranges_per_collection, concurrency, batch_size, target):
+    """Load every document of a namespace that is not backfilled yet, then hand the namespace over to tailing."""
+    name = lambda_function.get_namespace_name(namespace)
+    header = start_backfill(namespace, ranges_per_collection, target)
+    if header.get('completed'):
+        # Its tail has moved on from the backfill's token, storing that again would rewind it
+        logger.info('Backfill of {} completed at {}, skipping it.'.format(name, header.get('completedAt')))
+        return
+
+    # A resumed backfill keeps the target it was started with
+    target = header['target']
+    # DocumentDB returns naive UTC datetimes
+    started_at = int(header['startedAt'].replace(tzinfo=datetime.timezone.utc).timestamp())
+    # Backfills started before the clusterTime was recorded fall back to their start time
+    cluster_time = header.get('resumeClusterTime') or Timestamp(started_at, 0)
+
+    state_collection = lambda_function.get_state_collection_client()
+    pending = list(state_collection.find(dict(lambda_function.get_backfill_filter(namespace),
+                                              backfillRange={'$ne': None}, done=False)))
+    indices = set(namespace[0] + '-' + range_doc['collection'] for range_doc in pending)
+
+    if target == 'opensearch':
+        for index in indices:
+            index_manager.begin_bulk(index)
+
+    try:
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            futures = [executor.submit(backfill_range, namespace, range_doc, target, batch_size, started_at, cluster_time)
+                       for range_doc in pending]
+            documents = sum(future.result() for future in futures)
+    finally:
+        if target == 'opensearch':
+            for index in indices:
+                index_manager.end_bulk(index)
+        metrics.flush()
+
+    # Tailing starts from the token captured before the first document was read
+    lambda_function.store_last_processed_id(namespace, header['resumeToken'])
+    state_collection.update_one(dict(lambda_function.get_backfill_filter(namespace), backfillRange=None),
+                                {'$set': {'completed': True, 'completedAt': datetime.datetime.now(datetime.timezone.utc)}})
+    logger.info('Backfill of {} complete, {} documents in this run.'.format(name, documents))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Backfill the existing documents of the watched namespaces')
+    parser.add_argument('--target', choices=['opensearch', 'pipeline'], default='pipeline',
+                        help='write to OpenSearch directly, or through S3/SQS and the OpenSearch writer')
+    parser.add_argument('--ranges', type=int, default=DEFAULT_RANGES, help='_id ranges per collection')
+    parser.add_argument('--concurrency', type=int, default=DEFAULT_CONCURRENCY, help='ranges scanned in parallel')
+    parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE, help='documents per cursor batch and write')
+    args = parser.parse_args()
+
+    for namespace in lambda_function.get_watched_namespaces():
+        backfill(namespace, args.ranges, args.concurrency, args.batch_size, args.target)
+
+
+if __name__ == '__main__':
+    main()
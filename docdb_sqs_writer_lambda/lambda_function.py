@@ -1,15 +1,25 @@
 #!/bin/env python
 
 import json
-import logging
 import os
-import boto3
+import aws_clients
+import backpressure
+import budget
+import codec
+import delta
+import log
+import metrics
+import collections
 import datetime
-from bson import json_util
-from pymongo import MongoClient
+import gzip
+import hashlib
+import math
+import time
+import uuid
+import zlib
+from bson.objectid import ObjectId
+from concurrent.futures import ThreadPoolExecutor
 from pymongo.errors import OperationFailure
-import urllib.request
-import urllib.parse
 
 """
 Read data from a DocumentDB collection's change stream and replicate that data to MSK.
@@ -21,8 +31,29 @@ STATE_COLLECTION: The name of the collection in which to store sync state.
 STATE_DB: The name of the database in which to store sync state.
 WATCHED_COLLECTION_NAME: The name of the collection to watch for changes.
 WATCHED_DB_NAME: The name of the database to watch for changes.
+WATCHED_NAMESPACES (optional): Comma separated namespaces to replicate in place of WATCHED_DB_NAME/WATCHED_COLLECTION_NAME,
+    each either db.collection or a whole db. Every namespace has its own change stream, resume token and
+    Documents_per_run budget, and namespaces are processed in parallel. A namespace that backfill.py is loading is
+    skipped until the backfill has stored its resume token. With more namespaces than NAMESPACE_CONCURRENCY, each
+    one reads for at most its share of the invocation, and the start order rotates between invocations.
+NAMESPACE_CONCURRENCY (optional): How many namespaces are processed in parallel. Defaults to 4.
+WATCHED_COLLECTION_NAMES (optional): Comma separated collections to replicate when a whole database is watched.
+    Defaults to every collection.
+WATCHED_OPERATION_TYPES (optional): Comma separated operation types to replicate, e.g. insert,update,replace,delete. Defaults to all.
+WATCHED_FIELDS (optional): Comma separated fullDocument fields to replicate, e.g. name,address.city. Defaults to all.
+DELTA_UPDATES (optional): Set to true to replicate updates as their updateDescription, the updatedFields and
+    removedFields, instead of an updateLookup of the full document. Saves a DocumentDB read per update and ships
+    only the changed fields, see shared/delta.py. Partial updates carry no external version, so this needs a
+    FIFO SQS_QUERY_URL and is ignored otherwise. Defaults to false. Without it, an update whose updateLookup found
+    no document is skipped, since the document was deleted and its delete event follows.
 Iterations_per_sync: How many events to process before syncing state.
-Documents_per_run: The max for the iterator loop. 
+CHECKPOINT_INTERVAL_MS (optional): Maximum time between state syncs while events are flowing. Defaults to 5000.
+COALESCE_EVENTS (optional): Only replicate the last change of each document between state syncs. Defaults to true.
+COALESCE_MAX_KEYS (optional): Documents held for coalescing before they are written out early. Defaults to 1000.
+Documents_per_run (optional): The max for the iterator loop, per namespace. Defaults to no limit.
+    The backpressure.py rate controller lowers it while the SQS queue backs up or OpenSearch rejects writes.
+TIME_BUDGET_SAFETY_MARGIN_MS (optional): Each run reads events while the learned cost of the next one still fits in
+    the remaining Lambda time less this margin, which is kept for writing out buffers and checkpointing. Defaults to 5000.
 SNS_TOPIC_ARN_ALERT: The topic to send exceptions.
 
 SNS target environment variables:
@@ -31,54 +62,72 @@ SNS_TOPIC_ARN_EVENT: The topic to send docdb events.
 S3 target environment variables:
 BUCKET_NAME: The name of the bucket that will save streamed data. 
 BUCKET_PATH (optional): The path of the bucket that will save streamed data.
+S3_UPLOAD_CONCURRENCY (optional): How many S3 objects are uploaded in parallel. Defaults to 8.
+INLINE_PAYLOAD_MAX_BYTES (optional): Documents up to this size are embedded in the SQS message as
+    inlineDocument instead of being written to S3. Defaults to 65536, 0 sends every document to S3.
+S3_SEGMENT_MAX_BYTES (optional): Larger documents are appended to gzip compressed NDJSON segment objects of up to
+    this size, one per checkpoint window, instead of one S3 object each. Defaults to 4194304, 0 writes one object per document.
+
+Stage latencies, counters and the lag from clusterTime to reading each event are written once per invocation
+as CloudWatch EMF, see shared/metrics.py.
 
 SQS target environment variables:
 SQS_QUERY_URL: The URL of the Amazon SQS queue to which a message is sent.
+MESSAGE_GROUP_PARTITIONS (optional): How many FIFO message groups each collection is spread over, by a hash of
+    documentKey. Changes to one document stay in order, and up to this many writer batches of a collection run
+    in parallel. Defaults to 1, a single db-coll group per collection.
+    SQS_QUERY_URL may also be a standard queue, without message groups or ordering. The OpenSearch writer then
+    relies on the external versions it derives from clusterTime to drop changes that arrive late.
 
 """
 
 db_client = None                        # DocumentDB client - used as source
-s3_client = None                        # S3 client - used as target
-sqs_client = None                       # SQS client - used as target
-# SNS client - for exception alerting purposes
-sns_client = boto3.client('sns')
-# S3 client - used to get the DocumentDB certificates
-clientS3 = boto3.resource('s3')
+state_collection_client = None          # DocumentDB state collection - resolved once
+s3_upload_executor = None               # Worker pool for S3 uploads - reused across invocations
+namespace_executor = None               # Worker pool for watched namespaces - reused across invocations
+namespace_offset = 0                    # Rotates the namespace start order between invocations
+# AWS clients (S3, SQS, SNS, Secrets Manager) come from the shared aws_clients registry
 
-logger = logging.getLogger()
-logger.setLevel(level = os.environ.get('LOGLEVEL', 'INFO').upper())
+# Structured logging with a per-invocation byte budget, see shared/log.py
+logger = log.setup()
 
 # The error code returned when data for the requested resume token has been deleted
 TOKEN_DATA_DELETED_CODE = 136
 
+# SendMessageBatch limits - at most 10 entries and 256 KB of message payload per request
+SQS_BATCH_MAX_ENTRIES = 10
+SQS_BATCH_MAX_BYTES = 262144
+# Longest MessageDeduplicationId SQS accepts
+SQS_DEDUPLICATION_ID_MAX_LENGTH = 128
+# How many times entries reported as failed by SendMessageBatch are re-sent before giving up
+SQS_BATCH_MAX_RETRIES = 3
 
-def get_credentials():
-    """Retrieve credentials from the Secrets Manager service."""
-    boto_session = boto3.session.Session()
+# Change event fields the reader relies on, always kept when WATCHED_FIELDS projects fullDocument
+CHANGE_EVENT_FIELDS = ('_id', 'operationType', 'ns', 'documentKey', 'clusterTime')
 
-    try:
-        secret_name = os.environ['DOCUMENTDB_SECRET']
+# Operation types process_change_event replicates, the only ones the coalescer holds per document
+DOCUMENT_OPERATION_TYPES = ('insert', 'update', 'replace', 'delete')
 
-        logger.info(
-            'Retrieving secret {} from Secrets Manager.'.format(secret_name))
+# Collection of the canary document when the whole database is watched
+CANARY_COLLECTION_NAME = 'canary-collection'
 
-        secrets_client = boto_session.client(service_name='secretsmanager',
-                                             region_name=boto_session.region_name)
-        secret_value = secrets_client.get_secret_value(SecretId=secret_name)
+# Default maximum time between resume token checkpoints
+DEFAULT_CHECKPOINT_INTERVAL_MS = 5000
 
-        secret = secret_value['SecretString']
-        secret_json = json.loads(secret)
-        username = secret_json['username']
-        password = secret_json['password']
+# Default number of documents held back for coalescing
+DEFAULT_COALESCE_MAX_KEYS = 1000
 
-        logger.info(
-            'Secret {} retrieved from Secrets Manger.'.format(secret_name))
+# Default maximum compressed size of an S3 segment object
+DEFAULT_S3_SEGMENT_MAX_BYTES = 4194304
 
-        return (username, password)
+# Default number of namespaces processed in parallel
+DEFAULT_NAMESPACE_CONCURRENCY = 4
 
-    except Exception as ex:
-        logger.error('Failed to retrieve secret {}'.format(secret_name))
-        raise
+# Default size of the S3 upload worker pool
+DEFAULT_S3_UPLOAD_CONCURRENCY = 8
+
+# Default size up to which documents are embedded in the SQS message, leaving room for the change event under the 256 KB SQS limit
+DEFAULT_INLINE_PAYLOAD_MAX_BYTES = 65536
 
 
 def get_db_client():
@@ -87,65 +136,77 @@ def get_db_client():
     global db_client
 
     if db_client is None:
-        logger.info('Creating new DocumentDB client.')
+        db_client = aws_clients.get_documentdb_client()
+
+    return db_client
+
+
+def get_state_collection_client():
+    """Return a DocumentDB client for the collection in which we store processing state."""
+    # Use a global variable so the collection is only resolved once per container
+    global state_collection_client
 
+    if state_collection_client is None:
+        logger.info('Creating state_collection_client.')
         try:
-            cluster_uri = os.environ['DOCUMENTDB_URI']
-            (username, password) = get_credentials()          
-            cluster_conn_str = 'mongodb://%s:%s@%s' % (urllib.parse.quote_plus(username), urllib.parse.quote_plus(password), cluster_uri)
-            db_client = MongoClient(
-                cluster_conn_str, ssl=True, retryWrites=False, tlsCAFile='rds-combined-ca-bundle.pem')
-            logger.info('Successfully created new DocumentDB client.')
+            db_client = get_db_client()
+            state_db_name = os.environ['STATE_DB']
+            state_collection_name = os.environ['STATE_COLLECTION']
+            state_collection_client = db_client[state_db_name][state_collection_name]
         except Exception as ex:
             logger.error(
-                'Failed to create new DocumentDB client: {}'.format(ex))
+                'Failed to create new state collection client: {}'.format(ex))
             # send_sns_alert(str(ex))
             raise
 
-    return db_client
+    return state_collection_client
 
 
-def get_state_collection_client():
-    """Return a DocumentDB client for the collection in which we store processing state."""
+def get_env_list(name):
+    """Return a comma separated environment variable as a list, empty when it is not set."""
+    return [value.strip() for value in os.environ.get(name, '').split(',') if value.strip()]
 
-    logger.info('Creating state_collection_client.')
-    try:
-        db_client = get_db_client()
-        state_db_name = os.environ['STATE_DB']
-        state_collection_name = os.environ['STATE_COLLECTION']
-        state_collection = db_client[state_db_name][state_collection_name]
-    except Exception as ex:
-        logger.error(
-            'Failed to create new state collection client: {}'.format(ex))
-        # send_sns_alert(str(ex))
-        raise
 
-    return state_collection
+def get_watched_namespaces():
+    """Return the watched namespaces as (database, collection) tuples, collection is None for a whole database."""
+    if "WATCHED_NAMESPACES" in os.environ:
+        namespaces = []
+        for namespace in get_env_list('WATCHED_NAMESPACES'):
+            # Collection names may contain dots, database names may not
+            (database, _, collection) = namespace.partition('.')
+            namespaces.append((database, collection or None))
+        return namespaces
+
+    return [(os.environ['WATCHED_DB_NAME'], os.environ.get('WATCHED_COLLECTION_NAME'))]
 
 
-def get_last_processed_id():
+def get_namespace_name(namespace):
+    """Return a namespace as db.collection, or db for a whole database."""
+    (database, collection) = namespace
+    return database if collection is None else database + '.' + collection
+
+
+def get_state_filter(namespace):
+    """Return the filter selecting the state document of a watched namespace."""
+    (database, collection) = namespace
+    if collection is not None:
+        return {'dbWatched': str(database), 'collectionWatched': str(collection), 'db_level': False}
+    else:
+        return {'dbWatched': str(database), 'db_level': True}
+
+
+def get_last_processed_id(namespace):
     """Return the resume token corresponding to the last successfully processed change event."""
     last_processed_id = None
-    logger.info('Returning last processed id.')
+    logger.debug('Returning last processed id.')
     try:
         state_collection = get_state_collection_client()
-        if "WATCHED_COLLECTION_NAME" in os.environ:
-            state_doc = state_collection.find_one({'currentState': True, 'dbWatched': str(os.environ['WATCHED_DB_NAME']),
-                                                   'collectionWatched': str(os.environ['WATCHED_COLLECTION_NAME']), 'db_level': False})
-        else:
-            state_doc = state_collection.find_one({'currentState': True, 'db_level': True,
-                                                   'dbWatched': str(os.environ['WATCHED_DB_NAME'])})
+        state_filter = get_state_filter(namespace)
+        state_filter.update({'currentState': True})
+        state_doc = state_collection.find_one(state_filter)
 
-        if state_doc is not None:
-            if 'lastProcessed' in state_doc:
-                last_processed_id = state_doc['lastProcessed']
-        else:
-            if "WATCHED_COLLECTION_NAME" in os.environ:
-                state_collection.insert_one({'dbWatched': str(os.environ['WATCHED_DB_NAME']),
-                                             'collectionWatched': str(os.environ['WATCHED_COLLECTION_NAME']), 'currentState': True, 'db_level': False})
-            else:
-                state_collection.insert_one({'dbWatched': str(os.environ['WATCHED_DB_NAME']), 'currentState': True,
-                                             'db_level': True})
+        if state_doc is not None and 'lastProcessed' in state_doc:
+            last_processed_id = state_doc['lastProcessed']
 
     except Exception as ex:
         logger.error('Failed to return last processed id: {}'.format(ex))
@@ -155,30 +216,108 @@ def get_last_processed_id():
     return last_processed_id
 
 
-def store_last_processed_id(resume_token):
+def store_last_processed_id(namespace, resume_token):
     """Store the resume token corresponding to the last successfully processed change event."""
 
-    logger.info('Storing last processed id.')
+    logger.debug('Storing last processed id.')
     try:
         state_collection = get_state_collection_client()
-        if "WATCHED_COLLECTION_NAME" in os.environ:
-            state_collection.update_one({'dbWatched': str(os.environ['WATCHED_DB_NAME']),
-                                         'collectionWatched': str(os.environ['WATCHED_COLLECTION_NAME'])}, {'$set': {'lastProcessed': resume_token}})
-        else:
-            state_collection.update_one({'dbWatched': str(os.environ['WATCHED_DB_NAME']), 'db_level': True, },
-                                        {'$set': {'lastProcessed': resume_token}})
+        # Upsert, so the state document of a new namespace is created with its first token
+        with metrics.timer('Checkpoint'):
+            state_collection.update_one(get_state_filter(namespace),
+                                        {'$set': {'lastProcessed': resume_token, 'currentState': True}}, upsert=True)
 
     except Exception as ex:
         logger.error('Failed to store last processed id: {}'.format(ex))
         # send_sns_alert(str(ex))
         raise
-    
+
+
+def get_backfill_filter(namespace):
+    """Return the filter selecting the backfill.py state documents of a namespace, see backfill.py."""
+    return {'backfillNamespace': get_namespace_name(namespace)}
+
+
+def is_backfill_in_progress(namespace):
+    """True while backfill.py loads the existing documents of a namespace, which is tailed once it is done."""
+    try:
+        state_filter = get_backfill_filter(namespace)
+        state_filter.update({'backfillRange': None, 'completed': False})
+        return get_state_collection_client().find_one(state_filter, projection={'_id': 1}) is not None
+
+    except Exception as ex:
+        logger.error('Failed to return backfill state: {}'.format(ex))
+        # send_sns_alert(str(ex))
+        raise
+
+
+class Checkpointer:
+    """Persist the resume token every every_events events or every_ms milliseconds, whichever comes first.
+
+    Coalesced events, pending S3 uploads and buffered SQS messages are written out before the token is stored, and the
+    write is skipped when the token has not moved since the last checkpoint.
+    """
+
+    def __init__(self, namespace, last_token, every_events, every_ms, s3_pipeline=None, sqs_publisher=None, coalescer=None):
+        self.namespace = namespace
+        self.last_token = last_token
+        self.every_events = every_events
+        self.every_ms = every_ms
+        self.coalescer = coalescer
+        self.s3_pipeline = s3_pipeline
+        self.sqs_publisher = sqs_publisher
+        self.events_since_checkpoint = 0
+        self.last_checkpoint = time.monotonic()
+        self.checkpoints_written = 0
+
+    def is_due(self, idle=False):
+        """True once enough events or time have passed since the last checkpoint.
+
+        With idle, the time alone is enough, so a stream without events still stores the position it has reached.
+        """
+        interval_passed = (time.monotonic() - self.last_checkpoint) * 1000 >= self.every_ms
+        if self.events_since_checkpoint == 0:
+            return idle and interval_passed
+        return self.events_since_checkpoint >= self.every_events or interval_passed
+
+    def event_processed(self, change_stream):
+        """count a processed event and checkpoint if one is due"""
+        self.events_since_checkpoint += 1
+        if self.is_due():
+            self.checkpoint(change_stream)
+
+    def checkpoint(self, change_stream):
+        """write out pending events and store the resume token covering them"""
+        resume_token = change_stream.resume_token
+
+        if self.coalescer is not None:
+            self.coalescer.flush()
+        if self.s3_pipeline is not None:
+            watermark = self.s3_pipeline.drain()
+            # Without events since the last checkpoint, the stream's own token, e.g. the postBatchResumeToken of
+            # an idle stream, is past everything published
+            if self.events_since_checkpoint > 0:
+                resume_token = watermark or resume_token
+        if self.sqs_publisher is not None:
+            self.sqs_publisher.flush()
+
+        self.events_since_checkpoint = 0
+        self.last_checkpoint = time.monotonic()
+
+        if resume_token is None or resume_token == self.last_token:
+            return
+
+        store_last_processed_id(self.namespace, resume_token)
+        self.last_token = resume_token
+        self.checkpoints_written += 1
+        logger.info('Synced token %s of %s to state collection', resume_token, get_namespace_name(self.namespace))
+
 
 def send_sns_alert(message):
     """send an SNS alert"""
     try:
         logger.info('Sending SNS alert.')
-        response = sns_client.publish(
+        response = aws_clients.get_client('sns').publish(
             TopicArn=os.environ['SNS_TOPIC_ARN_ALERT'],
             Message=message,
             Subject='Document DB Replication Alarm',
@@ -194,7 +333,7 @@ def publish_sns_event(message):
     """send event to SNS"""
     try:
         logger.info('Sending SNS message event.')
-        response = sns_client.publish(
+        response = aws_clients.get_client('sns').publish(
             TopicArn=os.environ['SNS_TOPIC_ARN_EVENT'],
             Message=message
         )
@@ -204,7 +343,7 @@ def publish_sns_event(message):
         raise
 
 
-def insertCanary():
+def insertCanary(namespace, canary_id=None):
     """Inserts a canary event for change stream activation"""
 
     canary_record = None
@@ -212,16 +351,14 @@ def insertCanary():
     try:
         logger.info('Inserting canary.')
         db_client = get_db_client()
-        watched_db = os.environ['WATCHED_DB_NAME']
+        (watched_db, watched_collection) = namespace
 
-        if "WATCHED_COLLECTION_NAME" in os.environ:
-            watched_collection = os.environ['WATCHED_COLLECTION_NAME']
-        else:
-            watched_collection = 'canary-collection'
+        if watched_collection is None:
+            watched_collection = CANARY_COLLECTION_NAME
 
         collection_client = db_client[watched_db][watched_collection]
 
-        canary_record = collection_client.insert_one({"op_canary": "canary"})
+        canary_record = collection_client.insert_one({"_id": canary_id or ObjectId(), "op_canary": "canary"})
         logger.info('Canary inserted.')
 
     except Exception as ex:
@@ -232,21 +369,19 @@ def insertCanary():
     return canary_record
 
 
-def deleteCanary():
-    """Deletes a canary event for change stream activation"""
+def deleteCanary(namespace, canary_id):
+    """Deletes the canary inserted with canary_id, leaving the canaries of concurrent runs to their own delete"""
 
     try:
         logger.info('Deleting canary.')
         db_client = get_db_client()
-        watched_db = os.environ['WATCHED_DB_NAME']
+        (watched_db, watched_collection) = namespace
 
-        if "WATCHED_COLLECTION_NAME" in os.environ:
-            watched_collection = os.environ['WATCHED_COLLECTION_NAME']
-        else:
-            watched_collection = 'canary-collection'
+        if watched_collection is None:
+            watched_collection = CANARY_COLLECTION_NAME
 
         collection_client = db_client[watched_db][watched_collection]
-        collection_client.delete_one({"op_canary": "canary"})
+        collection_client.delete_one({"_id": canary_id})
         logger.info('Canary deleted.')
 
     except Exception as ex:
@@ -255,18 +390,17 @@ def deleteCanary():
         raise
 
 
+def get_sqs_client():
+    """Return an SQS client"""
+    return aws_clients.get_client('sqs')
+
+
 def publish_sqs_event(pkey, message, order):
     """send change event to SQS minus the fullDocument"""
-    # Use a global variable so Lambda can reuse the persisted client on future invocations
-    global sqs_client
-
-    if sqs_client is None:
-        logger.info('Creating new SQS client.')
-        sqs_client = boto3.client('sqs')
 
     try:
-        logger.info('Publishing message to SQS.')
-        response = sqs_client.send_message(
+        logger.debug('Publishing message to SQS.')
+        response = get_sqs_client().send_message(
             QueueUrl=os.environ['SQS_QUERY_URL'],
             MessageBody=message,
             MessageDeduplicationId=pkey,
@@ -278,19 +412,134 @@ def publish_sqs_event(pkey, message, order):
         raise
 
 
+def get_message_group_id(change_event):
+    """Return the FIFO message group of a change event, db-coll or db-coll-<partition> with MESSAGE_GROUP_PARTITIONS."""
+    order = str(change_event['ns']['db']) + '-' + str(change_event['ns'].get('coll'))
+
+    partitions = int(os.environ.get('MESSAGE_GROUP_PARTITIONS', 1))
+    if partitions > 1 and 'documentKey' in change_event:
+        # crc32 rather than hash(), the partition of a document must not change between processes
+        partition = zlib.crc32(codec.dumps(change_event['documentKey']).encode('utf-8')) % partitions
+        order += '-' + str(partition)
+
+    return order
+
+
+def get_message_deduplication_id(change_event):
+    """Return the MessageDeduplicationId of a change event, its resume token.
+
+    Every change has its own token, so only re-sends of the same change are dropped by SQS, not later changes of the same document.
+    """
+    token = change_event['_id']['_data']
+    if len(token) > SQS_DEDUPLICATION_ID_MAX_LENGTH:
+        token = hashlib.sha256(token.encode('utf-8')).hexdigest()
+
+    return token
+
+
+class SqsBatchPublisher:
+    """Buffer change events and send them to SQS with SendMessageBatch, within the 10 entry and 256 KB limits.
+
+    Buffered events are only guaranteed to be in SQS after flush() returns, so flush() must be called
+    before the resume token covering them is stored. Standard queues, whose URL does not end in .fifo, take
+    neither a MessageDeduplicationId nor a MessageGroupId.
+    """
+
+    def __init__(self, queue_url):
+        self.queue_url = queue_url
+        self.fifo = queue_url.endswith('.fifo')
+        self.entries = []
+        self.batch_bytes = 0
+        self.next_entry_id = 0
+        self.api_calls = 0
+        self.messages_sent = 0
+
+    def publish(self, pkey, message, order):
+        """add a change event to the buffer, sending the buffered batch first if the event does not fit in it"""
+        message_bytes = len(message.encode('utf-8'))
+
+        if self.entries and (len(self.entries) >= SQS_BATCH_MAX_ENTRIES or self.batch_bytes + message_bytes > SQS_BATCH_MAX_BYTES):
+            self.flush()
+
+        entry = {
+            'Id': str(self.next_entry_id),
+            'MessageBody': message
+        }
+        if self.fifo:
+            entry.update({'MessageDeduplicationId': pkey, 'MessageGroupId': order})
+        self.entries.append(entry)
+        self.next_entry_id += 1
+        self.batch_bytes += message_bytes
+
+        if len(self.entries) >= SQS_BATCH_MAX_ENTRIES:
+            self.flush()
+
+    def flush(self):
+        """send the buffered events, re-sending only the entries SQS reports as failed"""
+        entries = self.entries
+        self.entries = []
+        self.batch_bytes = 0
+
+        attempt = 0
+        while entries:
+            try:
+                logger.debug('Publishing batch of %d messages to SQS.', len(entries))
+                with metrics.timer('SqsSend'):
+                    response = get_sqs_client().send_message_batch(
+                        QueueUrl=self.queue_url,
+                        Entries=entries
+                    )
+                self.api_calls += 1
+            except Exception as ex:
+                logger.error('Exception in publishing message batch to SQS: {}'.format(ex))
+                # send_sns_alert(str(ex))
+                raise
+
+            failed = response.get('Failed', [])
+            self.messages_sent += len(entries) - len(failed)
+
+            if not failed:
+                break
+
+            attempt += 1
+            sender_faults = [f for f in failed if f.get('SenderFault')]
+            if sender_faults or attempt > SQS_BATCH_MAX_RETRIES:
+                logger.error('Failed to publish {} messages to SQS: {}'.format(len(failed), failed))
+                raise Exception('Failed to publish {} messages to SQS'.format(len(failed)))
+
+            logger.warning('Retrying {} messages SQS failed to accept.'.format(len(failed)))
+            metrics.add('SqsRetries', len(failed))
+            failed_ids = set(f['Id'] for f in failed)
+            entries = [entry for entry in entries if entry['Id'] in failed_ids]
+            time.sleep(0.1 * (2 ** (attempt - 1)))
+
+
+def get_s3_client():
+    """Return an S3 client"""
+    return aws_clients.get_client('s3')
+
+
+def get_s3_upload_executor():
+    """Return the worker pool used to upload S3 objects"""
+    # Use a global variable so Lambda can reuse the worker threads on future invocations
+    global s3_upload_executor
+
+    if s3_upload_executor is None:
+        max_workers = int(os.environ.get('S3_UPLOAD_CONCURRENCY', DEFAULT_S3_UPLOAD_CONCURRENCY))
+        logger.info('Creating S3 upload worker pool with {} workers.'.format(max_workers))
+        s3_upload_executor = ThreadPoolExecutor(max_workers=max_workers)
+
+    return s3_upload_executor
+
+
 def put_s3_event(event, database, collection, doc_id):
     """send full change event to S3"""
-    # Use a global variable so Lambda can reuse the persisted client on future invocations
-    global s3_client
-
-    if s3_client is None:
-        logger.info('Creating new S3 client.')
-        s3_client = boto3.client('s3')
+    s3_client = get_s3_client()
 
     try:
         if "BUCKET_NAME" in os.environ:
 
-            logger.info('Publishing message to S3.')
+            logger.debug('Publishing message to S3.')
             s3PutObjectResponse = None
             s3ObjectKey = ""
 
@@ -299,16 +548,17 @@ def put_s3_event(event, database, collection, doc_id):
             else:
                 s3ObjectKey = database + '/' + collection + '/' + datetime.datetime.now().strftime('%Y/%m/%d/') + doc_id
             
-            s3PutObjectResponse = s3_client.put_object(
-                ACL='private',
-                Body=event,
-                Bucket=os.environ['BUCKET_NAME'],
-                Key=s3ObjectKey
-            )
+            with metrics.timer('S3Put'):
+                s3PutObjectResponse = s3_client.put_object(
+                    ACL='private',
+                    Body=event,
+                    Bucket=os.environ['BUCKET_NAME'],
+                    Key=s3ObjectKey
+                )
 
             if s3PutObjectResponse["ResponseMetadata"]["HTTPStatusCode"] == 200:
 
-                logger.info('S3 PutObject Response: {}'.format(s3PutObjectResponse))
+                logger.debug('S3 PutObject Response: %s', log.Payload(s3PutObjectResponse))
 
                 s3MetadataDict = {}
                 s3MetadataDict.update({'bucketName': os.environ['BUCKET_NAME']})
@@ -317,8 +567,10 @@ def put_s3_event(event, database, collection, doc_id):
                 s3MetadataDict.update({'database': database})
                 s3MetadataDict.update({'collection': collection})
                 s3MetadataDict.update({'docId': doc_id})
+                # The object body is the OpenSearch source, ready to be passed to _bulk as-is
+                s3MetadataDict.update({'bodyFormat': 'source'})
 
-                logger.info('S3 Metadata: {}'.format(s3MetadataDict))
+                logger.debug('S3 Metadata: %s', s3MetadataDict)
                 return s3MetadataDict
             
             return None
@@ -329,138 +581,502 @@ def put_s3_event(event, database, collection, doc_id):
         raise
 
 
-def lambda_handler(event, context):
-    """Read any new events from DocumentDB and apply them to an streaming/datastore endpoint."""
+def put_s3_segment(body, database, collection):
+    """send a segment of compressed change events to S3"""
+    s3_client = get_s3_client()
+
+    try:
+        logger.debug('Publishing segment of %d bytes to S3.', len(body))
+
+        s3ObjectKey = database + '/' + collection + '/' + datetime.datetime.now().strftime('%Y/%m/%d/') + 'segments/' + uuid.uuid4().hex + '.ndjson.gz'
+        if "BUCKET_PATH" in os.environ:
+            s3ObjectKey = str(os.environ['BUCKET_PATH']) + '/' + s3ObjectKey
+
+        with metrics.timer('S3PutSegment'):
+            s3PutObjectResponse = s3_client.put_object(
+                ACL='private',
+                Body=body,
+                Bucket=os.environ['BUCKET_NAME'],
+                Key=s3ObjectKey,
+                ContentType='application/gzip'
+            )
+
+        if s3PutObjectResponse["ResponseMetadata"]["HTTPStatusCode"] == 200:
+            return {
+                'bucketName': os.environ['BUCKET_NAME'],
+                's3ObjectKey': s3ObjectKey,
+                's3ObjectVersionId': s3PutObjectResponse['VersionId']
+            }
+
+        return None
+
+    except Exception as ex:
+        logger.error('Exception in publishing segment to S3: {}'.format(ex))
+        # send_sns_alert(str(ex))
+        raise
+
+
+class S3Segment:
+    """Change event documents appended to one S3 object as NDJSON, each line compressed as its own gzip member.
+
+    Concatenated gzip members are still a valid gzip file, and each event's (offset, length) points at a
+    standalone member, so the consumer can fetch any run of events with a single ranged GET.
+    """
+
+    def __init__(self, database, collection):
+        self.database = database
+        self.collection = collection
+        self.buffer = bytearray()
+        self.future = None
+
+    def append(self, document):
+        """append an encoded document, returning its (offset, length) in the segment"""
+        member = gzip.compress(document.encode('utf-8') + b'\n', mtime=0)
+        offset = len(self.buffer)
+        self.buffer += member
+        return offset, len(member)
+
+    def is_uploaded(self):
+        return self.future is not None and self.future.done()
+
+
+class S3UploadPipeline:
+    """Upload change events to S3 on a bounded worker pool while publishing their SQS messages in change stream order.
+
+    Documents up to INLINE_PAYLOAD_MAX_BYTES skip S3 and travel in the SQS message as inlineDocument. Larger
+    ones go to the current S3Segment, or to an object of their own when S3_SEGMENT_MAX_BYTES is 0.
+
+    watermark is the resume token of the newest change event whose S3 object and SQS message have both
+    been written. It only moves forward when drain() returns, so it never runs ahead of replicated data.
+    """
+
+    def __init__(self, sqs_publisher):
+        self.sqs_publisher = sqs_publisher
+        self.executor = get_s3_upload_executor()
+        self.max_in_flight = int(os.environ.get('S3_UPLOAD_CONCURRENCY', DEFAULT_S3_UPLOAD_CONCURRENCY)) * 2
+        self.inline_max_bytes = int(os.environ.get('INLINE_PAYLOAD_MAX_BYTES', DEFAULT_INLINE_PAYLOAD_MAX_BYTES))
+        self.segment_max_bytes = int(os.environ.get('S3_SEGMENT_MAX_BYTES', DEFAULT_S3_SEGMENT_MAX_BYTES))
+        self.segment = None
+        self.segment_uploads = collections.deque()
+        self.pending = collections.deque()
+        self.published_token = None
+        self.watermark = None
+        self.events_inlined = 0
+
+    def submit(self, change_event, document, doc_id):
+        """start uploading the document of a change event to S3, or queue it for inlining if it is small enough"""
+        # Encoded once, the same JSON is either uploaded to S3 or spliced into the SQS message
+        s3_payload = codec.dumps(document)
+        # The document is encoded, don't hold on to it until the event is published
+        change_event.pop("fullDocument", None)
+
+        if len(s3_payload.encode('utf-8')) <= self.inline_max_bytes:
+            self.pending.append((None, change_event, doc_id, s3_payload, None))
+
+        elif self.segment_max_bytes > 0:
+            if self.segment is None:
+                self.segment = S3Segment(str(change_event['ns']['db']), str(change_event['ns']['coll']))
+            pointer = self.segment.append(s3_payload)
+            self.pending.append((self.segment, change_event, doc_id, None, pointer))
+
+            if len(self.segment.buffer) >= self.segment_max_bytes:
+                self.seal_segment()
+
+            # Like objects of their own, at most max_in_flight sealed segments are held while they upload
+            while self.segment_uploads and (len(self.segment_uploads) >= self.max_in_flight or self.segment_uploads[0].done()):
+                self.segment_uploads.popleft().result()
+
+            # Segment events are only published once the whole segment is uploaded, at the latest on drain()
+            self.publish_completed()
+            return
+
+        else:
+            database = str(change_event['ns']['db'])
+            collection = str(change_event['ns']['coll'])
+            future = self.executor.submit(put_s3_event, s3_payload, database, collection, doc_id)
+            self.pending.append((future, change_event, doc_id, None, None))
+
+        # Wait for the oldest upload once the pool is saturated, so memory use stays bounded
+        self.publish_completed(wait=len(self.pending) >= self.max_in_flight)
+
+    def seal_segment(self):
+        """start uploading the current segment, later events go to a new one"""
+        if self.segment is not None:
+            segment = self.segment
+            self.segment = None
+            segment.future = self.executor.submit(put_s3_segment, bytes(segment.buffer), segment.database, segment.collection)
+            self.segment_uploads.append(segment.future)
+
+    def is_ready(self, upload):
+        """True once the S3 write an event waits for, if any, has completed"""
+        if upload is None:
+            return True
+        if isinstance(upload, S3Segment):
+            return upload.is_uploaded()
+        return upload.done()
+
+    def publish_completed(self, wait=False):
+        """publish the SQS messages of the oldest uploads that have completed, in change stream order"""
+        while self.pending and (wait or self.is_ready(self.pending[0][0])):
+            wait = False
+            upload, change_event, doc_id, inline_document, pointer = self.pending.popleft()
+
+            if upload is None:
+                change_event.update({"docId": doc_id})
+                message = codec.dumps_with_raw_field(change_event, "inlineDocument", inline_document)
+                self.events_inlined += 1
+                metrics.add('EventsInlined')
+            else:
+                if upload is self.segment:
+                    self.seal_segment()
+
+                s3MetadataDict = (upload.future if isinstance(upload, S3Segment) else upload).result()
+                if not s3MetadataDict:
+                    logger.error('Error in publishing message to S3')
+                    send_sns_alert('Error in publishing message to S3')
+                    raise Exception('Error in publishing message to S3 for doc_id {}'.format(doc_id))
+
+                if pointer is not None:
+                    (offset, length) = pointer
+                    s3MetadataDict = dict(s3MetadataDict)
+                    s3MetadataDict.update({'database': str(change_event['ns']['db']),
+                                           'collection': str(change_event['ns']['coll']),
+                                           'docId': doc_id, 'bodyFormat': 'source', 'contentEncoding': 'gzip',
+                                           'segmentOffset': offset, 'segmentLength': length})
+
+                change_event.update({"s3Metadata": s3MetadataDict})
+                message = codec.dumps(change_event)
+
+            logger.debug('SQS Payload: %s', log.Payload(message))
+
+            self.sqs_publisher.publish(get_message_deduplication_id(change_event), message, get_message_group_id(change_event))
+            self.published_token = change_event['_id']
+
+            if log.sampled():
+                logger.info('Processed event ID %s - doc_id %s', change_event['_id']['_data'], doc_id)
+
+    def drain(self):
+        """upload the current segment, wait for every pending upload, publish and flush its SQS message and return the new watermark"""
+        self.seal_segment()
+
+        while self.pending:
+            self.publish_completed(wait=True)
+        self.segment_uploads.clear()
+
+        self.sqs_publisher.flush()
+        self.watermark = self.published_token
+
+        return self.watermark
+
+
+def get_watcher(namespace):
+    """Return the DocumentDB collection, or database, whose change stream is replicated."""
+    db_client = get_db_client()
+    (watched_db, watched_collection) = namespace
+    if watched_collection is not None:
+        watcher = db_client[watched_db][watched_collection]
+    else:
+        watcher = db_client[watched_db]
+    logger.info('Watching collection {}'.format(watcher))
+
+    return watcher
+
+
+def use_delta_updates():
+    """True if updates are replicated as their updateDescription instead of the full document"""
+    if os.environ.get('DELTA_UPDATES', 'false').lower() != 'true':
+        return False
+
+    if not os.environ.get('SQS_QUERY_URL', '').endswith('.fifo'):
+        # Only FIFO ordering applies partial updates in order, they cannot be versioned like full documents
+        logger.warning('DELTA_UPDATES needs a FIFO queue, replicating full documents.')
+        return False
+
+    return True
+
+
+def is_lookup_miss(change_event):
+    """True for an update event without a full document, i.e. the change stream did not look it up"""
+    return change_event['operationType'] == 'update' and change_event.get('fullDocument') is None
+
+
+def is_delta(change_event):
+    """True for an update event of the DELTA_UPDATES mode, which carries its updateDescription but no full document"""
+    return is_lookup_miss(change_event) and 'updateDescription' in change_event and use_delta_updates()
+
+
+def get_change_stream_pipeline(namespace, canary_id=None, delta_updates=False):
+    """Return the aggregation pipeline DocumentDB applies to the change stream before sending events.
+
+    Canary events and any operation types or collections that are not replicated are dropped on the server,
+    and fullDocument is projected down to WATCHED_FIELDS, so they never cross the wire or reach S3/SQS.
+    canary_id lets the delete of this run's canary through, its resume token is the first one stored.
+    With delta_updates the updateDescription is kept as well, it is narrowed down to WATCHED_FIELDS by the reader.
+    """
+
+    conditions = [{'fullDocument.op_canary': {'$exists': False}}]
+
+    operation_types = get_env_list('WATCHED_OPERATION_TYPES')
+    if operation_types:
+        conditions.append({'operationType': {'$in': operation_types}})
+
+    if namespace[1] is None:
+        collection_names = get_env_list('WATCHED_COLLECTION_NAMES')
+        if collection_names:
+            conditions.append({'ns.coll': {'$in': collection_names}})
+        else:
+            conditions.append({'ns.coll': {'$ne': CANARY_COLLECTION_NAME}})
+
+    match = {'$and': conditions}
+    if canary_id is not None:
+        match = {'$or': [match, {'operationType': 'delete', 'documentKey._id': canary_id}]}
+
+    pipeline = [{'$match': match}]
+
+    fields = get_env_list('WATCHED_FIELDS')
+    if fields:
+        projection = {field: 1 for field in CHANGE_EVENT_FIELDS}
+        projection['fullDocument._id'] = 1
+        projection.update({'fullDocument.' + field: 1 for field in fields})
+        if delta_updates:
+            projection['updateDescription'] = 1
+        pipeline.append({'$project': projection})
+
+    logger.info('Change stream pipeline: {}'.format(pipeline))
+
+    return pipeline
+
+
+def process_change_event(change_event, s3_pipeline):
+    """Build the document of a change event and hand it to the S3 upload pipeline, which publishes it to SQS.
+
+    The document is the OpenSearch source as-is, its id travels separately as docId.
+    """
+
+    op_type = change_event['operationType']
+
+    if is_delta(change_event):
+        # Only the changed fields are replicated, the writer applies them to the indexed document
+        update_description = change_event.pop('updateDescription')
+        doc_id = str(change_event['documentKey']['_id'])
+        readable = datetime.datetime.fromtimestamp(
+            change_event['clusterTime'].time).isoformat()
+        doc_body = {'updatedFields': dict(update_description.get('updatedFields', {}), operation=op_type, timestamp=str(
+            change_event['clusterTime'].time), timestampReadable=str(readable)),
+            'removedFields': list(update_description.get('removedFields', []))}
+        change_event['documentFormat'] = 'delta'
+        metrics.add('EventsDelta')
+
+        if s3_pipeline is not None:
+
+            logger.debug('S3 Payload: %s', log.Payload(doc_body))
+
+            # Small deltas are inlined in the SQS message like small documents
+            s3_pipeline.submit(change_event, doc_body, doc_id)
+
+    elif op_type in ['insert', 'update', 'replace']:
+        doc_body = change_event['fullDocument']
+        doc_id = str(doc_body.pop("_id", None))
+        readable = datetime.datetime.fromtimestamp(
+            change_event['clusterTime'].time).isoformat()
+        # Uncomment the following line if you want to add operation metadata fields to the document event.
+        doc_body.update({'operation': op_type, 'timestamp': str(
+            change_event['clusterTime'].time), 'timestampReadable': str(readable)})
+        # Uncomment the following line if you want to add db and coll metadata fields to the document event.
+        # doc_body.update({'db':str(change_event['ns']['db']),'coll':str(change_event['ns']['coll'])})
+
+        # Publish event to SQS and message to S3
+        if s3_pipeline is not None:
+
+            logger.debug('S3 Payload: %s', log.Payload(doc_body))
+
+            # Any S3 upload runs on the worker pool, the SQS message is published in order once it completes
+            s3_pipeline.submit(change_event, doc_body, doc_id)
+
+    elif op_type == 'delete':
+        doc_id = str(change_event['documentKey']['_id'])
+        readable = datetime.datetime.fromtimestamp(
+            change_event['clusterTime'].time).isoformat()
+        # Uncomment the following line if you want to add operation metadata fields to the document event.
+        doc_body = {'operation': op_type, 'timestamp': str(
+            change_event['clusterTime'].time), 'timestampReadable': str(readable)}
+        # Uncomment the following line if you want to add db and coll metadata fields to the document event.
+        # doc_body.update({'db':str(change_event['ns']['db']),'coll':str(change_event['ns']['coll'])})
+
+        # Publish event to SQS and message to S3
+        if s3_pipeline is not None:
+
+            logger.debug('S3 Payload: %s', log.Payload(doc_body))
+
+            # Any S3 upload runs on the worker pool, the SQS message is published in order once it completes
+            s3_pipeline.submit(change_event, doc_body, doc_id)
+
+class ChangeEventCoalescer:
+    """Hold change events between checkpoints and keep only the last one of each document (last write wins).
+
+    Events are keyed by (ns, documentKey). A newer event replaces the held one and moves to the end, so the
+    newest event of the window is always written out last and the resume token watermark still covers the
+    whole window. A delete is simply the last event of its document, and an insert after it wins again.
+    A delta update does not replace the held event but is folded into it: applied to its full document, or
+    merged with its delta.
+    """
+
+    def __init__(self, s3_pipeline, enabled=True, max_keys=DEFAULT_COALESCE_MAX_KEYS):
+        self.s3_pipeline = s3_pipeline
+        self.enabled = enabled
+        self.max_keys = max_keys
+        self.events = collections.OrderedDict()
+        self.events_coalesced = 0
+        self.watched_fields = get_env_list('WATCHED_FIELDS')
+
+    def add(self, change_event):
+        """hold a change event, replacing any earlier event of the same document"""
+        if is_delta(change_event):
+            change_event['updateDescription'] = delta.project_update(change_event['updateDescription'], self.watched_fields)
+        elif is_lookup_miss(change_event):
+            # The updateLookup found no document, it was deleted since and its delete event follows
+            metrics.add('EventsSkipped')
+            return
+
+        if not self.enabled:
+            process_change_event(change_event, self.s3_pipeline)
+            return
+
+        if 'documentKey' in change_event and change_event['operationType'] in DOCUMENT_OPERATION_TYPES:
+            key = (change_event['ns']['db'], change_event['ns'].get('coll'), codec.dumps(change_event['documentKey']))
+        else:
+            # Events without a document, e.g. drop or invalidate, are never coalesced, nor do they replace a held change
+            key = codec.dumps(change_event['_id'])
+
+        held_event = self.events.pop(key, None)
+        if held_event is not None:
+            self.events_coalesced += 1
+            metrics.add('EventsCoalesced')
+            if is_delta(change_event):
+                self.fold(held_event, change_event)
+        self.events[key] = change_event
+
+        if len(self.events) >= self.max_keys:
+            self.flush()
+
+    def fold(self, held_event, change_event):
+        """fold the changes of a held event into the delta update replacing it"""
+        if is_delta(held_event):
+            change_event['updateDescription'] = delta.merge_updates(held_event['updateDescription'], change_event['updateDescription'])
+        elif held_event.get('fullDocument') is not None:
+            # The document is known in full, so the update is replicated as the full document
+            delta.apply_update(held_event['fullDocument'], change_event.pop('updateDescription'))
+            change_event['fullDocument'] = held_event['fullDocument']
+
+    def flush(self):
+        """hand the surviving events to the S3 upload pipeline in order of their last change"""
+        events = self.events
+        self.events = collections.OrderedDict()
+
+        for change_event in events.values():
+            process_change_event(change_event, self.s3_pipeline)
+
+
+def get_namespace_executor():
+    """Return the worker pool on which watched namespaces are processed"""
+    # Use a global variable so Lambda can reuse the worker threads on future invocations
+    global namespace_executor
+
+    if namespace_executor is None:
+        max_workers = int(os.environ.get('NAMESPACE_CONCURRENCY', DEFAULT_NAMESPACE_CONCURRENCY))
+        logger.info('Creating namespace worker pool with {} workers.'.format(max_workers))
+        namespace_executor = ThreadPoolExecutor(max_workers=max_workers)
+
+    return namespace_executor
+
+
+def replicate_namespace(namespace, documents_per_run, time_budget):
+    """Replicate up to documents_per_run new events of one namespace from its last resume token, while time_budget lasts.
+
+    Returns (events_processed, events_coalesced, canary_applied).
+    """
 
     events_processed = 0
     canary_record = None
-    watcher = None
+    sqs_publisher = None
+    s3_pipeline = None
 
     try:
+        # The backfill stores the resume token to tail from once it has loaded the existing documents
+        if is_backfill_in_progress(namespace):
+            logger.info('Backfill of {} in progress, not tailing it yet.'.format(get_namespace_name(namespace)))
+            return (0, 0, False)
+
         # DocumentDB watched collection set up
-        db_client = get_db_client()
-        watched_db = os.environ['WATCHED_DB_NAME']
-        if "WATCHED_COLLECTION_NAME" in os.environ:
-            watched_collection = os.environ['WATCHED_COLLECTION_NAME']
-            watcher = db_client[watched_db][watched_collection]
-        else:
-            watcher = db_client[watched_db]
-        logger.info('Watching collection {}'.format(watcher))
+        watcher = get_watcher(namespace)
 
         # DocumentDB sync set up
-        state_sync_count = int(os.environ['Iterations_per_sync'])
-        last_processed_id = get_last_processed_id()
-        logger.info("last_processed_id: {}".format(last_processed_id))
-
-        with watcher.watch(full_document='updateLookup', resume_after=last_processed_id) as change_stream:
+        last_processed_id = get_last_processed_id(namespace)
+        logger.info("last_processed_id of {}: {}".format(get_namespace_name(namespace), last_processed_id))
+
+        if "SQS_QUERY_URL" in os.environ:
+            sqs_publisher = SqsBatchPublisher(os.environ['SQS_QUERY_URL'])
+            if "BUCKET_NAME" in os.environ:
+                s3_pipeline = S3UploadPipeline(sqs_publisher)
+
+        coalescer = ChangeEventCoalescer(s3_pipeline, os.environ.get('COALESCE_EVENTS', 'true').lower() == 'true',
+                                         int(os.environ.get('COALESCE_MAX_KEYS', DEFAULT_COALESCE_MAX_KEYS)))
+        checkpointer = Checkpointer(namespace, last_processed_id, int(os.environ['Iterations_per_sync']),
+                                    int(os.environ.get('CHECKPOINT_INTERVAL_MS', DEFAULT_CHECKPOINT_INTERVAL_MS)),
+                                    s3_pipeline, sqs_publisher, coalescer)
+
+        # The first run has no resume token yet, it takes the one of its own canary delete
+        canary_id = ObjectId() if last_processed_id is None else None
+
+        # Delta updates skip the point lookup DocumentDB makes for the full document of every update
+        delta_updates = use_delta_updates()
+        with watcher.watch(pipeline=get_change_stream_pipeline(namespace, canary_id, delta_updates),
+                           full_document=None if delta_updates else 'updateLookup',
+                           resume_after=last_processed_id) as change_stream:
             i = 0
 
             if last_processed_id is None:
-                canary_record = insertCanary()
-                deleteCanary()
+                canary_record = insertCanary(namespace, canary_id)
+                deleteCanary(namespace, canary_id)
 
-            while change_stream.alive and i < int(os.environ['Documents_per_run']):
+            time_budget.restart()
+
+            while change_stream.alive and (documents_per_run <= 0 or i < documents_per_run):
+
+                if not time_budget.has_time():
+                    logger.info('Time budget of {} exhausted after {} events, {:.0f} ms left.'.format(
+                        get_namespace_name(namespace), events_processed, time_budget.remaining_ms()))
+                    metrics.add('TimeBudgetExhausted')
+                    break
 
                 i += 1
-                change_event = change_stream.try_next()
-                logger.info('Event: {}'.format(change_event))
+                with metrics.timer('ChangeStreamNext'):
+                    change_event = change_stream.try_next()
+                if log.sampled():
+                    logger.info('Event: %s', log.Payload(change_event))
 
                 if last_processed_id is None:
-                    if change_event['operationType'] == 'delete':
-                        store_last_processed_id(change_stream.resume_token)
+                    if change_event is not None and change_event['operationType'] == 'delete':
+                        checkpointer.checkpoint(change_stream)
                         last_processed_id = change_event['_id']['_data']
                     continue
 
                 if change_event is None:
                     break
                 else:
-                    op_type = change_event['operationType']
-                    op_id = change_event['_id']['_data']
-
-                    s3MetadataDict = {}
-
-                    if op_type in ['insert', 'update']:
-                        doc_body = change_event['fullDocument']
-                        doc_id = str(doc_body.pop("_id", None))
-                        readable = datetime.datetime.fromtimestamp(
-                            change_event['clusterTime'].time).isoformat()
-                        # Uncomment the following line if you want to add operation metadata fields to the document event.
-                        doc_body.update({'operation': op_type, 'timestamp': str(
-                            change_event['clusterTime'].time), 'timestampReadable': str(readable)})
-                        # Uncomment the following line if you want to add db and coll metadata fields to the document event.
-                        # doc_body.update({'db':str(change_event['ns']['db']),'coll':str(change_event['ns']['coll'])})
-                        payload = {'_id': doc_id}
-                        payload.update(doc_body)
-                            
-                        # Publish event to SQS and message to S3
-                        if "BUCKET_NAME" in os.environ and "SQS_QUERY_URL" in os.environ:
-
-                            logger.info('S3 Payload: {}'.format(payload))
-
-                            s3MetadataDict = put_s3_event(json_util.dumps(payload), str(
-                                change_event['ns']['db']), str(change_event['ns']['coll']), doc_id)
-
-                            if s3MetadataDict:
-                                order = str(
-                                change_event['ns']['db']) + '-' + str(change_event['ns']['coll'])
-                            
-                                change_event.pop("fullDocument", None)
-                                change_event.update({"s3Metadata": s3MetadataDict})
-
-                                logger.info('SQS Payload: {}'.format(change_event))
-
-                                publish_sqs_event(
-                                    str(doc_id), json_util.dumps(change_event), order)
-
-                                logger.info('Processed event ID {} - doc_id {}'.format(op_id, doc_id))
-                            
-                            else:
-                                logger.error('Error in publishing message to S3')
-                                send_sns_alert('Error in publishing message to S3')
-                                raise
-
-                    if op_type == 'delete':
-                        doc_id = str(change_event['documentKey']['_id'])
-                        readable = datetime.datetime.fromtimestamp(
-                            change_event['clusterTime'].time).isoformat()
-                        payload = {'_id': doc_id}
-                        # Uncomment the following line if you want to add operation metadata fields to the document event.
-                        payload.update({'operation': op_type, 'timestamp': str(
-                            change_event['clusterTime'].time), 'timestampReadable': str(readable)})
-                        # Uncomment the following line if you want to add db and coll metadata fields to the document event.
-                        # payload.update({'db':str(change_event['ns']['db']),'coll':str(change_event['ns']['coll'])})
-
-                        # Publish event to SQS and message to S3
-                        if "BUCKET_NAME" in os.environ and "SQS_QUERY_URL" in os.environ:
-
-                            logger.info('S3 Payload: {}'.format(payload))
-
-                            s3MetadataDict = put_s3_event(json_util.dumps(payload), str(
-                                change_event['ns']['db']), str(change_event['ns']['coll']), doc_id)
-
-                            if s3MetadataDict:
-                                order = str(
-                                    change_event['ns']['db']) + '-' + str(change_event['ns']['coll'])
-
-                                logger.info('SQS Payload: {}'.format(change_event))
-
-                                publish_sqs_event(
-                                    str(doc_id), json_util.dumps(change_event), order)
-
-                                logger.info('Processed event ID {} - doc_id {}'.format(op_id, doc_id))
-
-                            else:
-                                logger.error('Error in publishing message to S3')
-                                send_sns_alert('Error in publishing message to S3')
-                                raise
+                    metrics.record_lag(change_event['clusterTime'].time, 'ReadLag')
+                    coalescer.add(change_event)
 
                     events_processed += 1
+                    metrics.add('EventsProcessed')
 
-                    if events_processed >= state_sync_count and "BUCKET_NAME" not in os.environ:
-                        # To reduce DocumentDB IO, only persist the stream state every N events
-                        store_last_processed_id(change_stream.resume_token)
-                        logger.info('Synced token {} to state collection'.format(
-                            change_stream.resume_token))
+                    # To reduce DocumentDB IO, only persist the stream state every N events or T milliseconds
+                    checkpointer.event_processed(change_stream)
+                    # Checkpoints are part of the cost of the events they cover
+                    time_budget.record()
+
+            # Always checkpoint on a clean exit, pending uploads and buffered events are written out first
+            checkpointer.checkpoint(change_stream)
 
     except OperationFailure as of:
         send_sns_alert(str(of))
@@ -468,9 +1084,67 @@ def lambda_handler(event, context):
             # Data for the last processed ID has been deleted in the change stream,
             # Store the last known good state so our next invocation
             # starts from the most recently available data
-            store_last_processed_id(None)
+            store_last_processed_id(namespace, None)
         raise
 
+    if sqs_publisher is not None and events_processed > 0:
+        logger.info('Published {} messages of {} with {} SQS requests'.format(
+            sqs_publisher.messages_sent, get_namespace_name(namespace), sqs_publisher.api_calls))
+
+    return (events_processed, coalescer.events_coalesced, canary_record is not None)
+
+
+def lambda_handler(event, context):
+    """Read any new events from DocumentDB and apply them to an streaming/datastore endpoint."""
+
+    global namespace_offset
+
+    events_processed = 0
+    events_coalesced = 0
+    canary_applied = False
+
+    try:
+        namespaces = get_watched_namespaces()
+        documents_per_run = int(os.environ.get('Documents_per_run', 0))
+
+        # Read less while the queue backs up or OpenSearch rejects writes, see backpressure.py
+        rate_limit = backpressure.get_reader_limit(get_state_collection_client, os.environ.get('SQS_QUERY_URL'))
+        if rate_limit is not None:
+            documents_per_run = rate_limit if documents_per_run <= 0 else min(documents_per_run, rate_limit)
+
+        if len(namespaces) == 1:
+            results = [replicate_namespace(namespaces[0], documents_per_run, budget.TimeBudget(context))]
+        else:
+            # Namespaces beyond the worker pool wait for a free worker, so each one gets its share of the time
+            # of the waves they run in, and a different namespace goes first every invocation
+            waves = math.ceil(len(namespaces) / int(os.environ.get('NAMESPACE_CONCURRENCY', DEFAULT_NAMESPACE_CONCURRENCY)))
+            share_ms = budget.TimeBudget(context).remaining_ms() / waves if waves > 1 else None
+            offset = namespace_offset % len(namespaces)
+            namespace_offset += 1
+            namespaces = namespaces[offset:] + namespaces[:offset]
+
+            # Each namespace gets its own budget, so a busy one cannot hold back the others
+            futures = [get_namespace_executor().submit(replicate_namespace, namespace, documents_per_run,
+                                                       budget.TimeBudget(context, share_ms=share_ms))
+                       for namespace in namespaces]
+
+            # Let every namespace finish and checkpoint before reporting the first failure
+            results = []
+            errors = []
+            for namespace, future in zip(namespaces, futures):
+                try:
+                    results.append(future.result())
+                except Exception as ex:
+                    logger.error('Exception in namespace {}: {}'.format(get_namespace_name(namespace), ex))
+                    errors.append(ex)
+            if errors:
+                raise errors[0]
+
+        for (namespace_events_processed, namespace_events_coalesced, namespace_canary_applied) in results:
+            events_processed += namespace_events_processed
+            events_coalesced += namespace_events_coalesced
+            canary_applied = canary_applied or namespace_canary_applied
+
     except Exception as ex:
         logger.error('Exception: {}'.format(ex))
         # send_sns_alert(str(ex))
@@ -479,17 +1153,14 @@ def lambda_handler(event, context):
     else:
 
         if events_processed > 0:
-
-            store_last_processed_id(change_stream.resume_token)
-            logger.info('Synced token {} to state collection'.format(
-                change_stream.resume_token))
             return {
                 'statusCode': 200,
                 'description': 'Success',
-                'detail': json.dumps(str(events_processed) + ' records processed successfully.')
+                'detail': json.dumps(str(events_processed) + ' records processed successfully.'),
+                'eventsCoalesced': events_coalesced
             }
         else:
-            if canary_record is not None:
+            if canary_applied:
                 return {
                     'statusCode': 202,
                     'description': 'Success',
@@ -503,4 +1174,6 @@ def lambda_handler(event, context):
                 }
 
     finally:
+        metrics.flush()
         logger.info("Processing Complete!")
+        log.end_invocation()
@@ -0,0 +1,165 @@
+#!/bin/env python
+
+import os
+import signal
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pymongo.errors import OperationFailure
+
+import lambda_function
+import log
+import metrics
+
+"""
+Long-running change stream tailer. Keeps a single DocumentDB change stream open and replicates its events
+to S3/SQS with the same pipeline as the DocumentDB reader Lambda function, instead of reconnecting on every
+trigger_lambda invocation. Meant to run as a long-lived process, e.g. a container, and stops cleanly on SIGTERM.
+
+Uses the same environment variables as docdb_sqs_writer_lambda/lambda_function.py, plus:
+TAILER_MAX_AWAIT_TIME_MS (optional): How long each getMore waits for new events on the server. Defaults to 1000.
+TAILER_METRICS_INTERVAL_SECONDS (optional): How often the collected metrics are written as an EMF line. Defaults to 60.
+
+The resume token is checkpointed every Iterations_per_sync events or CHECKPOINT_INTERVAL_MS, and on shutdown.
+An idle stream also stores its postBatchResumeToken every CHECKPOINT_INTERVAL_MS, so a tailer that started without
+a token, or watches a quiet collection, resumes from where it was rather than from the time of the restart.
+Whenever the stream runs idle, coalesced events, the current S3 segment and buffered SQS messages are written out
+right away, so replication latency does not wait for the next checkpoint.
+With WATCHED_NAMESPACES, every namespace is tailed on its own thread with its own change stream and resume token.
+A namespace that backfill.py is loading is only tailed once the backfill has stored its resume token.
+"""
+
+logger = log.setup()
+
+DEFAULT_MAX_AWAIT_TIME_MS = 1000
+DEFAULT_METRICS_INTERVAL_SECONDS = 60
+# How often a namespace being backfilled is checked again
+BACKFILL_POLL_SECONDS = 30
+
+stop_requested = False
+
+
+def handle_sigterm(signum, frame):
+    """Ask the tail loop to stop after the current event"""
+    global stop_requested
+
+    logger.info('Received signal {}, stopping after the current event.'.format(signum))
+    stop_requested = True
+
+
+def tail(namespace):
+    """Replicate change events of a namespace until SIGTERM, checkpointing every Iterations_per_sync events or CHECKPOINT_INTERVAL_MS."""
+    global stop_requested
+
+    events_processed = 0
+    sqs_publisher = None
+    s3_pipeline = None
+    coalescer = None
+
+    max_await_time_ms = int(os.environ.get('TAILER_MAX_AWAIT_TIME_MS', DEFAULT_MAX_AWAIT_TIME_MS))
+    metrics_interval = int(os.environ.get('TAILER_METRICS_INTERVAL_SECONDS', DEFAULT_METRICS_INTERVAL_SECONDS))
+    last_metrics_flush = time.monotonic()
+
+    try:
+        if lambda_function.is_backfill_in_progress(namespace):
+            logger.info('Backfill of {} in progress, waiting for it.'.format(lambda_function.get_namespace_name(namespace)))
+            while not stop_requested and lambda_function.is_backfill_in_progress(namespace):
+                time.sleep(BACKFILL_POLL_SECONDS)
+            if stop_requested:
+                return
+
+        watcher = lambda_function.get_watcher(namespace)
+
+        last_processed_id = lambda_function.get_last_processed_id(namespace)
+        logger.info("last_processed_id of {}: {}".format(lambda_function.get_namespace_name(namespace), last_processed_id))
+
+        if "SQS_QUERY_URL" in os.environ:
+            sqs_publisher = lambda_function.SqsBatchPublisher(os.environ['SQS_QUERY_URL'])
+            if "BUCKET_NAME" in os.environ:
+                s3_pipeline = lambda_function.S3UploadPipeline(sqs_publisher)
+
+        coalescer = lambda_function.ChangeEventCoalescer(
+            s3_pipeline, os.environ.get('COALESCE_EVENTS', 'true').lower() == 'true',
+            int(os.environ.get('COALESCE_MAX_KEYS', lambda_function.DEFAULT_COALESCE_MAX_KEYS)))
+        checkpointer = lambda_function.Checkpointer(
+            namespace, last_processed_id, int(os.environ['Iterations_per_sync']),
+            int(os.environ.get('CHECKPOINT_INTERVAL_MS', lambda_function.DEFAULT_CHECKPOINT_INTERVAL_MS)),
+            s3_pipeline, sqs_publisher, coalescer)
+
+        # Without a stored token the stream simply starts from now, the open stream keeps its position between checkpoints
+        delta_updates = lambda_function.use_delta_updates()
+        with watcher.watch(pipeline=lambda_function.get_change_stream_pipeline(namespace, delta_updates=delta_updates),
+                           full_document=None if delta_updates else 'updateLookup',
+                           resume_after=last_processed_id, max_await_time_ms=max_await_time_ms) as change_stream:
+
+            while change_stream.alive and not stop_requested:
+
+                # Blocks on the server for up to max_await_time_ms when there are no new events
+                with metrics.timer('ChangeStreamNext'):
+                    change_event = change_stream.try_next()
+
+                if change_event is not None:
+                    if log.sampled():
+                        logger.info('Event: %s', log.Payload(change_event))
+                    metrics.record_lag(change_event['clusterTime'].time, 'ReadLag')
+                    coalescer.add(change_event)
+                    events_processed += 1
+                    metrics.add('EventsProcessed')
+                    checkpointer.event_processed(change_stream)
+                else:
+                    # Idle, write out the held events and buffered messages now instead of at the next checkpoint,
+                    # and checkpoint if the interval has passed
+                    coalescer.flush()
+                    if s3_pipeline is not None:
+                        s3_pipeline.seal_segment()
+                        s3_pipeline.publish_completed()
+                    if sqs_publisher is not None:
+                        sqs_publisher.flush()
+                    if checkpointer.is_due(idle=True):
+                        checkpointer.checkpoint(change_stream)
+
+                # Metrics are process wide, any tail thread may write them out
+                if time.monotonic() - last_metrics_flush >= metrics_interval:
+                    metrics.flush()
+                    # The log byte budget also applies per metrics interval
+                    log.end_invocation()
+                    last_metrics_flush = time.monotonic()
+
+            checkpointer.checkpoint(change_stream)
+
+    except OperationFailure as of:
+        lambda_function.send_sns_alert(str(of))
+        # Stop the other namespaces too, the process exits with the error
+        stop_requested = True
+        if of.code == lambda_function.TOKEN_DATA_DELETED_CODE:
+            # Data for the last processed ID has been deleted in the change stream,
+            # restart from the most recently available data
+            lambda_function.store_last_processed_id(namespace, None)
+        raise
+
+    except Exception as ex:
+        logger.error('Exception: {}'.format(ex))
+        lambda_function.send_sns_alert(str(ex))
+        stop_requested = True
+        raise
+
+    finally:
+        logger.info("Tailer of {} stopped after {} events.".format(lambda_function.get_namespace_name(namespace), events_processed))
+        if coalescer is not None:
+            logger.info("{} events coalesced.".format(coalescer.events_coalesced))
+
+
+def main():
+    signal.signal(signal.SIGTERM, handle_sigterm)
+    signal.signal(signal.SIGINT, handle_sigterm)
+
+    namespaces = lambda_function.get_watched_namespaces()
+    with ThreadPoolExecutor(max_workers=len(namespaces)) as executor:
+        futures = [executor.submit(tail, namespace) for namespace in namespaces]
+    metrics.flush()
+    log.end_invocation()
+    for future in futures:
+        future.result()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,10 +1,25 @@
 #!/bin/env python
 
+import collections
+import datetime
+import functools
+import gzip
 import json
-import logging
 import os
-import boto3
-from opensearchpy import OpenSearch, RequestsHttpConnection, AWSV4SignerAuth
+import random
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from bson import json_util
+import aws_clients
+import backpressure
+import budget
+import codec
+import delta
+import index_manager
+import log
+import metrics
 
 """
 Read data from SQS, fetch S3 document, transform and pipe it to OpenSearch. Send alerts and exceptions through SNS.
@@ -18,57 +33,139 @@ SNS_TOPIC_ARN_EVENT: The topic to send docdb events.
 Source SQS environment variables:
 SQS_QUERY_URL: The URL of the Amazon SQS queue to which a message is sent.
 
+Messages carry the document either inline as inlineDocument or as an s3Metadata pointer to a versioned S3 object.
+Pointers with segmentOffset/segmentLength address one gzip member of a segment object; all pointers of a batch
+into the same segment are served by a single ranged GET. Segments are left to the bucket lifecycle rules.
+
 Source S3 environment variables:
 BUCKET_NAME: The name of the bucket has the streamed data. 
 BUCKET_PATH (optional): The path of the bucket has the streamed data. 
 
+Consumed S3 object versions are deleted in the background with DeleteObjects:
+S3_CLEANUP_BATCH_SIZE (optional): Versions collected before a DeleteObjects call is started. Defaults to 1000.
+S3_CLEANUP_MAX_AGE_SECONDS (optional): Maximum time a consumed version waits for deletion. Defaults to 30.
+
 OpenSearch target environment variables:
 OPENSEARCH_URI: The URI of the OpenSearch domain where data should be streamed.
+
+Writes carry the change's clusterTime as an external version (version_type=external_gte), unless
+OPENSEARCH_EXTERNAL_VERSIONING (optional) is false. OpenSearch then rejects a write older than the version a
+document already has. Changes of one transaction share their clusterTime, so an equal version is accepted: the
+later of them wins within a batch, and a redelivered change rewrites the same document. The writer counts a
+rejected write as stale instead of failed, so changes can be applied in any order, e.g. from a standard SQS
+queue with any number of concurrent writers. Deletes are indexed as tombstone documents with operation delete
+rather than removed, so their version outlives the change that a late update could otherwise resurrect the
+document with.
+
+Partial updates of the reader's DELTA_UPDATES mode are folded into a full document of the same batch, or merged
+and written as a bulk update: a doc to merge when the update only sets fields, a painless script that sets and
+removes the dotted paths otherwise. The update API takes no external version, these rely on FIFO ordering. With
+DOCUMENTDB_URI and DOCUMENTDB_SECRET, an update of a document that is missing from the index is replaced with the
+document looked up from DocumentDB, projected to WATCHED_FIELDS (optional) like the reader does.
+
+Target indices are created from a template on first use, and switched to bulk ingest settings while the writer
+catches up with a backlog, see shared/index_manager.py for the INDEX_* environment variables.
+
+Each invocation writes the SQS batch with _bulk requests and returns failed messages as batchItemFailures,
+which requires ReportBatchItemFailures on the event source mapping. The records per _bulk request follow an
+AIMD limit: a request with items OpenSearch rejects with 429 halves it before they are retried.
+With STATE_DB, STATE_COLLECTION, DOCUMENTDB_URI and DOCUMENTDB_SECRET, the rejections are shared with the
+DocumentDB reader through the state collection, so it reads less while OpenSearch is overloaded, see
+shared/backpressure.py for the BACKPRESSURE_* environment variables.
+
+Bulk items that fail with 429, 5xx or a timeout are retried in the same invocation, with exponential backoff
+and full jitter, for up to BULK_MAX_RETRIES (optional, defaults to 3) rounds and as long as the time budget below
+allows. Items OpenSearch will never accept, e.g. a mapper_parsing_exception, and messages that cannot be parsed
+are dead letters. With DEAD_LETTER_BUCKET they are written to S3 and acknowledged, so they do not hold back their
+FIFO message group; without it they are returned for redelivery like any other failure. Each invocation with
+dead letters writes <DEAD_LETTER_PREFIX>data/yyyy/mm/dd/<id>.ndjson.gz with the action and source of each item,
+and <DEAD_LETTER_PREFIX>index/yyyy/mm/dd/<id>.ndjson with one small line per item. DEAD_LETTER_PREFIX (optional)
+defaults to dead-letter/, BULK_RETRY_BASE_MS (optional) to 100. See replay_dead_letters.py to write them again.
+
+The cost of a record is learned across invocations. When the remaining Lambda time, less
+TIME_BUDGET_SAFETY_MARGIN_MS (optional, defaults to 5000), cannot cover the whole batch, only the records that fit
+are written and the rest are returned as batchItemFailures, instead of the invocation timing out and SQS
+redelivering the whole batch.
+
+Stage latencies, counters and the replication lag from clusterTime to the _bulk acknowledgement are
+written once per invocation as CloudWatch EMF, see shared/metrics.py.
 """
                                        
-opensearch_client = None                # OpenSearch client - used as target
-s3_client = None                        # S3 client - used as target        
-sqs_client = None                       # SQS client - used as target                                                   
-sns_client = boto3.client('sns')        # SNS client - for exception alerting purposes
+# OpenSearch, S3, SQS and SNS clients come from the shared aws_clients registry and are reused across invocations
                                   
-logger = logging.getLogger()
-logger.setLevel(level = os.environ.get('LOGLEVEL', 'INFO').upper())
+# Structured logging with a per-invocation byte budget, see shared/log.py
+logger = log.setup()
+
+# DeleteObjects accepts at most 1000 keys per request
+S3_DELETE_OBJECTS_MAX_KEYS = 1000
+DEFAULT_S3_CLEANUP_MAX_AGE_SECONDS = 30
+# How many times a version S3 failed to delete is re-queued before it is left to the bucket lifecycle rules
+S3_CLEANUP_MAX_ATTEMPTS = 5
+DEFAULT_BULK_MAX_RETRIES = 3
+DEFAULT_BULK_RETRY_BASE_MS = 100
+BULK_RETRY_MAX_BACKOFF_MS = 5000
+DEFAULT_DEAD_LETTER_PREFIX = 'dead-letter/'
+# Changes of one transaction share a clusterTime, external_gte keeps the later of them from being rejected as stale
+VERSION_TYPE = 'external_gte'
+# Fields the DocumentDB reader adds to every document, also in the updatedFields of a partial update
+DELTA_METADATA_FIELDS = ('operation', 'timestamp', 'timestampReadable')
+
+# Applies params.unset and params.set, dotted paths of the _source, like shared/delta.py apply_update()
+DELTA_UPDATE_SCRIPT = """
+for (def path : params.unset) {
+  String[] keys = path.splitOnToken('.');
+  def parent = ctx._source;
+  for (int n = 0; n < keys.length - 1 && parent != null; n++) {
+    if (parent instanceof List) {
+      int index = Integer.parseInt(keys[n]);
+      parent = index < parent.size() ? parent.get(index) : null;
+    } else if (parent instanceof Map) {
+      parent = parent.get(keys[n]);
+    } else {
+      parent = null;
+    }
+  }
+  if (parent instanceof Map) {
+    parent.remove(keys[keys.length - 1]);
+  } else if (parent instanceof List && Integer.parseInt(keys[keys.length - 1]) < parent.size()) {
+    parent.set(Integer.parseInt(keys[keys.length - 1]), null);
+  }
+}
+for (def entry : params.set.entrySet()) {
+  String[] keys = entry.getKey().splitOnToken('.');
+  def parent = ctx._source;
+  for (int n = 0; n < keys.length; n++) {
+    boolean last = n == keys.length - 1;
+    if (parent instanceof List) {
+      int index = Integer.parseInt(keys[n]);
+      while (parent.size() <= index) { parent.add(null); }
+      if (last) {
+        parent.set(index, entry.getValue());
+      } else {
+        if (!(parent.get(index) instanceof Map || parent.get(index) instanceof List)) { parent.set(index, new HashMap()); }
+        parent = parent.get(index);
+      }
+    } else {
+      if (last) {
+        parent.put(keys[n], entry.getValue());
+      } else {
+        if (!(parent.get(keys[n]) instanceof Map || parent.get(keys[n]) instanceof List)) { parent.put(keys[n], new HashMap()); }
+        parent = parent.get(keys[n]);
+      }
+    }
+  }
+}
+"""
 
 def get_opensearch_client():
     """Return an OpenSearch client."""
-
-    global opensearch_client
-
-    # aws_region = os.environ.get('AWS_REGION_NAME')
-    # service = 'es'
-    # credentials = boto3.Session().get_credentials()
-    # auth = AWSV4SignerAuth(credentials, aws_region, service)
-    auth = (os.environ.get("OPENSEARCH_USER"), os.environ.get("OPENSEARCH_PASS")) # For testing only. Don't store credentials in code.
-
-    if opensearch_client is None:
-        try:            
-            logger.debug('Creating OpenSearch client Amazon root CA')
-            opensearch_client = OpenSearch(
-                hosts=[{'host': os.environ['OPENSEARCH_URI'], 'port': 443}],
-                # http_compress = True, # enables gzip compression for request bodies
-                http_auth = auth,
-                use_ssl=True,
-                verify_certs=True,
-                # connection_class = RequestsHttpConnection,
-                # pool_maxsize = 20,
-                ca_certs='AmazonRootCA1.pem'
-            )
-            return opensearch_client
-        except Exception as ex:
-            logger.error('Failed to create new OpenSearch client: {}'.format(ex))
-            # send_sns_alert(str(ex))
-            raise
+    return aws_clients.get_opensearch_client()
 
 def send_sns_alert(message):
     """send an SNS alert"""
     try:
         logger.debug('Sending SNS alert.')
-        response = sns_client.publish(
+        response = aws_clients.get_client('sns').publish(
             TopicArn=os.environ['SNS_TOPIC_ARN_ALERT'],
             Message=message,
             Subject='Document DB Replication Alarm',
@@ -83,7 +180,7 @@ def publish_sns_event(message):
     """send event to SNS"""
     try:
         logger.debug('Sending SNS message event.')
-        response = sns_client.publish(
+        response = aws_clients.get_client('sns').publish(
             TopicArn=os.environ['SNS_TOPIC_ARN_EVENT'],
             Message=message
         )
@@ -96,7 +193,7 @@ def get_sqs_message(event):
     """get SQS message"""
     try:
         logger.debug('Getting SQS message.')
-        sqs_client = boto3.client('sqs')
+        sqs_client = aws_clients.get_client('sqs')
         response = sqs_client.receive_message(
             QueueUrl=os.environ['SQS_QUERY_URL'],
             AttributeNames=[
@@ -118,8 +215,8 @@ def get_sqs_message(event):
 def remove_sqs_message(receipt_handle):
     """remove SQS message"""
     try:
-        logger.debug('Removing SQS message - {}'.format(receipt_handle))
-        sqs_client = boto3.client('sqs')
+        logger.debug('Removing SQS message - %s', receipt_handle)
+        sqs_client = aws_clients.get_client('sqs')
         sqs_client.delete_message(
             QueueUrl=os.environ['SQS_QUERY_URL'],
             ReceiptHandle=receipt_handle
@@ -134,14 +231,15 @@ def get_s3_object_with_version(bucket_name, bucket_path, version_id):
 
     try:
         logger.debug('Getting S3 object.')
-        s3_client = boto3.client('s3')
-        s3GetObjectResponse = s3_client.get_object(
-            Bucket=bucket_name,
-            Key=bucket_path,
-            VersionId=version_id
-        )
+        s3_client = aws_clients.get_client('s3')
+        with metrics.timer('S3Get'):
+            s3GetObjectResponse = s3_client.get_object(
+                Bucket=bucket_name,
+                Key=bucket_path,
+                VersionId=version_id
+            )
 
-        logger.info('S3 object: {}'.format(s3GetObjectResponse))
+        logger.debug('S3 object: %s', log.Payload(s3GetObjectResponse))
 
         return s3GetObjectResponse
     
@@ -155,7 +253,7 @@ def delete_s3_object_with_version(bucket_name, bucket_path, version_id):
 
     try:
         logger.debug('Deleting S3 object.')
-        s3_client = boto3.client('s3')
+        s3_client = aws_clients.get_client('s3')
         s3_client.delete_object(
             Bucket=bucket_name,
             Key=bucket_path,
@@ -166,62 +264,703 @@ def delete_s3_object_with_version(bucket_name, bucket_path, version_id):
         send_sns_alert(str(ex))
         raise
 
+def get_s3_object_range(bucket_name, bucket_path, version_id, start, end):
+    """get the bytes [start, end) of an S3 object"""
+
+    try:
+        logger.debug('Getting S3 object range.')
+        s3_client = aws_clients.get_client('s3')
+        with metrics.timer('S3GetRange'):
+            s3GetObjectResponse = s3_client.get_object(
+                Bucket=bucket_name,
+                Key=bucket_path,
+                VersionId=version_id,
+                Range='bytes={}-{}'.format(start, end - 1)
+            )
+
+        return s3GetObjectResponse["Body"].read()
+
+    except Exception as ex:
+        logger.error('Exception in getting S3 object range: {}'.format(ex))
+        # send_sns_alert(str(ex))
+        raise
+
+def fetch_segment_ranges(segment_pointers):
+    """fetch the bytes covering every (offset, length) pointer of the batch into each segment, with one ranged GET per segment"""
+
+    segment_ranges = {}
+
+    for segment, pointers in segment_pointers.items():
+        start = min(offset for (offset, length) in pointers)
+        end = max(offset + length for (offset, length) in pointers)
+        try:
+            segment_ranges[segment] = (start, get_s3_object_range(segment[0], segment[1], segment[2], start, end))
+        except Exception as ex:
+            logger.error('Failed to get segment {}: {}'.format(segment[1], ex))
+
+    return segment_ranges
+
+class S3CleanupQueue:
+    """Collect consumed S3 object versions and delete them in batches with DeleteObjects, off the ingest path.
+
+    Deletes run on a single background thread, so they overlap with the S3 GETs and _bulk request of the
+    next batches instead of blocking them. Versions S3 fails to delete are re-queued and never fail the
+    ingest batch; anything still left when the container is recycled is expired by the bucket lifecycle rules.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pending = []
+        self.oldest_pending = None
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.in_flight = None
+        self.batch_size = min(int(os.environ.get('S3_CLEANUP_BATCH_SIZE', S3_DELETE_OBJECTS_MAX_KEYS)), S3_DELETE_OBJECTS_MAX_KEYS)
+        self.max_age = float(os.environ.get('S3_CLEANUP_MAX_AGE_SECONDS', DEFAULT_S3_CLEANUP_MAX_AGE_SECONDS))
+
+    def add(self, bucket_name, key, version_id, attempt=0):
+        """queue a consumed object version for deletion"""
+        with self.lock:
+            if not self.pending:
+                self.oldest_pending = time.monotonic()
+            self.pending.append((bucket_name, key, version_id, attempt))
+
+    def maybe_flush(self):
+        """start a background delete if enough versions are queued or the oldest one has waited long enough"""
+        with self.lock:
+            if not self.pending or (self.in_flight is not None and not self.in_flight.done()):
+                return
+            if len(self.pending) < self.batch_size and time.monotonic() - self.oldest_pending < self.max_age:
+                return
+            versions = self.pending
+            self.pending = []
+            self.in_flight = self.executor.submit(self.delete_versions, versions)
+
+    def delete_versions(self, versions):
+        """delete versions with DeleteObjects, grouped by bucket in chunks of up to 1000 keys"""
+        by_bucket = {}
+        for version in versions:
+            by_bucket.setdefault(version[0], []).append(version)
+
+        for bucket_name, bucket_versions in by_bucket.items():
+            for i in range(0, len(bucket_versions), S3_DELETE_OBJECTS_MAX_KEYS):
+                chunk = bucket_versions[i:i + S3_DELETE_OBJECTS_MAX_KEYS]
+                failed = chunk
+                try:
+                    logger.debug('Deleting %d S3 object versions from %s.', len(chunk), bucket_name)
+                    with metrics.timer('S3DeleteObjects'):
+                        response = aws_clients.get_client('s3').delete_objects(
+                            Bucket=bucket_name,
+                            Delete={
+                                'Objects': [{'Key': key, 'VersionId': version_id} for (_, key, version_id, _) in chunk],
+                                'Quiet': True
+                            }
+                        )
+                    errors = set((error['Key'], error.get('VersionId')) for error in response.get('Errors', []))
+                    failed = [version for version in chunk if (version[1], version[2]) in errors]
+                except Exception as ex:
+                    logger.error('Exception in deleting S3 objects from {}: {}'.format(bucket_name, ex))
+
+                self.retry(failed)
+
+    def retry(self, versions):
+        """re-queue versions that failed to delete, giving up after S3_CLEANUP_MAX_ATTEMPTS"""
+        for (bucket_name, key, version_id, attempt) in versions:
+            if attempt + 1 >= S3_CLEANUP_MAX_ATTEMPTS:
+                logger.error('Giving up deleting S3 object {} version {}'.format(key, version_id))
+                continue
+            self.add(bucket_name, key, version_id, attempt + 1)
+
+
+s3_cleanup_queue = S3CleanupQueue()
+
+# Milliseconds of building and writing one record, kept across invocations of the container
+record_cost = budget.CostEstimate()
+
+def use_external_versioning():
+    return os.environ.get('OPENSEARCH_EXTERNAL_VERSIONING', 'true').lower() == 'true'
+
+
+def get_change_event_version(change_event_body):
+    """return the external version of a change event from its clusterTime, None for messages without one"""
+    timestamp = change_event_body.get('clusterTime', {}).get('$timestamp')
+    if timestamp is None:
+        return None
+    return codec.external_version(timestamp['t'], timestamp['i'])
+
+
+def is_newer(change_event_body, other_body):
+    """True if change_event_body supersedes other_body, by clusterTime when versioning is used and by arrival order otherwise"""
+    if use_external_versioning():
+        version = get_change_event_version(change_event_body)
+        other_version = get_change_event_version(other_body)
+        if version is not None and other_version is not None:
+            return version >= other_version
+    return True
+
+
+def is_delta(change_event_body):
+    """True for a partial update of the DocumentDB reader's DELTA_UPDATES mode, whose document is an updateDescription"""
+    return change_event_body.get('documentFormat') == 'delta'
+
+
+def supersedes(position, change_event_body, other_position, other_body):
+    """True if the record at position of the batch is a later change than the one at other_position"""
+    if position > other_position:
+        return is_newer(change_event_body, other_body)
+    return not is_newer(other_body, change_event_body)
+
+
+def get_document_key(change_event_body):
+    """return the (index, docId) a change event writes to"""
+    opensearch_index = str(change_event_body['ns']['db']) + '-' + str(change_event_body['ns']['coll'])
+
+    if 'inlineDocument' in change_event_body:
+        return opensearch_index, change_event_body.get('docId') or change_event_body['inlineDocument']['_id']
+
+    return opensearch_index, change_event_body['s3Metadata']['docId']
+
+
+def get_record_source(change_event_body, segment_ranges):
+    """return the document of a change event as JSON bytes, and the S3 metadata of the object to delete once it is written, None if there is none"""
+
+    if 'inlineDocument' in change_event_body:
+        # Small documents are embedded in the message by the DocumentDB reader, no S3 object to fetch or delete
+        opensearch_doc = change_event_body['inlineDocument']
+        # Messages from older readers still carry _id, a metadata field OpenSearch rejects in the source
+        opensearch_doc.pop('_id', None)
+        return json.dumps(opensearch_doc, separators=(',', ':')).encode('utf-8'), None
+
+    s3_metadata = change_event_body['s3Metadata']
+
+    if 'segmentOffset' in s3_metadata:
+        segment = (s3_metadata['bucketName'], s3_metadata['s3ObjectKey'], s3_metadata['s3ObjectVersionId'])
+        if segment not in segment_ranges:
+            raise Exception('Segment {} is not available'.format(s3_metadata['s3ObjectKey']))
+
+        # Segments are shared with other events and expire with the bucket lifecycle rules instead
+        (start, data) = segment_ranges[segment]
+        offset = s3_metadata['segmentOffset'] - start
+        return gzip.decompress(data[offset:offset + s3_metadata['segmentLength']]).rstrip(b'\n'), None
+
+    s3GetObjectWithVersionResponse = get_s3_object_with_version(s3_metadata['bucketName'], s3_metadata['s3ObjectKey'], s3_metadata['s3ObjectVersionId'])
+
+    if s3GetObjectWithVersionResponse is None or s3GetObjectWithVersionResponse["ResponseMetadata"]["HTTPStatusCode"] != 200:
+        raise Exception('Failed to get S3 object {}'.format(s3_metadata['s3ObjectKey']))
+
+    source = s3GetObjectWithVersionResponse["Body"].read()
+
+    if s3_metadata.get('bodyFormat') != 'source':
+        # Objects from older readers embed _id, re-encode them without it
+        opensearch_doc = json.loads(source)
+        opensearch_doc.pop('_id', None)
+        source = json.dumps(opensearch_doc, separators=(',', ':')).encode('utf-8')
+
+    return source, s3_metadata
+
+
+def get_update_source(update):
+    """return the _bulk update source of a partial update, a doc to merge where that has the same effect and DELTA_UPDATE_SCRIPT otherwise"""
+    partial_document = delta.get_partial_document(update)
+    if partial_document is not None:
+        body = {'doc': partial_document}
+    else:
+        body = {'script': {'source': DELTA_UPDATE_SCRIPT, 'lang': 'painless',
+                           'params': {'set': update.get('updatedFields', {}), 'unset': update.get('removedFields', [])}}}
+
+    return json.dumps(body, separators=(',', ':')).encode('utf-8')
+
+
+def build_bulk_request(records):
+    """build a single _bulk request from SQS records.
+
+    Returns the (action line, source) pairs and the (messageId, S3 metadata, clusterTime, index) of each bulk item
+    in request order, the messageIds that could not be staged, the dead letters of records that never can, how many
+    records were coalesced, and the DocumentDB lookups of partial updates by bulk item position.
+    """
+
+    bulk_body = []
+    bulk_items = []
+    failed_message_ids = []
+    dead_letters = []
+    events_coalesced = 0
+    lookups = {}
+
+    # Parse every record first so only the last change of each document in the batch is fetched and indexed.
+    # Without FIFO ordering the last change is the one with the newest clusterTime, not the last one received.
+    parsed_records = []
+    last_record_by_key = {}
+
+    for position, change_event in enumerate(records):
+
+        message_id = change_event['messageId']
+
+        try:
+            change_event_body = json.loads(change_event['body'])
+
+            if log.sampled():
+                logger.info('Processing change event: %s', log.Payload(change_event['body']))
+
+            document_key = get_document_key(change_event_body)
+            if not is_delta(change_event_body):
+                last_position = last_record_by_key.get(document_key)
+                if last_position is None or is_newer(change_event_body, parsed_records[last_position][1]):
+                    last_record_by_key[document_key] = position
+            parsed_records.append((message_id, change_event_body, document_key))
+
+        except Exception as ex:
+            # A message that cannot be parsed will not parse on redelivery either
+            logger.error('Exception in parsing message {}: {}'.format(message_id, ex))
+            dead_letters.append({'messageId': message_id, 'error': str(ex), 'message': change_event['body']})
+            parsed_records.append(None)
+
+    # Partial updates after the last full document are applied on top of it, or merged into a single update
+    deltas_by_key = {}
+    for position, parsed_record in enumerate(parsed_records):
+        if parsed_record is None or not is_delta(parsed_record[1]):
+            continue
+        last_position = last_record_by_key.get(parsed_record[2])
+        if last_position is None or supersedes(position, parsed_record[1], last_position, parsed_records[last_position][1]):
+            deltas_by_key.setdefault(parsed_record[2], []).append(position)
+
+    # A document is written by the bulk item of its earliest record still needed, so with FIFO ordering
+    # a failed item is redelivered together with every later change folded into it
+    item_positions = {document_key: positions[0] for document_key, positions in deltas_by_key.items()}
+    for document_key, position in last_record_by_key.items():
+        item_positions[document_key] = min(position, item_positions.get(document_key, position))
+    folded_positions = set(last_record_by_key.values()).union(*deltas_by_key.values())
+
+    # Pointers into segment objects of the surviving records, fetched once per segment for the whole batch
+    segment_pointers = {}
+    for position in folded_positions:
+        s3_metadata = parsed_records[position][1].get('s3Metadata')
+        if s3_metadata is not None and 'segmentOffset' in s3_metadata:
+            segment = (s3_metadata['bucketName'], s3_metadata['s3ObjectKey'], s3_metadata['s3ObjectVersionId'])
+            segment_pointers.setdefault(segment, []).append((s3_metadata['segmentOffset'], s3_metadata['segmentLength']))
+
+    segment_ranges = fetch_segment_ranges(segment_pointers)
+
+    for position, parsed_record in enumerate(parsed_records):
+
+        if parsed_record is None:
+            continue
+
+        message_id, change_event_body, document_key = parsed_record
+        opensearch_index, doc_id = document_key
+
+        try:
+            if item_positions[document_key] != position:
+                events_coalesced += 1
+                if position in folded_positions:
+                    # Folded into the bulk item of an earlier record, its S3 object is left to the bucket lifecycle rules
+                    continue
+                # Superseded by a later change of the same document in this batch (last write wins)
+                if 's3Metadata' in change_event_body and 'segmentOffset' not in change_event_body['s3Metadata']:
+                    s3_metadata = change_event_body['s3Metadata']
+                    s3_cleanup_queue.add(s3_metadata['bucketName'], s3_metadata['s3ObjectKey'], s3_metadata['s3ObjectVersionId'])
+                continue
+
+            base_position = last_record_by_key.get(document_key)
+            delta_positions = deltas_by_key.get(document_key, [])
+            change_positions = ([base_position] if base_position is not None else []) + delta_positions
+
+            sources = {change_position: get_record_source(parsed_records[change_position][1], segment_ranges)
+                       for change_position in change_positions}
+            s3_metadata = sources[position][1]
+            updates = [json.loads(sources[delta_position][0]) for delta_position in delta_positions]
+
+            # The newest change folded into the item decides its version
+            newest_body = parsed_records[change_positions[-1]][1]
+            version = get_change_event_version(newest_body) if use_external_versioning() else None
+            metadata = {'_index': opensearch_index, '_id': doc_id}
+
+            if base_position is not None:
+                action = 'index'
+                source = sources[base_position][0]
+                if updates:
+                    opensearch_doc = json.loads(source)
+                    for update in updates:
+                        delta.apply_update(opensearch_doc, update)
+                    source = json.dumps(opensearch_doc, separators=(',', ':')).encode('utf-8')
+                if version is not None:
+                    metadata.update({'version': version, 'version_type': VERSION_TYPE})
+
+            else:
+                # The update API takes no external version, FIFO ordering applies partial updates in order
+                action = 'update'
+                update = functools.reduce(delta.merge_updates, updates)
+                source = get_update_source(update)
+                if "DOCUMENTDB_URI" in os.environ:
+                    lookups[len(bulk_body)] = {
+                        '_index': opensearch_index, '_id': doc_id, 'version': version,
+                        'ns': newest_body['ns'], 'documentKey': newest_body['documentKey'],
+                        'metadata': {field: update['updatedFields'][field] for field in DELTA_METADATA_FIELDS if field in update['updatedFields']}}
+
+            logger.debug('OpenSearch index: %s, docId: %s, Document: %s', opensearch_index, doc_id, log.Payload(source))
+
+            # The source bytes go into the NDJSON body as-is, without being decoded
+            bulk_body.append((codec.bulk_action_line(action, metadata), source))
+            bulk_items.append((message_id, s3_metadata, newest_body.get('clusterTime', {}).get('$timestamp', {}).get('t'), opensearch_index))
+
+        except Exception as ex:
+            logger.error('Exception in staging message {}: {}'.format(message_id, ex))
+            failed_message_ids.append(message_id)
+
+    return bulk_body, bulk_items, failed_message_ids, dead_letters, events_coalesced, lookups
+
+
+def get_lookup_item(lookup):
+    """return an index bulk item with the current DocumentDB document of a partial update whose target is missing, None if DocumentDB no longer has it either"""
+    fields = [field.strip() for field in os.environ.get('WATCHED_FIELDS', '').split(',') if field.strip()]
+
+    with metrics.timer('DocumentLookup'):
+        document = aws_clients.get_documentdb_client()[str(lookup['ns']['db'])][str(lookup['ns']['coll'])].find_one(
+            json_util.loads(json.dumps(lookup['documentKey'])), {field: 1 for field in fields} or None)
+
+    if document is None:
+        return None
+
+    # Like an updateLookup, the current document with the operation metadata of the update
+    document.pop('_id', None)
+    document.update(lookup['metadata'])
+
+    metadata = {'_index': lookup['_index'], '_id': lookup['_id']}
+    if lookup['version'] is not None:
+        metadata.update({'version': lookup['version'], 'version_type': VERSION_TYPE})
+
+    return codec.bulk_action_line('index', metadata), codec.dumps(document).encode('utf-8')
+
+
+def prepare_indices(bulk_items):
+    """create the target indices of a batch on first use, and switch them to bulk settings while the batch lags far behind"""
+
+    oldest_cluster_times = {}
+    for (_, _, cluster_time, opensearch_index) in bulk_items:
+        oldest = oldest_cluster_times.get(opensearch_index)
+        if oldest is None or (cluster_time is not None and cluster_time < oldest):
+            oldest_cluster_times[opensearch_index] = cluster_time
+
+    now = time.time()
+    for opensearch_index, cluster_time in oldest_cluster_times.items():
+        try:
+            index_manager.ensure_index(opensearch_index)
+        except Exception:
+            # The _bulk request still auto-creates the index, with default settings
+            continue
+
+        if cluster_time is not None:
+            index_manager.update_bulk_mode(opensearch_index, now - cluster_time)
+
+
+def is_retryable(status):
+    """True for bulk failures that may succeed later, e.g. 429 rejections, 5xx and timeouts, False for e.g. mapper_parsing_exception"""
+    return status is None or status in (408, 429) or status >= 500
+
+
+def get_retry_backoff_ms(attempt):
+    """exponential backoff with full jitter, so retrying writers do not hit OpenSearch in lockstep"""
+    base_ms = float(os.environ.get('BULK_RETRY_BASE_MS', DEFAULT_BULK_RETRY_BASE_MS))
+    return random.uniform(0, min(base_ms * (2 ** attempt), BULK_RETRY_MAX_BACKOFF_MS))
+
+
+def send_bulk_requests(opensearch_client, bulk_body, bulk_message_ids, time_budget, lookups=None):
+    """write the bulk items in _bulk requests of up to the writer's AIMD limit, retrying while time_budget allows.
+
+    Retryable failures are sent again with backoff. A partial update of a document missing from the index is
+    replaced with the current document from DocumentDB, if lookups has an entry for its position, and sent again.
+    Returns the messageIds left for redelivery, the dead letters of items that failed permanently, and how many
+    items were sent and rejected with 429.
+    """
+
+    bulk_limit = backpressure.get_writer_limit()
+    max_retries = int(os.environ.get('BULK_MAX_RETRIES', DEFAULT_BULK_MAX_RETRIES))
+    pending = collections.deque(range(len(bulk_body)))
+    # Items at the head of pending to send one per request, to find the one failing a whole request
+    isolated = 0
+    attempt = 0
+    failed_message_ids = []
+    dead_letters = []
+    items_sent = 0
+    rejections = 0
+    lookups = lookups or {}
+
+    while pending:
+        if isolated:
+            size = 1
+            isolated -= 1
+        else:
+            size = bulk_limit.value if backpressure.is_enabled() else len(pending)
+        chunk = [pending.popleft() for _ in range(min(size, len(pending)))]
+        retry = []
+        looked_up = []
+        rejected = 0
+
+        try:
+            with metrics.timer('OpenSearchBulk'):
+                bulk_response = opensearch_client.bulk(body=codec.build_bulk_body([bulk_body[position] for position in chunk]))
+            items_sent += len(chunk)
+
+            # Each item is keyed by its action, i.e. {'index': {'status': 201, ...}}
+            for position, item in zip(chunk, bulk_response['items']):
+                result = next(iter(item.values()))
+                status = result.get('status', 500)
+                if 'error' not in result and status < 300:
+                    continue
+
+                if status == 409 and result.get('error', {}).get('type') == 'version_conflict_engine_exception':
+                    # The document already has a newer change, this one arrived late and is a no-op
+                    metrics.add('EventsStale')
+                    continue
+
+                if status == 404 and position in lookups and result.get('error', {}).get('type') == 'document_missing_exception':
+                    # e.g. the document existed before replication started, or its insert failed for good
+                    try:
+                        lookup_item = get_lookup_item(lookups[position])
+                    except Exception as ex:
+                        logger.error('Exception in looking up the document of message {}: {}'.format(bulk_message_ids[position], ex))
+                        retry.append(position)
+                        continue
+
+                    del lookups[position]
+                    metrics.add('DocumentLookups')
+                    if lookup_item is None:
+                        # Deleted from DocumentDB since, its delete event follows
+                        metrics.add('EventsStale')
+                    else:
+                        bulk_body[position] = lookup_item
+                        looked_up.append(position)
+                    continue
+
+                if status == 429:
+                    rejected += 1
+                if is_retryable(status):
+                    retry.append(position)
+                else:
+                    logger.error('Bulk item for message {} failed permanently: {}'.format(bulk_message_ids[position], result.get('error')))
+                    dead_letters.append(get_bulk_dead_letter(bulk_body[position], bulk_message_ids[position], status, result.get('error')))
+
+        except Exception as ex:
+            # Connection errors and timeouts have no status_code
+            status = getattr(ex, 'status_code', None)
+            if isinstance(status, str):
+                status = None
+            logger.error('Exception in OpenSearch bulk request: {}'.format(ex))
+            # The whole chunk is handled below, looked up documents included
+            looked_up = []
+
+            if is_retryable(status):
+                retry = chunk
+                rejected = len(chunk) if status == 429 else 0
+            elif len(chunk) > 1:
+                pending.extendleft(reversed(chunk))
+                isolated += len(chunk)
+                continue
+            else:
+                dead_letters.append(get_bulk_dead_letter(bulk_body[chunk[0]], bulk_message_ids[chunk[0]], status, str(ex)))
+
+        # Looked up documents are sent right away, they are not failures to back off from
+        pending.extendleft(reversed(looked_up))
+
+        if rejected:
+            rejections += rejected
+            bulk_limit.decrease(len(chunk))
+            metrics.add('BulkRejections', rejected)
+        elif not retry:
+            bulk_limit.increase()
+
+        if not retry:
+            continue
+
+        backoff_ms = get_retry_backoff_ms(attempt)
+        attempt += 1
+        if attempt > max_retries or time_budget.remaining_ms() < backoff_ms + time_budget.estimate.cost(len(retry)):
+            # Out of attempts or time, SQS redelivers what is left
+            failed_message_ids.extend(bulk_message_ids[position] for position in retry + list(pending))
+            if pending:
+                metrics.add('EventsDeferred', len(pending))
+            logger.warning('Leaving {} items for redelivery after {} attempts, bulk limit {}.'.format(
+                len(retry) + len(pending), attempt, bulk_limit.value))
+            break
+
+        metrics.add('BulkRetries', len(retry))
+        pending.extendleft(reversed(retry))
+        time.sleep(backoff_ms / 1000)
+
+    return failed_message_ids, dead_letters, items_sent, rejections
+
+
+def get_bulk_dead_letter(bulk_item, message_id, status, error):
+    """return the dead letter of a bulk item OpenSearch will not accept, with the action and source needed to replay it"""
+    (action_line, source) = bulk_item
+    return {'messageId': message_id, 'status': status, 'error': error,
+            'action': json.loads(action_line), 'source': source.decode('utf-8') if source is not None else None}
+
+
+def spill_dead_letters(dead_letters, records):
+    """write dead letters to DEAD_LETTER_BUCKET as one gzip NDJSON data object and an NDJSON index of it, returning False without a bucket"""
+
+    if "DEAD_LETTER_BUCKET" not in os.environ:
+        return False
+
+    group_ids = {record['messageId']: record.get('attributes', {}).get('MessageGroupId') for record in records}
+    now = datetime.datetime.now(datetime.timezone.utc)
+    prefix = os.environ.get('DEAD_LETTER_PREFIX', DEFAULT_DEAD_LETTER_PREFIX)
+    name = now.strftime('%Y/%m/%d/') + uuid.uuid4().hex
+    data_key = prefix + 'data/' + name + '.ndjson.gz'
+    index_key = prefix + 'index/' + name + '.ndjson'
+
+    data_lines = []
+    index_lines = []
+    for line, dead_letter in enumerate(dead_letters):
+        dead_letter = dict(dead_letter, messageGroupId=group_ids.get(dead_letter['messageId']), failedAt=now.isoformat())
+        data_lines.append(json.dumps(dead_letter, separators=(',', ':')))
+
+        # Small enough to list what failed and why without reading the data object
+        metadata = next(iter(dead_letter.get('action', {}).values()), {})
+        error = dead_letter.get('error')
+        if isinstance(error, dict):
+            error_type = error.get('type')
+        else:
+            error_type = 'request_error' if 'action' in dead_letter else 'parse_error'
+        index_lines.append(json.dumps({
+            'messageId': dead_letter['messageId'], 'index': metadata.get('_index'), 'docId': metadata.get('_id'),
+            'status': dead_letter.get('status'), 'errorType': error_type,
+            'dataKey': data_key, 'line': line}, separators=(',', ':')))
+
+    s3_client = aws_clients.get_client('s3')
+    bucket_name = os.environ['DEAD_LETTER_BUCKET']
+    with metrics.timer('S3PutDeadLetters'):
+        # The data object goes first, an index entry never points at a missing object
+        s3_client.put_object(Bucket=bucket_name, Key=data_key, Body=gzip.compress(('\n'.join(data_lines) + '\n').encode('utf-8')),
+                             ContentType='application/x-ndjson', ContentEncoding='gzip')
+        s3_client.put_object(Bucket=bucket_name, Key=index_key, Body=('\n'.join(index_lines) + '\n').encode('utf-8'),
+                             ContentType='application/x-ndjson')
+
+    logger.warning('Spilled {} dead letters to s3://{}/{}'.format(len(dead_letters), bucket_name, data_key))
+    return True
+
+
+def get_state_collection_client():
+    """return the DocumentDB state collection the rate controller shares with the reader, None if it is not configured"""
+    if "STATE_DB" not in os.environ or "STATE_COLLECTION" not in os.environ:
+        return None
+    return aws_clients.get_documentdb_client()[os.environ['STATE_DB']][os.environ['STATE_COLLECTION']]
+
+
+def get_fifo_ordered_failures(records, failed_message_ids):
+    """extend failures to every later record of the same FIFO message group so a redelivered record is never overtaken by a newer one"""
+
+    failed_message_ids = set(failed_message_ids)
+    failed_groups = set()
+    ordered_failures = []
+
+    for change_event in records:
+        message_id = change_event['messageId']
+        message_group_id = change_event.get('attributes', {}).get('MessageGroupId')
+
+        if message_id in failed_message_ids or (message_group_id is not None and message_group_id in failed_groups):
+            ordered_failures.append(message_id)
+            if message_group_id is not None:
+                failed_groups.add(message_group_id)
+
+    return ordered_failures
+
+
 def lambda_handler(event, context):
-    """Read any new events from DocumentDB and apply them to an streaming/datastore endpoint."""
-    
+    """Read a batch of change events from SQS and apply them to OpenSearch with _bulk requests, reporting per-message failures."""
+
     events_processed = 0
+    events_coalesced = 0
+    failed_message_ids = []
 
-    logger.debug('Received event: {}'.format(json.dumps(event)))
+    logger.debug('Received event: %s', log.Payload(event))
 
     try:
 
-        for change_event in event["Records"]:
+        # Versions consumed by earlier invocations are deleted in the background while this batch is ingested
+        s3_cleanup_queue.maybe_flush()
 
-            logger.debug('Processing change event: {}'.format(json.dumps(change_event)))
+        records = event["Records"]
+        deferred_message_ids = []
 
-            change_event_body = json.loads(change_event['body'])
+        # Redeliveries of messages that failed in an earlier invocation
+        metrics.add('EventsRetried', sum(1 for record in records
+                                         if int(record.get('attributes', {}).get('ApproximateReceiveCount', 1)) > 1))
+
+        # OpenSearch target index set up
+        if "OPENSEARCH_URI" in os.environ:
 
-            logger.debug('change_event_body: {}'.format(change_event_body))            
+            time_budget = budget.TimeBudget(context, record_cost)
+            affordable = time_budget.affordable_units(len(records))
+            if affordable < len(records):
+                # Only a prefix is written, so the records left for redelivery never overtake a written one
+                deferred_message_ids = [record['messageId'] for record in records[affordable:]]
+                logger.warning('Deferring {} of {} records, {:.0f} ms left.'.format(
+                    len(deferred_message_ids), len(records), time_budget.remaining_ms()))
+                metrics.add('EventsDeferred', len(deferred_message_ids))
 
-            # OpenSearch target index set up
-            if "OPENSEARCH_URI" in os.environ:
-                    
-                s3GetObjectWithVersionResponse = get_s3_object_with_version(change_event_body['s3Metadata']['bucketName'], change_event_body['s3Metadata']['s3ObjectKey'],change_event_body['s3Metadata']['s3ObjectVersionId'])
+            with metrics.timer('BuildBulkRequest'):
+                bulk_body, bulk_items, failed_message_ids, dead_letters, events_coalesced, lookups = build_bulk_request(records[:affordable])
 
-                logger.info('S3 Get Object Response: {}'.format(s3GetObjectWithVersionResponse))
+            if bulk_body:
 
-                if s3GetObjectWithVersionResponse is not None and s3GetObjectWithVersionResponse["ResponseMetadata"]["HTTPStatusCode"] == 200:
+                opensearch_client = get_opensearch_client()
 
-                    opensearch_client = get_opensearch_client()
+                logger.debug('OpenSearch client set up.')
 
-                    logger.debug('OpenSearch client set up.')
-                    logger.debug('OpenSearch client directory: {}'.format(dir(opensearch_client)))
+                with metrics.timer('PrepareIndices'):
+                    prepare_indices(bulk_items)
 
-                    opensearch_index = str(change_event_body['ns']['db']) + '-' + str(change_event_body['ns']['coll'])
-                    opensearch_doc = json.dumps(s3GetObjectWithVersionResponse["Body"].read().decode("utf-8"))
+                bulk_message_ids = [message_id for (message_id, _, _, _) in bulk_items]
 
-                    logger.debug('OpenSearch index: {}, docId: {}, Document: {}'.format(opensearch_index, change_event_body['s3Metadata']['docId'], opensearch_doc))
+                bulk_failed_message_ids, bulk_dead_letters, bulk_items_sent, bulk_rejections = send_bulk_requests(
+                    opensearch_client, bulk_body, bulk_message_ids, time_budget, lookups)
+                backpressure.record_bulk_outcome(get_state_collection_client, bulk_items_sent, bulk_rejections)
 
-                    # logger.debug('Indexing document: {} with docId: {}'.format(opensearch_client.index(
-                    #     index=opensearch_index,
-                    #     id=change_event_body['s3Metadata']['docId'],
-                    #     body=opensearch_doc
-                    # ), change_event_body['s3Metadata']['docId']))     
-                    opensearch_client.index(
-                        index=opensearch_index,
-                        id=change_event_body['s3Metadata']['docId'],
-                        body=opensearch_doc
-                    )               
+                failed_message_ids.extend(bulk_failed_message_ids)
+                dead_letters.extend(bulk_dead_letters)
+                # Dead-lettered items keep their S3 objects until the bucket lifecycle rules expire them
+                unprocessed_message_ids = set(bulk_failed_message_ids) | set(dead_letter['messageId'] for dead_letter in bulk_dead_letters)
 
-                    logger.debug('Processed change event ID {}'.format(change_event_body['s3Metadata']['docId']))
+                for (message_id, s3_metadata, cluster_time, opensearch_index) in bulk_items:
+                    if message_id in unprocessed_message_ids:
+                        continue
 
-                    # Delete received SQS Message
-                    remove_sqs_message(change_event['receiptHandle'])
+                    logger.debug('Processed change event message %s', message_id)
+                    events_processed += 1
 
-                    # Delete ingested S3 Object from versioned S3 bucket
-                    delete_s3_object_with_version(change_event_body['s3Metadata']['bucketName'], change_event_body['s3Metadata']['s3ObjectKey'],change_event_body['s3Metadata']['s3ObjectVersionId'])
+                    # Replication lag, from the change on DocumentDB until OpenSearch acknowledged it
+                    if cluster_time is not None:
+                        metrics.record_lag(cluster_time)
 
-        events_processed += 1
+                    if s3_metadata is None:
+                        continue
+
+                    # Ingested S3 Object versions are deleted in batches, off the critical path
+                    s3_cleanup_queue.add(s3_metadata['bucketName'], s3_metadata['s3ObjectKey'], s3_metadata['s3ObjectVersionId'])
+
+                for opensearch_index in set(opensearch_index for (_, _, _, opensearch_index) in bulk_items):
+                    index_manager.maybe_rollover(opensearch_index)
+
+            if dead_letters:
+                try:
+                    spilled = spill_dead_letters(dead_letters, records)
+                except Exception as ex:
+                    logger.error('Exception in spilling dead letters: {}'.format(ex))
+                    spilled = False
+
+                if spilled:
+                    # Acknowledged, so a poison message no longer holds back the rest of its FIFO message group
+                    metrics.add('EventsDeadLettered', len(dead_letters))
+                else:
+                    failed_message_ids.extend(dead_letter['messageId'] for dead_letter in dead_letters)
+
+            time_budget.record(affordable)
+
+            failed_message_ids = get_fifo_ordered_failures(records, failed_message_ids + deferred_message_ids)
+
+        metrics.add('EventsProcessed', events_processed)
+        metrics.add('EventsCoalesced', events_coalesced)
+        metrics.add('EventsFailed', len(failed_message_ids))
 
     except Exception as ex:
         logger.error('Exception: {}'.format(ex))
@@ -229,13 +968,17 @@ def lambda_handler(event, context):
         raise
 
     else:
-        
-        if events_processed > 0:
-            return {
-                'statusCode': 200,
-                'description': 'Success',
-                'detail': json.dumps(str(events_processed)+ ' records processed successfully.')
-            }
+
+        # SQS deletes the successful messages and only redelivers the ones listed in batchItemFailures
+        return {
+            'statusCode': 200,
+            'description': 'Success' if not failed_message_ids else 'Partial Failure',
+            'detail': json.dumps(str(events_processed + events_coalesced) + ' records processed successfully, ' + str(len(failed_message_ids)) + ' records failed.'),
+            'eventsCoalesced': events_coalesced,
+            'batchItemFailures': [{'itemIdentifier': message_id} for message_id in failed_message_ids]
+        }
 
     finally:
-        logger.info("Processing Complete!")
\ No newline at end of file
+        metrics.flush()
+        logger.info("Processing Complete!")
+        log.end_invocation()
@@ -0,0 +1,104 @@
+#!/bin/env python
+
+import argparse
+import gzip
+import json
+import os
+import aws_clients
+import codec
+import log
+
+"""
+Write the dead letters of the OpenSearch writer to OpenSearch again, e.g. after fixing the mapping that rejected them.
+
+Reads the index objects under <DEAD_LETTER_PREFIX>index/ in DEAD_LETTER_BUCKET, or only those of one day with
+--date yyyy/mm/dd, and replays the bulk items of the data objects they point to with _bulk. Both objects are
+deleted once every one of their items was accepted. Messages that could not be parsed have no bulk item, they
+are listed and their objects are kept.
+
+Uses DEAD_LETTER_BUCKET, DEAD_LETTER_PREFIX (optional, defaults to dead-letter/) and the OPENSEARCH_* variables
+of shared/aws_clients.py.
+
+Usage: PYTHONPATH=../shared python3 replay_dead_letters.py [--date 2024/01/31] [--dry-run]
+"""
+
+logger = log.setup()
+
+DEFAULT_DEAD_LETTER_PREFIX = 'dead-letter/'
+
+
+def list_index_keys(bucket_name, prefix):
+    """Return the keys of the index objects under prefix."""
+    keys = []
+    for page in aws_clients.get_client('s3').get_paginator('list_objects_v2').paginate(Bucket=bucket_name, Prefix=prefix):
+        keys.extend(content['Key'] for content in page.get('Contents', []))
+    return keys
+
+
+def get_lines(bucket_name, key):
+    """Return the parsed lines of an NDJSON object, gunzipped if it is a .gz object."""
+    body = aws_clients.get_client('s3').get_object(Bucket=bucket_name, Key=key)['Body'].read()
+    if key.endswith('.gz'):
+        body = gzip.decompress(body)
+    return [json.loads(line) for line in body.splitlines() if line]
+
+
+def replay(bucket_name, index_key, dry_run):
+    """Replay the dead letters of one index object, returning how many were accepted and how many are left."""
+    data_keys = sorted(set(entry['dataKey'] for entry in get_lines(bucket_name, index_key)))
+    (accepted, left) = (0, 0)
+
+    for data_key in data_keys:
+        dead_letters = get_lines(bucket_name, data_key)
+        bulk_body = []
+        for dead_letter in dead_letters:
+            if 'action' not in dead_letter:
+                logger.warning('Message {} cannot be replayed: {}'.format(dead_letter['messageId'], dead_letter.get('error')))
+                left += 1
+                continue
+            (action, metadata) = next(iter(dead_letter['action'].items()))
+            source = dead_letter['source'].encode('utf-8') if dead_letter.get('source') is not None else None
+            bulk_body.append((codec.bulk_action_line(action, metadata), source))
+
+        if dry_run or not bulk_body:
+            logger.info('{}: {} items to replay.'.format(data_key, len(bulk_body)))
+            left += len(bulk_body)
+            continue
+
+        response = aws_clients.get_opensearch_client().bulk(body=codec.build_bulk_body(bulk_body))
+        for item in response['items']:
+            result = next(iter(item.values()))
+            if 'error' in result or result.get('status', 500) >= 300:
+                logger.error('Replay of {}/{} failed: {}'.format(result.get('_index'), result.get('_id'), result.get('error')))
+                left += 1
+            else:
+                accepted += 1
+
+    if left == 0 and not dry_run:
+        s3_client = aws_clients.get_client('s3')
+        for key in data_keys + [index_key]:
+            s3_client.delete_object(Bucket=bucket_name, Key=key)
+
+    return (accepted, left)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay the dead letters of the OpenSearch writer')
+    parser.add_argument('--date', help='only replay the dead letters of this day, yyyy/mm/dd')
+    parser.add_argument('--dry-run', action='store_true', help='list the dead letters without replaying them')
+    args = parser.parse_args()
+
+    bucket_name = os.environ['DEAD_LETTER_BUCKET']
+    prefix = os.environ.get('DEAD_LETTER_PREFIX', DEFAULT_DEAD_LETTER_PREFIX) + 'index/' + (args.date.strip('/') + '/' if args.date else '')
+
+    (accepted, left) = (0, 0)
+    for index_key in list_index_keys(bucket_name, prefix):
+        (index_accepted, index_left) = replay(bucket_name, index_key, args.dry_run)
+        accepted += index_accepted
+        left += index_left
+
+    logger.info('Replayed {} dead letters, {} left.'.format(accepted, left))
+
+
+if __name__ == '__main__':
+    main()
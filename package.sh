@@ -22,8 +22,9 @@ if [ $BUILD_DOCDBSQSWRITERLAMBDA -eq 1 ]; then
     [ -d "docdbSqsWriterLambda" ] && echo "Directory docdbSqsWriterLambda exists." && rm -rf docdbSqsWriterLambda
     python3 -m venv docdbSqsWriterLambda
     source docdbSqsWriterLambda/bin/activate
-    cp ${APP_PATH}/lambda_function.py docdbSqsWriterLambda/lib/python*/site-packages/
+    cp ${APP_PATH}/*.py docdbSqsWriterLambda/lib/python*/site-packages/
     cp ${APP_PATH}/requirements.txt docdbSqsWriterLambda/lib/python*/site-packages/
+    cp ${SCRIPT_DIR}/shared/*.py docdbSqsWriterLambda/lib/python*/site-packages/
     cp ${SCRIPT_DIR}/files/rds-combined-ca-bundle.pem docdbSqsWriterLambda/lib/python*/site-packages/
     cd docdbSqsWriterLambda/lib/python*/site-packages/
     pip3 install -r requirements.txt 
@@ -43,7 +44,9 @@ if [ $BUILD_OPENSEARCHWRITERLAMBDA -eq 1 ]; then
     source openSearchWriterLambda/bin/activate
     cp ${APP_PATH}/lambda_function.py openSearchWriterLambda/lib/python*/site-packages/
     cp ${APP_PATH}/requirements.txt openSearchWriterLambda/lib/python*/site-packages/
+    cp ${SCRIPT_DIR}/shared/*.py openSearchWriterLambda/lib/python*/site-packages/
     cp ${SCRIPT_DIR}/files/AmazonRootCA1.pem openSearchWriterLambda/lib/python*/site-packages/
+    cp ${SCRIPT_DIR}/files/rds-combined-ca-bundle.pem openSearchWriterLambda/lib/python*/site-packages/
     cd openSearchWriterLambda/lib/python*/site-packages/
     pip3 install -r requirements.txt 
     deactivate
@@ -62,6 +65,7 @@ if [ $BUILD_TRIGGERLAMBDA -eq 1 ]; then
     source triggerLambda/bin/activate
     cp ${APP_PATH}/lambda_function.py triggerLambda/lib/python*/site-packages/
     cp ${APP_PATH}/requirements.txt triggerLambda/lib/python*/site-packages/
+    cp ${SCRIPT_DIR}/shared/*.py triggerLambda/lib/python*/site-packages/
     cp ${SCRIPT_DIR}/files/AmazonRootCA1.pem triggerLambda/lib/python*/site-packages/
     cd triggerLambda/lib/python*/site-packages/
     pip3 install -r requirements.txt 
@@ -0,0 +1,164 @@
+#!/bin/env python
+
+import json
+import logging
+import os
+import threading
+import time
+import urllib.parse
+import boto3
+from botocore.config import Config
+
+"""
+Client registry shared by the Lambda functions.
+
+Clients are created lazily on first use and cached at module level, so warm invocations reuse both the
+client objects and their pooled keep-alive connections. Secrets Manager values are cached for a TTL.
+
+Optional environment variables:
+AWS_MAX_POOL_CONNECTIONS: Connection pool size of each boto3 client. Defaults to 50.
+AWS_CONNECT_TIMEOUT: boto3 connect timeout, in seconds. Defaults to 5.
+AWS_READ_TIMEOUT: boto3 read timeout, in seconds. Defaults to 60.
+SECRETS_CACHE_TTL_SECONDS: How long a Secrets Manager value is reused. Defaults to 900.
+
+OpenSearch client environment variables:
+OPENSEARCH_URI: The URI of the OpenSearch domain.
+OPENSEARCH_USER, OPENSEARCH_PASS: Basic auth credentials for the OpenSearch domain.
+OPENSEARCH_POOL_MAXSIZE (optional): Connections kept open to the OpenSearch domain. Defaults to 10.
+
+DocumentDB client environment variables:
+DOCUMENTDB_URI: The URI of the DocumentDB cluster.
+DOCUMENTDB_SECRET: Secret Name of the credentials for the DocumentDB cluster in Secrets Manager.
+"""
+
+DEFAULT_MAX_POOL_CONNECTIONS = 50
+DEFAULT_CONNECT_TIMEOUT = 5
+DEFAULT_READ_TIMEOUT = 60
+DEFAULT_SECRETS_CACHE_TTL_SECONDS = 900
+DEFAULT_OPENSEARCH_POOL_MAXSIZE = 10
+
+boto3_clients = {}                      # boto3 clients by service name
+secrets_cache = {}                      # Secrets Manager values by secret name - (value, expiry)
+opensearch_client = None                # OpenSearch client
+documentdb_client = None                # DocumentDB MongoClient
+
+# Clients are also requested from worker threads, creation goes through this lock
+clients_lock = threading.Lock()
+
+logger = logging.getLogger()
+
+
+def get_client_config():
+    """Return the botocore config shared by every boto3 client."""
+    return Config(
+        max_pool_connections=int(os.environ.get('AWS_MAX_POOL_CONNECTIONS', DEFAULT_MAX_POOL_CONNECTIONS)),
+        connect_timeout=int(os.environ.get('AWS_CONNECT_TIMEOUT', DEFAULT_CONNECT_TIMEOUT)),
+        read_timeout=int(os.environ.get('AWS_READ_TIMEOUT', DEFAULT_READ_TIMEOUT)),
+        tcp_keepalive=True,
+        retries={'max_attempts': 3, 'mode': 'standard'}
+    )
+
+
+def get_client(service_name):
+    """Return the cached boto3 client for a service, creating it on first use."""
+    client = boto3_clients.get(service_name)
+
+    if client is None:
+        with clients_lock:
+            client = boto3_clients.get(service_name)
+            if client is None:
+                logger.info('Creating new {} client.'.format(service_name))
+                client = boto3.client(service_name, config=get_client_config())
+                boto3_clients[service_name] = client
+
+    return client
+
+
+def get_secret(secret_name):
+    """Return the parsed JSON value of a Secrets Manager secret, cached for SECRETS_CACHE_TTL_SECONDS."""
+    cached = secrets_cache.get(secret_name)
+    if cached is not None and cached[1] > time.monotonic():
+        return cached[0]
+
+    try:
+        logger.info('Retrieving secret {} from Secrets Manager.'.format(secret_name))
+
+        secret_value = get_client('secretsmanager').get_secret_value(SecretId=secret_name)
+        secret_json = json.loads(secret_value['SecretString'])
+
+        ttl = int(os.environ.get('SECRETS_CACHE_TTL_SECONDS', DEFAULT_SECRETS_CACHE_TTL_SECONDS))
+        secrets_cache[secret_name] = (secret_json, time.monotonic() + ttl)
+
+        logger.info('Secret {} retrieved from Secrets Manger.'.format(secret_name))
+
+        return secret_json
+
+    except Exception as ex:
+        logger.error('Failed to retrieve secret {}: {}'.format(secret_name, ex))
+        raise
+
+
+def invalidate_secret(secret_name):
+    """Drop a cached secret, e.g. after an authentication failure following a rotation."""
+    secrets_cache.pop(secret_name, None)
+
+
+def get_opensearch_client():
+    """Return the cached OpenSearch client, with a pool of keep-alive connections to the domain."""
+    global opensearch_client
+
+    if opensearch_client is None:
+        # Only the OpenSearch writer ships opensearch-py
+        from opensearchpy import OpenSearch
+
+        # aws_region = os.environ.get('AWS_REGION_NAME')
+        # service = 'es'
+        # credentials = boto3.Session().get_credentials()
+        # auth = AWSV4SignerAuth(credentials, aws_region, service)
+        auth = (os.environ.get("OPENSEARCH_USER"), os.environ.get("OPENSEARCH_PASS")) # For testing only. Don't store credentials in code.
+
+        try:
+            logger.debug('Creating OpenSearch client Amazon root CA')
+            opensearch_client = OpenSearch(
+                hosts=[{'host': os.environ['OPENSEARCH_URI'], 'port': 443}],
+                # http_compress = True, # enables gzip compression for request bodies
+                http_auth = auth,
+                use_ssl=True,
+                verify_certs=True,
+                maxsize=int(os.environ.get('OPENSEARCH_POOL_MAXSIZE', DEFAULT_OPENSEARCH_POOL_MAXSIZE)),
+                ca_certs='AmazonRootCA1.pem'
+            )
+        except Exception as ex:
+            logger.error('Failed to create new OpenSearch client: {}'.format(ex))
+            raise
+
+    return opensearch_client
+
+
+def get_documentdb_client():
+    """Return the cached, authenticated connection to DocumentDB."""
+    global documentdb_client
+
+    if documentdb_client is None:
+        # Only the functions that talk to DocumentDB ship pymongo and the RDS CA bundle
+        from pymongo import MongoClient
+
+        logger.info('Creating new DocumentDB client.')
+
+        try:
+            cluster_uri = os.environ['DOCUMENTDB_URI']
+            secret_json = get_secret(os.environ['DOCUMENTDB_SECRET'])
+            cluster_conn_str = 'mongodb://%s:%s@%s' % (urllib.parse.quote_plus(secret_json['username']),
+                                                       urllib.parse.quote_plus(secret_json['password']), cluster_uri)
+            # MongoClient connects lazily, a client that loses the race below is simply dropped
+            client = MongoClient(cluster_conn_str, ssl=True, retryWrites=False, tlsCAFile='rds-combined-ca-bundle.pem')
+        except Exception as ex:
+            logger.error('Failed to create new DocumentDB client: {}'.format(ex))
+            raise
+
+        with clients_lock:
+            if documentdb_client is None:
+                documentdb_client = client
+                logger.info('Successfully created new DocumentDB client.')
+
+    return documentdb_client
@@ -0,0 +1,191 @@
+#!/bin/env python
+
+import datetime
+import logging
+import os
+import threading
+import time
+import aws_clients
+
+"""
+Closed-loop rate control between OpenSearch, the SQS queue and the DocumentDB reader.
+
+Both pipeline functions adjust a limit by additive increase, multiplicative decrease (AIMD):
+
+- The OpenSearch writer limits the records of one _bulk request. A request with 429 rejections halves the limit,
+  so the rejected items are retried, after a backoff, in smaller requests. Every request without rejections
+  raises the limit by one record. The bulk items and rejections are also added up
+  in the state collection, see record_bulk_outcome().
+- The DocumentDB reader limits the events of each run and namespace. It halves the limit while the SQS queue
+  holds more than BACKPRESSURE_QUEUE_DEPTH messages, or while more than BACKPRESSURE_REJECTION_RATE of the bulk
+  items written since its last check were rejected, and raises it by BACKPRESSURE_READER_STEP otherwise.
+
+The reader's limit and the writers' counters live in the state collection, next to the resume tokens, so every
+container of both functions acts on the same state. Each container looks at it at most every
+BACKPRESSURE_CHECK_INTERVAL_SECONDS and uses its last view in between.
+
+Optional environment variables:
+BACKPRESSURE_ENABLED: Set to false to turn rate control off. Defaults to true.
+BACKPRESSURE_CHECK_INTERVAL_SECONDS: How often the shared state is read and written. Defaults to 10.
+BACKPRESSURE_QUEUE_DEPTH: SQS ApproximateNumberOfMessages above which the reader backs off. Defaults to 5000.
+BACKPRESSURE_REJECTION_RATE: Share of rejected bulk items above which the reader backs off. Defaults to 0.01.
+BACKPRESSURE_READER_MIN_EVENTS: Lowest events per run and namespace. Defaults to 100.
+BACKPRESSURE_READER_MAX_EVENTS: Highest events per run and namespace. Defaults to 100000.
+BACKPRESSURE_READER_STEP: Additive increase of the events per run. Defaults to 1000.
+BACKPRESSURE_WRITER_MAX_BULK_RECORDS: Highest records per _bulk request. Defaults to 10000.
+"""
+
+DEFAULT_CHECK_INTERVAL_SECONDS = 10
+DEFAULT_QUEUE_DEPTH = 5000
+DEFAULT_REJECTION_RATE = 0.01
+DEFAULT_READER_MIN_EVENTS = 100
+DEFAULT_READER_MAX_EVENTS = 100000
+DEFAULT_READER_STEP = 1000
+DEFAULT_WRITER_MAX_BULK_RECORDS = 10000
+DECREASE_FACTOR = 0.5
+
+# State documents in the state collection, their field cannot collide with the resume token or backfill documents
+READER_STATE_FILTER = {'rateController': 'reader'}
+WRITER_STATE_FILTER = {'rateController': 'writer'}
+
+reader_limit = None                     # AimdLimit of the reader, as of the last check
+last_reader_check = float('-inf')       # time.monotonic() of the last reader check
+writer_limit = None                     # AimdLimit of the writer's _bulk requests
+pending_bulk_outcome = [0, 0]           # bulk items and rejections not yet added to the state collection
+last_writer_flush = float('-inf')       # time.monotonic() of the last record_bulk_outcome() write
+
+# Namespaces of the reader and the S3 cleanup of the writer run on worker threads
+state_lock = threading.Lock()
+
+logger = logging.getLogger()
+
+
+def is_enabled():
+    return os.environ.get('BACKPRESSURE_ENABLED', 'true').lower() == 'true'
+
+
+def get_check_interval():
+    return float(os.environ.get('BACKPRESSURE_CHECK_INTERVAL_SECONDS', DEFAULT_CHECK_INTERVAL_SECONDS))
+
+
+class AimdLimit:
+    """Limit raised by step while there is no congestion and multiplied by DECREASE_FACTOR when there is"""
+
+    def __init__(self, minimum, maximum, step, value=None):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.step = step
+        self.value = maximum if value is None else min(max(value, minimum), maximum)
+
+    def increase(self):
+        self.value = min(self.value + self.step, self.maximum)
+        return self.value
+
+    def decrease(self, used=None):
+        """cut the limit, from the amount actually used if that was below it"""
+        value = self.value if used is None else min(self.value, used)
+        self.value = max(int(value * DECREASE_FACTOR), self.minimum)
+        return self.value
+
+
+def get_queue_depth(queue_url):
+    """Return the ApproximateNumberOfMessages of an SQS queue."""
+    response = aws_clients.get_client('sqs').get_queue_attributes(QueueUrl=queue_url, AttributeNames=['ApproximateNumberOfMessages'])
+    return int(response['Attributes']['ApproximateNumberOfMessages'])
+
+
+def get_reader_limit(get_state_collection, queue_url):
+    """Return the events per run and namespace of the reader, updated from the queue depth and the bulk rejections at most every BACKPRESSURE_CHECK_INTERVAL_SECONDS.
+
+    get_state_collection returns the state collection, it is only called when the shared state is due to be read.
+    """
+    global reader_limit, last_reader_check
+
+    if not is_enabled():
+        return None
+
+    with state_lock:
+        now = time.monotonic()
+        if reader_limit is not None and now - last_reader_check < get_check_interval():
+            return reader_limit.value
+        last_reader_check = now
+
+        try:
+            state_collection = get_state_collection()
+            state = state_collection.find_one(READER_STATE_FILTER) or {}
+            writer_state = state_collection.find_one(WRITER_STATE_FILTER) or {}
+
+            reader_limit = AimdLimit(int(os.environ.get('BACKPRESSURE_READER_MIN_EVENTS', DEFAULT_READER_MIN_EVENTS)),
+                                     int(os.environ.get('BACKPRESSURE_READER_MAX_EVENTS', DEFAULT_READER_MAX_EVENTS)),
+                                     int(os.environ.get('BACKPRESSURE_READER_STEP', DEFAULT_READER_STEP)),
+                                     state.get('limit'))
+
+            # Rejection rate of the bulk items written since the last check, by any writer container
+            items = writer_state.get('bulkItems', 0) - state.get('bulkItemsSeen', 0)
+            rejections = writer_state.get('bulkRejections', 0) - state.get('bulkRejectionsSeen', 0)
+            rejection_rate = rejections / items if items > 0 else 0.0
+
+            queue_depth = get_queue_depth(queue_url) if queue_url else 0
+
+            if queue_depth > int(os.environ.get('BACKPRESSURE_QUEUE_DEPTH', DEFAULT_QUEUE_DEPTH)) or \
+                    rejection_rate > float(os.environ.get('BACKPRESSURE_REJECTION_RATE', DEFAULT_REJECTION_RATE)):
+                reader_limit.decrease()
+                logger.warning('Backing off to {} events per run, queue depth {}, bulk rejection rate {:.3f}.'.format(
+                    reader_limit.value, queue_depth, rejection_rate))
+            else:
+                reader_limit.increase()
+
+            state_collection.update_one(READER_STATE_FILTER, {'$set': {
+                'limit': reader_limit.value, 'queueDepth': queue_depth, 'rejectionRate': rejection_rate,
+                'bulkItemsSeen': writer_state.get('bulkItems', 0), 'bulkRejectionsSeen': writer_state.get('bulkRejections', 0),
+                'updatedAt': datetime.datetime.now(datetime.timezone.utc)}}, upsert=True)
+
+        except Exception as ex:
+            # Rate control must not stop replication, the last limit is kept until the next check
+            logger.error('Failed to update the reader rate limit: {}'.format(ex))
+            if reader_limit is None:
+                return None
+
+        return reader_limit.value
+
+
+def get_writer_limit():
+    """Return the AimdLimit of the records per _bulk request of this container."""
+    global writer_limit
+
+    if writer_limit is None:
+        writer_limit = AimdLimit(1, int(os.environ.get('BACKPRESSURE_WRITER_MAX_BULK_RECORDS', DEFAULT_WRITER_MAX_BULK_RECORDS)), 1)
+    return writer_limit
+
+
+def record_bulk_outcome(get_state_collection, items, rejections):
+    """Add bulk items and their 429 rejections to the shared counters, right away when there were rejections and at most every BACKPRESSURE_CHECK_INTERVAL_SECONDS otherwise.
+
+    get_state_collection returns the state collection, or None when there is none to share the counters in.
+    """
+    global last_writer_flush
+
+    if not is_enabled():
+        return
+
+    with state_lock:
+        pending_bulk_outcome[0] += items
+        pending_bulk_outcome[1] += rejections
+
+        now = time.monotonic()
+        if not pending_bulk_outcome[1] and now - last_writer_flush < get_check_interval():
+            return
+        last_writer_flush = now
+
+        (items, rejections) = pending_bulk_outcome
+        pending_bulk_outcome[0] = pending_bulk_outcome[1] = 0
+
+    try:
+        state_collection = get_state_collection()
+        if state_collection is None:
+            return
+        state_collection.update_one(WRITER_STATE_FILTER, {'$inc': {'bulkItems': items, 'bulkRejections': rejections},
+                                                          '$set': {'updatedAt': datetime.datetime.now(datetime.timezone.utc)}},
+                                    upsert=True)
+    except Exception as ex:
+        logger.error('Failed to record bulk outcome: {}'.format(ex))
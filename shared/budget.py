@@ -0,0 +1,107 @@
+#!/bin/env python
+
+import os
+import threading
+import time
+
+"""
+Time budgeting against the Lambda timeout, shared by the Lambda functions.
+
+A CostEstimate learns the cost of one unit of work, e.g. one change event or one SQS record, as an exponentially
+weighted moving average. A TimeBudget combines it with context.get_remaining_time_in_millis(), so a loop keeps
+going while the next unit still fits in front of a safety margin, which is left for flushing buffers and
+checkpointing, e.g.
+
+    time_budget = budget.TimeBudget(context)
+    while time_budget.has_time():
+        process(next_event())
+        time_budget.record()
+
+Without a Lambda context, e.g. in the tailer or the benchmarks, the budget never runs out. A budget with
+share_ms covers at most that many milliseconds from its last restart(), so work that runs in waves, e.g. more
+namespaces than worker threads, can split the invocation between the waves.
+
+Optional environment variables:
+TIME_BUDGET_SAFETY_MARGIN_MS: Time kept in reserve before the Lambda timeout. Defaults to 5000.
+"""
+
+DEFAULT_SAFETY_MARGIN_MS = 5000
+# Weight of the newest sample in the moving average
+EWMA_ALPHA = 0.2
+
+
+class CostEstimate:
+    """Moving average of the milliseconds one unit of work takes"""
+
+    def __init__(self, alpha=EWMA_ALPHA):
+        self.alpha = alpha
+        self.unit_ms = None
+        self.lock = threading.Lock()
+
+    def update(self, elapsed_ms, units=1):
+        """add a sample of units units of work taking elapsed_ms milliseconds"""
+        if units <= 0:
+            return
+
+        sample = elapsed_ms / units
+        with self.lock:
+            if self.unit_ms is None:
+                self.unit_ms = sample
+            else:
+                self.unit_ms += self.alpha * (sample - self.unit_ms)
+
+    def cost(self, units=1):
+        """return the expected milliseconds of units units of work, 0 until there is a sample"""
+        return (self.unit_ms or 0.0) * units
+
+
+class TimeBudget:
+    """Remaining time of a Lambda invocation, less a safety margin, measured in units of a CostEstimate"""
+
+    def __init__(self, context, estimate=None, safety_margin_ms=None, share_ms=None):
+        self.estimate = estimate if estimate is not None else CostEstimate()
+        if safety_margin_ms is None:
+            safety_margin_ms = int(os.environ.get('TIME_BUDGET_SAFETY_MARGIN_MS', DEFAULT_SAFETY_MARGIN_MS))
+        self.safety_margin_ms = safety_margin_ms
+
+        # Read once, the monotonic clock is cheaper than asking the context for every event
+        get_remaining_time_in_millis = getattr(context, 'get_remaining_time_in_millis', None)
+        if get_remaining_time_in_millis is not None:
+            self.context_deadline = time.monotonic() + get_remaining_time_in_millis() / 1000
+        else:
+            self.context_deadline = None
+        self.share_ms = share_ms
+
+        self.restart()
+
+    def remaining_ms(self):
+        """milliseconds left before the safety margin, unlimited without a Lambda context"""
+        if self.deadline is None:
+            return float('inf')
+        return (self.deadline - time.monotonic()) * 1000 - self.safety_margin_ms
+
+    def has_time(self, units=1):
+        """True while units more units of work are expected to finish before the safety margin"""
+        return self.remaining_ms() >= self.estimate.cost(units)
+
+    def affordable_units(self, units):
+        """return how many of units units of work are expected to finish before the safety margin"""
+        remaining_ms = self.remaining_ms()
+        if remaining_ms >= self.estimate.cost(units):
+            return units
+        if remaining_ms <= 0:
+            return 0
+        return min(units, int(remaining_ms / self.estimate.cost(1)))
+
+    def record(self, units=1):
+        """add the time since the last record() or restart(), spent on units units of work, to the estimate"""
+        now = time.monotonic()
+        self.estimate.update((now - self.mark) * 1000, units)
+        self.mark = now
+
+    def restart(self):
+        """start measuring the next units of work from now, e.g. after time that is not part of their cost, and start the share_ms"""
+        self.mark = time.monotonic()
+        self.deadline = self.context_deadline
+        if self.share_ms is not None and self.deadline is not None:
+            self.deadline = min(self.deadline, self.mark + (self.share_ms + self.safety_margin_ms) / 1000)
@@ -0,0 +1,75 @@
+#!/bin/env python
+
+import json
+from bson import json_util
+from bson.decimal128 import Decimal128
+from bson.objectid import ObjectId
+from bson.timestamp import Timestamp
+
+"""
+Serialization helpers shared by the DocumentDB reader and the OpenSearch writer.
+
+dumps() produces the same relaxed Extended JSON as bson.json_util.dumps, minus the whitespace, but lets the
+C accelerated json encoder walk the document and only calls back into Python for BSON specific values,
+instead of first rebuilding the whole document with json_util's pure Python converter. The encoder never calls
+back for floats, so documents with NaN or Infinity are encoded by json_util instead, as {"$numberDouble": "NaN"}.
+One difference remains: bson.code.Code is a str subclass, which the encoder writes as a plain string rather than
+{"$code": ...}.
+
+The _bulk helpers build NDJSON request bodies from raw bytes, so document sources that are already JSON
+(e.g. S3 objects written by the reader) go to OpenSearch without being decoded and encoded again.
+external_version() turns a clusterTime into an OpenSearch external version that sorts like the clusterTime.
+"""
+
+
+def default(obj):
+    """Encode the BSON values the json module does not know about."""
+    if isinstance(obj, ObjectId):
+        return {'$oid': str(obj)}
+    if isinstance(obj, Decimal128):
+        return {'$numberDecimal': str(obj)}
+    if isinstance(obj, Timestamp):
+        return {'$timestamp': {'t': obj.time, 'i': obj.inc}}
+    # Dates, binary, regular expressions, min/max keys, ... - same output as json_util
+    return json_util.default(obj, json_util.RELAXED_JSON_OPTIONS)
+
+
+# allow_nan=False raises ValueError instead of writing NaN and Infinity, which are not valid JSON
+encoder = json.JSONEncoder(default=default, separators=(',', ':'), allow_nan=False)
+
+
+def dumps(obj):
+    """Encode a BSON document as relaxed Extended JSON."""
+    try:
+        return encoder.encode(obj)
+    except ValueError:
+        return json_util.dumps(obj, json_options=json_util.RELAXED_JSON_OPTIONS, separators=(',', ':'))
+
+
+def dumps_with_raw_field(obj, name, raw_json):
+    """Encode a document and add a field whose value is already encoded JSON, without encoding it again."""
+    encoded = dumps(obj)
+    separator = ',' if len(encoded) > 2 else ''
+    return encoded[:-1] + separator + json.dumps(name) + ':' + raw_json + '}'
+
+
+def bulk_action_line(action, metadata):
+    """Return one _bulk action line, e.g. bulk_action_line('index', {'_index': 'db-coll', '_id': '1'})."""
+    return json.dumps({action: metadata}, separators=(',', ':')).encode('utf-8')
+
+
+def build_bulk_body(items):
+    """Join (action line, source) pairs into an NDJSON _bulk body. Sources are bytes of single line JSON, or None for deletes."""
+    lines = []
+    for action_line, source in items:
+        lines.append(action_line)
+        if source is not None:
+            lines.append(source)
+    lines.append(b'')
+
+    return b'\n'.join(lines)
+
+
+def external_version(t, i):
+    """Return the OpenSearch external version of a clusterTime (t, i), seconds in the high and the increment in the low 32 bits."""
+    return (int(t) << 32) | int(i)
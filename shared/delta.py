@@ -0,0 +1,185 @@
+#!/bin/env python
+
+import copy
+
+"""
+Partial updates shared by the DocumentDB reader and the OpenSearch writer.
+
+An update is the updateDescription of a change event, {'updatedFields': {path: value}, 'removedFields': [path]},
+whose paths are dotted, e.g. address.city, and may address array elements, e.g. tags.2. The helpers follow
+DocumentDB's $set and $unset semantics: setting a path creates the objects above it and pads arrays with None,
+unsetting an array element sets it to None.
+
+apply_update() applies an update to a full document, merge_updates() folds two consecutive updates of a
+document into one and project_update() narrows an update down to WATCHED_FIELDS, like the change stream
+pipeline does with fullDocument.
+"""
+
+# Returned by get_path() for a path that is not in the document
+MISSING = object()
+
+
+def covers(path, other):
+    """True if other is path or a path below it"""
+    return other == path or other.startswith(path + '.')
+
+
+def get_child(parent, key):
+    if isinstance(parent, list):
+        index = int(key)
+        return parent[index] if index < len(parent) else None
+    return parent.get(key)
+
+
+def put_child(parent, key, value):
+    if isinstance(parent, list):
+        index = int(key)
+        parent.extend([None] * (index + 1 - len(parent)))
+        parent[index] = value
+    else:
+        parent[key] = value
+
+
+def get_path(document, path):
+    """return the value at a dotted path, MISSING if it does not exist"""
+    value = document
+    for key in path.split('.'):
+        if isinstance(value, dict) and key in value:
+            value = value[key]
+        elif isinstance(value, list) and key.isdigit() and int(key) < len(value):
+            value = value[int(key)]
+        else:
+            return MISSING
+    return value
+
+
+def set_path(document, path, value):
+    """set a dotted path, creating the objects above it"""
+    keys = path.split('.')
+    parent = document
+    for key in keys[:-1]:
+        child = get_child(parent, key)
+        if not isinstance(child, (dict, list)):
+            child = {}
+            put_child(parent, key, child)
+        parent = child
+    put_child(parent, keys[-1], value)
+
+
+def unset_path(document, path):
+    """remove a dotted path, if it exists"""
+    keys = path.split('.')
+    parent = document
+    for key in keys[:-1]:
+        parent = get_child(parent, key) if isinstance(parent, (dict, list)) else None
+        if parent is None:
+            return
+
+    if isinstance(parent, dict):
+        parent.pop(keys[-1], None)
+    elif isinstance(parent, list) and int(keys[-1]) < len(parent):
+        parent[int(keys[-1])] = None
+
+
+def apply_update(document, update):
+    """apply an update to a full document in place"""
+    for path in update.get('removedFields', []):
+        unset_path(document, path)
+    for (path, value) in update.get('updatedFields', {}).items():
+        set_path(document, path, value)
+
+
+def merge_updates(update, newer):
+    """return a single update with the effect of update followed by newer"""
+    updated = dict(update.get('updatedFields', {}))
+    removed = list(update.get('removedFields', []))
+
+    changes = [(path, True, None) for path in newer.get('removedFields', [])]
+    changes.extend((path, False, value) for (path, value) in newer.get('updatedFields', {}).items())
+
+    for (path, remove, value) in changes:
+        # Earlier changes at or below the path are overwritten
+        overwritten = [other for other in updated if covers(path, other)]
+        for other in overwritten:
+            del updated[other]
+        if remove and overwritten and path.rsplit('.', 1)[-1].isdigit():
+            # The array may have been padded up to the element, which unsetting leaves as None
+            (remove, value) = (False, None)
+        removed = [other for other in removed if not covers(path, other)]
+
+        updated_parent = next((other for other in updated if covers(other, path)), None)
+        removed_parent = next((other for other in removed if covers(other, path)), None)
+
+        if updated_parent is not None:
+            # An earlier change set an object above the path, change the path within its value
+            parent_value = copy.deepcopy(updated[updated_parent])
+            if remove:
+                if isinstance(parent_value, (dict, list)):
+                    unset_path(parent_value, path[len(updated_parent) + 1:])
+            else:
+                if not isinstance(parent_value, (dict, list)):
+                    parent_value = {}
+                set_path(parent_value, path[len(updated_parent) + 1:], value)
+            updated[updated_parent] = parent_value
+
+        elif removed_parent is not None:
+            # Setting a path below a removed field creates it again, removing one is a no-op
+            if not remove:
+                removed.remove(removed_parent)
+                parent_value = {}
+                set_path(parent_value, path[len(removed_parent) + 1:], value)
+                updated[removed_parent] = parent_value
+
+        elif remove:
+            removed.append(path)
+        else:
+            updated[path] = value
+
+    return {'updatedFields': updated, 'removedFields': removed}
+
+
+def project_update(update, fields):
+    """return the part of an update that changes the dotted fields, or the whole update without fields"""
+    if not fields:
+        return update
+
+    updated = {}
+    removed = []
+
+    for (path, value) in update.get('updatedFields', {}).items():
+        for field in fields:
+            if covers(field, path):
+                updated[path] = value
+            elif covers(path, field):
+                # An object above the field was set, keep just the field, which it may no longer have
+                field_value = get_path(value, field[len(path) + 1:])
+                if field_value is MISSING:
+                    removed.append(field)
+                else:
+                    updated[field] = field_value
+
+    for path in update.get('removedFields', []):
+        for field in fields:
+            if covers(field, path):
+                removed.append(path)
+            elif covers(path, field):
+                removed.append(field)
+
+    return {'updatedFields': updated, 'removedFields': sorted(set(removed))}
+
+
+def get_partial_document(update):
+    """return the updatedFields of an update as a nested partial document, None if merging it into a document would not have the same effect.
+
+    A merge only replaces values that are not objects, so it cannot remove fields, replace a whole object or address array elements.
+    """
+    if update.get('removedFields'):
+        return None
+
+    document = {}
+    for (path, value) in update.get('updatedFields', {}).items():
+        if isinstance(value, dict) or any(key.isdigit() for key in path.split('.')):
+            return None
+        set_path(document, path, value)
+
+    return document
@@ -0,0 +1,210 @@
+#!/bin/env python
+
+import json
+import logging
+import os
+import threading
+import time
+import aws_clients
+
+"""
+OpenSearch index management for the OpenSearch writer.
+
+ensure_index() creates the target index of a db-coll name from a template the first time it is written to,
+instead of letting OpenSearch auto-create it with default settings and dynamic mappings. Known indices are
+cached in memory, so warm invocations do not ask OpenSearch again.
+
+With INDEX_USE_ALIASES, db-coll is a write alias over db-coll-000001, db-coll-000002, ... and an index template
+db-coll-* applies the same settings to every backing index. INDEX_ROLLOVER_CONDITIONS, e.g. {"max_size": "50gb"},
+rolls the alias over to a new backing index. Rollover only suits append-mostly collections, since a change of a
+document that lives in an older backing index is written to the current one as a new copy.
+
+update_bulk_mode() switches an index to bulk ingest settings, a longer refresh_interval and fewer replicas, while the
+writer is catching up with a backlog, and back to the template settings once it has caught up. The settings in
+OpenSearch are the only state, so any writer container can restore what another one changed. Indices whose
+settings differ from both are left alone. begin_bulk()/end_bulk() do the same for explicit windows, e.g. a backfill.
+
+Optional environment variables:
+INDEX_TEMPLATE: JSON body, settings/mappings/aliases, of new indices. Defaults to DEFAULT_INDEX_TEMPLATE.
+INDEX_USE_ALIASES: Write through db-coll aliases over numbered backing indices. Defaults to false.
+INDEX_ROLLOVER_CONDITIONS: JSON rollover conditions of aliased indices. Defaults to no rollover.
+INDEX_CATCHUP_LAG_SECONDS: Replication lag above which an index switches to bulk settings, and below half of
+    which it switches back. Only a later batch switches it back, so an index whose traffic stops while it
+    catches up keeps the bulk settings until the next write or end_bulk(). Defaults to 0, disabled.
+INDEX_BULK_REFRESH_INTERVAL: refresh_interval while in bulk mode. Defaults to 30s.
+INDEX_BULK_NUMBER_OF_REPLICAS: number_of_replicas while in bulk mode. Defaults to 0.
+"""
+
+DEFAULT_INDEX_TEMPLATE = {
+    'settings': {
+        'index': {
+            'refresh_interval': '1s',
+            'number_of_replicas': 1,
+            # Fail documents that would add too many fields instead of growing the mapping without bound
+            'mapping': {'total_fields': {'limit': 1000}}
+        }
+    },
+    'mappings': {
+        # Strings that happen to look like dates or numbers would otherwise fix the field type on first sight
+        'date_detection': False,
+        'numeric_detection': False
+    }
+}
+DEFAULT_BULK_REFRESH_INTERVAL = '30s'
+DEFAULT_BULK_NUMBER_OF_REPLICAS = 0
+# How often an index's bulk mode and rollover conditions are looked at, per container
+SETTINGS_CHECK_INTERVAL_SECONDS = 60
+ROLLOVER_CHECK_INTERVAL_SECONDS = 300
+
+known_indices = set()                   # indices and aliases that exist
+bulk_mode = {}                          # index -> True/False as last seen in OpenSearch
+last_settings_check = {}                # index -> time.monotonic() of the last bulk mode check
+last_rollover_check = {}                # alias -> time.monotonic() of the last rollover
+
+index_lock = threading.Lock()
+
+logger = logging.getLogger()
+
+
+def get_index_template():
+    """Return the body of new indices."""
+    if "INDEX_TEMPLATE" in os.environ:
+        return json.loads(os.environ['INDEX_TEMPLATE'])
+    return DEFAULT_INDEX_TEMPLATE
+
+
+def use_aliases():
+    return os.environ.get('INDEX_USE_ALIASES', 'false').lower() == 'true'
+
+
+def is_already_exists(ex):
+    """True for the error of creating an index another writer has just created"""
+    return getattr(ex, 'error', None) in ('resource_already_exists_exception', 'index_already_exists_exception')
+
+
+def ensure_index(index):
+    """Create index, or the write alias index with its first backing index, unless it already exists."""
+    if index in known_indices:
+        return
+
+    with index_lock:
+        if index in known_indices:
+            return
+
+        client = aws_clients.get_opensearch_client()
+
+        try:
+            # True for concrete indices too, so indices created before aliases were enabled keep being used
+            if not client.indices.exists(index=index):
+                template = get_index_template()
+
+                if use_aliases():
+                    logger.info('Creating index template and write alias {}.'.format(index))
+                    client.indices.put_index_template(name=index, body={'index_patterns': [index + '-*'], 'template': template})
+                    body = dict(template, aliases={index: {'is_write_index': True}})
+                    client.indices.create(index=index + '-000001', body=body)
+                else:
+                    logger.info('Creating index {}.'.format(index))
+                    client.indices.create(index=index, body=template)
+
+        except Exception as ex:
+            if not is_already_exists(ex):
+                logger.error('Failed to create index {}: {}'.format(index, ex))
+                raise
+
+        known_indices.add(index)
+
+
+def get_normal_settings():
+    """Return the (refresh_interval, number_of_replicas) of the template, restored after bulk mode."""
+    settings = get_index_template().get('settings', {}).get('index', {})
+    return str(settings.get('refresh_interval', '1s')), str(settings.get('number_of_replicas', 1))
+
+
+def get_bulk_settings():
+    """Return the (refresh_interval, number_of_replicas) of bulk mode."""
+    return (os.environ.get('INDEX_BULK_REFRESH_INTERVAL', DEFAULT_BULK_REFRESH_INTERVAL),
+            str(os.environ.get('INDEX_BULK_NUMBER_OF_REPLICAS', DEFAULT_BULK_NUMBER_OF_REPLICAS)))
+
+
+def set_bulk_mode(index, enabled):
+    """Switch every index behind index to the bulk or the template settings, if it is on the other one."""
+    client = aws_clients.get_opensearch_client()
+    (current, target) = (get_normal_settings(), get_bulk_settings()) if enabled else (get_bulk_settings(), get_normal_settings())
+
+    response = client.indices.get_settings(index=index, name='index.refresh_interval,index.number_of_replicas',
+                                           flat_settings=True, include_defaults=True)
+
+    for concrete_index, index_settings in response.items():
+        values = dict(index_settings.get('defaults', {}), **index_settings.get('settings', {}))
+        settings = (values.get('index.refresh_interval'), values.get('index.number_of_replicas'))
+
+        if settings == target:
+            continue
+        if settings != current:
+            logger.warning('Index {} has custom settings {}, not changing them.'.format(concrete_index, settings))
+            continue
+
+        logger.info('Switching index {} to {} settings {}.'.format(concrete_index, 'bulk' if enabled else 'normal', target))
+        client.indices.put_settings(index=concrete_index, body={'index': {'refresh_interval': target[0], 'number_of_replicas': target[1]}})
+
+    bulk_mode[index] = enabled
+
+
+def begin_bulk(index):
+    """Switch an index to bulk settings for an explicit window, e.g. a backfill."""
+    ensure_index(index)
+    set_bulk_mode(index, True)
+
+
+def end_bulk(index):
+    """Restore the template settings of an index after begin_bulk()."""
+    set_bulk_mode(index, False)
+
+
+def update_bulk_mode(index, lag_seconds):
+    """Enter bulk mode while the replication lag of index is above INDEX_CATCHUP_LAG_SECONDS, leave it below half of that."""
+    catchup_lag = float(os.environ.get('INDEX_CATCHUP_LAG_SECONDS', 0))
+    if catchup_lag <= 0:
+        return
+
+    if lag_seconds > catchup_lag:
+        wanted = True
+    elif lag_seconds < catchup_lag / 2:
+        wanted = False
+    else:
+        return
+
+    # A caught up batch may be the last one for a while, so an index this container switched to bulk settings is
+    # restored right away rather than on a later check
+    restoring = bulk_mode.get(index) is True and not wanted
+    now = time.monotonic()
+    if not restoring and now - last_settings_check.get(index, float('-inf')) < SETTINGS_CHECK_INTERVAL_SECONDS:
+        return
+    last_settings_check[index] = now
+
+    # Another container may have switched the index, so the settings are checked while bulk_mode is unknown
+    if bulk_mode.get(index) != wanted:
+        try:
+            set_bulk_mode(index, wanted)
+        except Exception as ex:
+            logger.error('Failed to update bulk mode of index {}: {}'.format(index, ex))
+
+
+def maybe_rollover(index):
+    """Roll a write alias over to a new backing index once INDEX_ROLLOVER_CONDITIONS are met."""
+    if not use_aliases() or "INDEX_ROLLOVER_CONDITIONS" not in os.environ:
+        return
+
+    now = time.monotonic()
+    if now - last_rollover_check.get(index, float('-inf')) < ROLLOVER_CHECK_INTERVAL_SECONDS:
+        return
+    last_rollover_check[index] = now
+
+    try:
+        response = aws_clients.get_opensearch_client().indices.rollover(
+            alias=index, body={'conditions': json.loads(os.environ['INDEX_ROLLOVER_CONDITIONS'])})
+        if response.get('rolled_over'):
+            logger.info('Rolled alias {} over from {} to {}.'.format(index, response.get('old_index'), response.get('new_index')))
+    except Exception as ex:
+        logger.error('Failed to roll over alias {}: {}'.format(index, ex))
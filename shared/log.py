@@ -0,0 +1,152 @@
+#!/bin/env python
+
+import datetime
+import json
+import logging
+import os
+import random
+import sys
+
+"""
+Logging set up shared by the Lambda functions.
+
+setup() makes the root logger write one JSON object per line and puts a byte budget on it: once
+LOG_BYTES_PER_INVOCATION bytes of messages have been written, records below WARNING are dropped until
+end_invocation() reports how many were and starts the next budget.
+
+Per-event records use %-style arguments, which are only formatted if the record is emitted. They are
+guarded by sampled(), and large objects are wrapped in Payload() so at most LOG_PAYLOAD_MAX_CHARS
+characters of them are ever formatted into a message, e.g.
+
+    if log.sampled():
+        logger.info('Event: %s', log.Payload(change_event))
+
+Optional environment variables:
+LOGLEVEL: Level of the root logger. Defaults to INFO.
+LOG_FORMAT: json, or text for plain messages. Defaults to json.
+LOG_EVENT_SAMPLE_RATE: Share of the per-event records that are logged. Defaults to 0.01.
+LOG_BYTES_PER_INVOCATION: Message bytes logged below WARNING per invocation. Defaults to 65536, 0 for no limit.
+LOG_PAYLOAD_MAX_CHARS: Characters of a Payload written to the log. Defaults to 512.
+"""
+
+DEFAULT_EVENT_SAMPLE_RATE = 0.01
+DEFAULT_BYTES_PER_INVOCATION = 65536
+DEFAULT_PAYLOAD_MAX_CHARS = 512
+
+event_sample_rate = DEFAULT_EVENT_SAMPLE_RATE
+payload_max_chars = DEFAULT_PAYLOAD_MAX_CHARS
+budget_filter = None                    # BudgetFilter of the root handlers, set up by setup()
+
+
+class Payload:
+    """Lazily formatted, truncated representation of a large object, e.g. a change event or an S3 response"""
+
+    __slots__ = ('obj',)
+
+    def __init__(self, obj):
+        self.obj = obj
+
+    def __str__(self):
+        obj = self.obj
+        if isinstance(obj, (bytes, bytearray)):
+            text = bytes(obj[:payload_max_chars * 4]).decode('utf-8', errors='replace')
+            length = len(obj)
+        else:
+            text = str(obj)
+            length = len(text)
+
+        if length > payload_max_chars:
+            return '{}... ({} of {} truncated)'.format(text[:payload_max_chars], length - payload_max_chars, length)
+        return text
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per record, with any fields passed as extra={'fields': {...}}"""
+
+    def format(self, record):
+        entry = {
+            'time': datetime.datetime.fromtimestamp(record.created, datetime.timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage()
+        }
+        fields = getattr(record, 'fields', None)
+        if fields:
+            entry.update(fields)
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+
+        return json.dumps(entry, default=str)
+
+
+class BudgetFilter(logging.Filter):
+    """Drop records below WARNING once max_bytes of messages have been written, 0 for no limit"""
+
+    def __init__(self, max_bytes):
+        super().__init__()
+        self.max_bytes = max_bytes
+        self.bytes_written = 0
+        self.dropped = 0
+
+    def filter(self, record):
+        if self.max_bytes <= 0:
+            return True
+
+        message_bytes = len(record.getMessage())
+        if record.levelno < logging.WARNING and self.bytes_written + message_bytes > self.max_bytes:
+            self.dropped += 1
+            return False
+
+        self.bytes_written += message_bytes
+        return True
+
+    def reset(self):
+        (dropped, self.dropped, self.bytes_written) = (self.dropped, 0, 0)
+        return dropped
+
+
+def setup():
+    """Configure the root logger from the environment and return it. Safe to call more than once."""
+    global event_sample_rate, payload_max_chars, budget_filter
+
+    event_sample_rate = float(os.environ.get('LOG_EVENT_SAMPLE_RATE', DEFAULT_EVENT_SAMPLE_RATE))
+    payload_max_chars = int(os.environ.get('LOG_PAYLOAD_MAX_CHARS', DEFAULT_PAYLOAD_MAX_CHARS))
+
+    logger = logging.getLogger()
+    logger.setLevel(level=os.environ.get('LOGLEVEL', 'INFO').upper())
+
+    # The Lambda runtime installs its own handler on the root logger, elsewhere e.g. the tailer needs one
+    if not logger.handlers:
+        logger.addHandler(logging.StreamHandler(sys.stderr))
+
+    if os.environ.get('LOG_FORMAT', 'json').lower() == 'json':
+        formatter = JsonFormatter()
+    else:
+        formatter = logging.Formatter('%(asctime)s %(levelname)s %(message)s')
+
+    if budget_filter is None:
+        budget_filter = BudgetFilter(0)
+    budget_filter.max_bytes = int(os.environ.get('LOG_BYTES_PER_INVOCATION', DEFAULT_BYTES_PER_INVOCATION))
+
+    for handler in logger.handlers:
+        handler.setFormatter(formatter)
+        if budget_filter not in handler.filters:
+            handler.addFilter(budget_filter)
+
+    return logger
+
+
+def sampled():
+    """True for the LOG_EVENT_SAMPLE_RATE share of calls, guards per-event records."""
+    return event_sample_rate >= 1 or random.random() < event_sample_rate
+
+
+def end_invocation():
+    """Report the records dropped by the byte budget and start a new budget."""
+    if budget_filter is None:
+        return
+
+    dropped = budget_filter.reset()
+    if dropped:
+        logging.getLogger().warning('%d log records dropped after LOG_BYTES_PER_INVOCATION of %d bytes',
+                                    dropped, budget_filter.max_bytes)
@@ -0,0 +1,152 @@
+#!/bin/env python
+
+import json
+import os
+import random
+import threading
+import time
+
+"""
+Per-stage timings and counters shared by the Lambda functions, written as one CloudWatch Embedded Metric
+Format (EMF) log line per invocation.
+
+Stages are timed with `with metrics.timer('S3Put'):` and counters bumped with metrics.add('EventsInlined').
+Samples are aggregated in memory and flush() writes them out at the end of the invocation, so nothing
+is logged per event. Each stage is reported as <stage>Calls and a <stage>Latency array of up to
+MAX_SAMPLES values, sampled uniformly when there are more, from which CloudWatch derives percentiles.
+Lags recorded with record_lag(), e.g. ReplicationLag, are reported as an array under their own name.
+
+Optional environment variables:
+METRICS_ENABLED: Set to false to turn instrumentation into no-ops. Defaults to true.
+METRICS_NAMESPACE: CloudWatch namespace of the metrics. Defaults to DocDBChangeStreams.
+"""
+
+# EMF accepts at most 100 values per metric
+MAX_SAMPLES = 100
+DEFAULT_NAMESPACE = 'DocDBChangeStreams'
+
+enabled = os.environ.get('METRICS_ENABLED', 'true').lower() == 'true'
+
+stages = {}                             # stage name -> [calls, reservoir of latencies in milliseconds]
+counters = {}                           # counter name -> value
+
+# Stages are also timed on worker threads
+metrics_lock = threading.Lock()
+
+
+class Timer:
+    """Context manager recording the duration of a stage"""
+
+    __slots__ = ('stage', 'start')
+
+    def __init__(self, stage):
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        record(self.stage, (time.perf_counter() - self.start) * 1000)
+        return False
+
+
+class NullTimer:
+    """Timer used while metrics are disabled"""
+
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+NULL_TIMER = NullTimer()
+
+
+def timer(stage):
+    """Return a context manager timing one call of a stage."""
+    return Timer(stage) if enabled else NULL_TIMER
+
+
+def record(stage, milliseconds):
+    """Record one sample of a stage, e.g. a latency measured elsewhere."""
+    if not enabled:
+        return
+
+    with metrics_lock:
+        stats = stages.get(stage)
+        if stats is None:
+            stats = stages[stage] = [0, []]
+        stats[0] += 1
+        if len(stats[1]) < MAX_SAMPLES:
+            stats[1].append(milliseconds)
+        else:
+            # Reservoir sampling keeps a uniform sample of every call
+            slot = random.randrange(stats[0])
+            if slot < MAX_SAMPLES:
+                stats[1][slot] = milliseconds
+
+
+def add(counter, value=1):
+    """Increase a counter."""
+    if not enabled or not value:
+        return
+
+    with metrics_lock:
+        counters[counter] = counters.get(counter, 0) + value
+
+
+def record_lag(cluster_time_seconds, stage='ReplicationLag'):
+    """Record the lag of a change, from its DocumentDB clusterTime until now."""
+    if enabled:
+        record(stage, max(0.0, time.time() - cluster_time_seconds) * 1000)
+
+
+def flush():
+    """Write the collected metrics as one EMF line and start over."""
+    global stages, counters
+
+    if not enabled:
+        return
+
+    with metrics_lock:
+        (flushed_stages, flushed_counters) = (stages, counters)
+        stages = {}
+        counters = {}
+
+    if not flushed_stages and not flushed_counters:
+        return
+
+    function_name = os.environ.get('AWS_LAMBDA_FUNCTION_NAME', 'local')
+    definitions = []
+    document = {'FunctionName': function_name}
+
+    for stage, (calls, samples) in sorted(flushed_stages.items()):
+        if stage.endswith('Lag'):
+            # Lags are per event, their count is already in the event counters
+            name = stage
+        else:
+            name = stage + 'Latency'
+            definitions.append({'Name': stage + 'Calls', 'Unit': 'Count'})
+            document[stage + 'Calls'] = calls
+        definitions.append({'Name': name, 'Unit': 'Milliseconds'})
+        document[name] = [round(sample, 3) for sample in samples]
+
+    for counter, value in sorted(flushed_counters.items()):
+        definitions.append({'Name': counter, 'Unit': 'Count'})
+        document[counter] = value
+
+    document['_aws'] = {
+        'Timestamp': int(time.time() * 1000),
+        'CloudWatchMetrics': [{
+            'Namespace': os.environ.get('METRICS_NAMESPACE', DEFAULT_NAMESPACE),
+            'Dimensions': [['FunctionName']],
+            'Metrics': definitions
+        }]
+    }
+
+    # Lambda sends stdout to CloudWatch Logs, which extracts the metrics from EMF lines
+    print(json.dumps(document, separators=(',', ':')), flush=True)
@@ -1,9 +1,29 @@
 import json
 import os
-import boto3
-import logging
+import aws_clients
+import log
 import time
 
+"""
+Invoke the DocumentDB reader Lambda function at a fixed rate for the lifetime of this function.
+
+Environment variables:
+LAMBDA_FUNCTION_NAME: The Lambda function to invoke.
+INVOCATION_TYPE: RequestResponse, Event or DryRun. The template uses Event. RequestResponse waits for each reader run,
+    so reader errors and latency reach this function and Lambda's asynchronous retries no longer apply, but it is
+    the opt-in that idle back-off needs.
+TRIGGER_LAMBDA_TIMEOUT: How long to keep invoking the function, in seconds.
+INVOCATION_TIME_INTERVAL: The base interval between invocations, in seconds.
+MAX_INVOCATION_TIME_INTERVAL (optional): The longest interval to back off to while the reader reports no records.
+    Defaults to 8 times INVOCATION_TIME_INTERVAL. Back-off needs the reader's response, so it only applies to
+    RequestResponse.
+SNS_TOPIC_ARN_ALERT: The topic to send exceptions.
+"""
+
+# Status codes the DocumentDB reader returns when it found no records to process
+IDLE_STATUS_CODES = (201, 202)
+DEFAULT_MAX_INTERVAL_MULTIPLIER = 8
+
 # Trigger a lambda function from within this Lambda function
 def trigger_invocation_on_docdb_reader_lambda(function_name, invocation_type):
 
@@ -12,7 +32,81 @@ def trigger_invocation_on_docdb_reader_lambda(function_name, invocation_type):
         InvocationType = invocation_type,
     )
 
-    logger.info("Lambda Invoke Response: {}".format(lambdaInvokeResponse))
+    logger.debug("Lambda Invoke Response: %s", log.Payload(lambdaInvokeResponse))
+
+    return lambdaInvokeResponse
+
+def is_reader_idle(lambda_invoke_response):
+    """Return True if a synchronous invocation of the reader reported no records to process"""
+    if 'Payload' not in lambda_invoke_response or 'FunctionError' in lambda_invoke_response:
+        return False
+
+    try:
+        payload = json.loads(lambda_invoke_response['Payload'].read())
+    except ValueError:
+        return False
+
+    return isinstance(payload, dict) and payload.get('statusCode') in IDLE_STATUS_CODES
+
+class InvocationScheduler:
+    """Fixed-rate scheduler with idle back-off.
+
+    Deadlines are computed from the previous deadline rather than from when the previous invocation returned,
+    so invoke latency does not add to the period. While the reader reports idle the interval doubles up to
+    max_interval, and it snaps back to base_interval as soon as records show up.
+    """
+
+    def __init__(self, base_interval, max_interval, duration):
+        self.base_interval = base_interval
+        self.max_interval = max(max_interval, base_interval)
+        self.interval = base_interval
+        self.start = time.monotonic()
+        self.end = self.start + duration
+        self.next_deadline = self.start
+        self.invocations = 0
+        self.idle_invocations = 0
+        self.missed_deadlines = 0
+
+    def wait_for_next_slot(self):
+        """sleep until the next deadline, return False once the scheduling window is over"""
+        now = time.monotonic()
+        if self.next_deadline >= self.end:
+            return False
+
+        if self.next_deadline > now:
+            time.sleep(self.next_deadline - now)
+        elif now - self.next_deadline > self.interval:
+            # Skip slots missed because of a slow invoke instead of firing a burst to catch up
+            self.missed_deadlines += 1
+            self.next_deadline = now
+
+        return True
+
+    def record_invocation(self, idle):
+        """schedule the next deadline, backing off while the reader is idle"""
+        self.invocations += 1
+
+        if idle:
+            self.idle_invocations += 1
+            self.interval = min(self.interval * 2, self.max_interval)
+        else:
+            self.interval = self.base_interval
+
+        self.next_deadline += self.interval
+
+    def report(self):
+        """achieved vs. target invocation rate over the elapsed window"""
+        elapsed = max(time.monotonic() - self.start, 1e-9)
+        target_invocations = elapsed / self.base_interval
+        return {
+            'invocations': self.invocations,
+            'idleInvocations': self.idle_invocations,
+            'missedDeadlines': self.missed_deadlines,
+            'elapsedSeconds': round(elapsed, 3),
+            'targetRatePerSecond': round(1 / self.base_interval, 3),
+            'achievedRatePerSecond': round(self.invocations / elapsed, 3),
+            'achievedVsTarget': round(self.invocations / target_invocations, 3) if target_invocations else 0
+        }
 
 def send_sns_alert(message):
     """send an SNS alert"""
@@ -30,37 +124,37 @@ def send_sns_alert(message):
         raise
 
 
-logger = logging.getLogger()
-logger.setLevel(level = os.environ.get('LOGLEVEL', 'INFO').upper())
+# Structured logging with a per-invocation byte budget, see shared/log.py
+logger = log.setup()
 
-sns_client = boto3.client('sns')        # SNS client - for exception alerting purposes
-lambda_client = boto3.client('lambda')
+sns_client = aws_clients.get_client('sns')          # SNS client - for exception alerting purposes
+lambda_client = aws_clients.get_client('lambda')
 
 def lambda_handler(event, context):
     """Trigger a given Lambda function in short intervals for that Lambda function to typically compute. This is a workaround for Events Rule which cannot do trigger less than a minute"""
 
-    logger.debug("Event: {}".format(event))
-    logger.debug("Context: {}".format(context))    
+    logger.debug("Event: %s", log.Payload(event))
+    logger.debug("Context: %s", context)    
 
     lambda_function_name = str(os.environ.get("LAMBDA_FUNCTION_NAME"))
     trigger_lambda_timeout = int(os.environ.get("TRIGGER_LAMBDA_TIMEOUT"))
     invocation_type = str(os.environ.get("INVOCATION_TYPE"))
     invocation_time_interval = int(os.environ.get("INVOCATION_TIME_INTERVAL"))
+    max_invocation_time_interval = float(os.environ.get("MAX_INVOCATION_TIME_INTERVAL", invocation_time_interval * DEFAULT_MAX_INTERVAL_MULTIPLIER))
 
     events_processed = 0
     is_error = 0
     success_status_code_by_invocation_type = { "RequestResponse": 200, "Event": 202, "DryRun": 204 }
+    scheduler = InvocationScheduler(invocation_time_interval, max_invocation_time_interval, trigger_lambda_timeout)
 
     try:        
 
-        # Runs every second until the Lambda function times out. You could set a larger lambda timeout (max 15 minutes).
-        iter = 0 
-        while iter < (trigger_lambda_timeout / invocation_time_interval):
-            logger.info("Invoking {} using AWS Request ID: {}...".format(lambda_function_name, context.aws_request_id))
-            trigger_invocation_on_docdb_reader_lambda(lambda_function_name, invocation_type)
+        # Runs at a fixed rate until the scheduling window is over. You could set a larger lambda timeout (max 15 minutes).
+        while scheduler.wait_for_next_slot():
+            logger.debug("Invoking %s using AWS Request ID: %s...", lambda_function_name, context.aws_request_id)
+            lambdaInvokeResponse = trigger_invocation_on_docdb_reader_lambda(lambda_function_name, invocation_type)
             events_processed += 1
-            time.sleep(invocation_time_interval)
-            iter += 1
+            scheduler.record_invocation(invocation_type == "RequestResponse" and is_reader_idle(lambdaInvokeResponse))
 
     except Exception as ex:
         logger.error('Exception in invoking {} using AWS Request ID: {} : {}'.format(lambda_function_name, context.aws_request_id, ex))
@@ -70,11 +164,14 @@ def lambda_handler(event, context):
 
     finally:
         logger.info("{} Invocations Complete using AWS Request ID: {}".format(events_processed, context.aws_request_id))
+        logger.info("Invocation rate report: {}".format(json.dumps(scheduler.report())))
+        log.end_invocation()
 
         return {
                 'statusCode': success_status_code_by_invocation_type[invocation_type],
                 'description': 'Success',
-                'detail': '{} records processed successfully using AWS Request ID: {}'.format(events_processed, context.aws_request_id)
+                'detail': '{} records processed successfully using AWS Request ID: {}'.format(events_processed, context.aws_request_id),
+                'report': scheduler.report()
             } if is_error == 0 else {
                 'statusCode': 0,
                 'description': 'Failure',